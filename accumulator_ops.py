@@ -0,0 +1,159 @@
+"""Allocation-free reduction ops for ``geoprocessing.raster_calculator``.
+
+Not a command line script. Every op takes the nodata value as its first
+argument, pass it as ``(nodata, 'raw')`` ahead of the raster list, e.g.::
+
+    geoprocessing.raster_calculator(
+        [(nodata, 'raw')] + raster_path_band_list, accumulator_ops.sum_op,
+        target_path, gdal.GDT_Float32, nodata)
+
+Arrays are added one at a time into per-thread buffers that are reused
+from block to block, so a block of N rasters costs a couple of block sized
+buffers instead of the (N, rows, cols) stack ``numpy.sum(array_list,
+axis=0)`` builds. Pixels are skipped per array where they are nodata or
+not finite.
+"""
+import threading
+
+import numpy
+
+_THREAD_BUFFERS = threading.local()
+
+
+def _block_buffers(shape):
+    """Return this thread's (sum, valid_count, nodata_count, nodata_mask,
+    redo_mask) buffers.
+
+    Buffers are reallocated only when the block shape changes, which
+    ``raster_calculator`` does only for the edge blocks.
+    """
+    buffers = getattr(_THREAD_BUFFERS, 'buffers', None)
+    if buffers is None or buffers[0].shape != shape:
+        buffers = (
+            numpy.empty(shape, dtype=numpy.float32),
+            numpy.empty(shape, dtype=numpy.int32),
+            numpy.empty(shape, dtype=numpy.uint8),
+            numpy.empty(shape, dtype=bool),
+            numpy.empty(shape, dtype=bool))
+        _THREAD_BUFFERS.buffers = buffers
+    return buffers
+
+
+def _masked_accumulate(nodata, array_list, accumulator, valid_count):
+    """Sum and count the valid pixels of `array_list` one array at a time.
+
+    Args:
+        nodata (float): nodata value of the arrays or None.
+        array_list (list): same shaped arrays.
+        accumulator (numpy.ndarray): float32 array to write the sum to.
+        valid_count (numpy.ndarray): int32 array to write the count to.
+
+    Returns:
+        None
+    """
+    invalid_mask = numpy.empty(accumulator.shape, dtype=bool)
+    nodata_mask = numpy.empty(accumulator.shape, dtype=bool)
+    next_accumulator = numpy.empty(accumulator.shape, dtype=numpy.float32)
+    invalid_count = numpy.zeros(
+        accumulator.shape,
+        dtype=numpy.uint8 if len(array_list) < 256 else numpy.int32)
+    sum_array = accumulator
+    sum_array.fill(0)
+    for array in array_list:
+        numpy.isfinite(array, out=invalid_mask)
+        numpy.logical_not(invalid_mask, out=invalid_mask)
+        if nodata is not None:
+            numpy.equal(array, nodata, out=nodata_mask)
+            numpy.logical_or(invalid_mask, nodata_mask, out=invalid_mask)
+        # adding everything and putting back the few invalid pixels is
+        # several times faster than ``numpy.add(..., where=valid_mask)``
+        numpy.add(sum_array, array, out=next_accumulator)
+        numpy.copyto(next_accumulator, sum_array, where=invalid_mask)
+        sum_array, next_accumulator = next_accumulator, sum_array
+        numpy.add(
+            invalid_count, invalid_mask.view(numpy.uint8), out=invalid_count)
+    if sum_array is not accumulator:
+        accumulator[:] = sum_array
+    numpy.subtract(len(array_list), invalid_count, out=valid_count)
+
+
+def accumulate(nodata, array_list):
+    """Sum and count the valid pixels of `array_list` into reused buffers.
+
+    Sums are float32 like the daily rasters, the same precision the
+    stacking ``numpy.sum(array_list, axis=0)`` ops had. Non-finite values
+    are never valid.
+
+    Each array is read once: it's added to the sum unmasked and its nodata
+    pixels are tallied. That sum is already exact wherever a pixel is valid
+    on every day, or nodata on every day so its count is 0, which is every
+    pixel when the nodata mask doesn't change from day to day. Only the
+    rows with a NaN or inf, or with a pixel that is nodata on some days but
+    not all, are summed again with a per array mask.
+
+    Args:
+        nodata (float): nodata value of the arrays, if None only
+            non-finite values are skipped.
+        array_list (list): same shaped 2D arrays.
+
+    Returns:
+        (sum, valid_count) arrays, the sum is 0 where the count is 0. These
+        are the thread's reused buffers and are only valid until the next
+        call on the same thread.
+    """
+    accumulator, valid_count, nodata_count, nodata_mask, redo_mask = (
+        _block_buffers(array_list[0].shape))
+    n_arrays = len(array_list)
+    # a uint8 tally of the bool masks is much cheaper than an int32 one
+    tally = nodata_count if n_arrays < 256 else valid_count
+    accumulator.fill(0)
+    tally.fill(0)
+    for array in array_list:
+        numpy.add(accumulator, array, out=accumulator)
+        if nodata is not None:
+            numpy.equal(array, nodata, out=nodata_mask)
+            numpy.add(tally, nodata_mask.view(numpy.uint8), out=tally)
+    numpy.subtract(n_arrays, tally, out=valid_count)
+
+    numpy.isfinite(accumulator, out=redo_mask)
+    numpy.logical_not(redo_mask, out=redo_mask)
+    if nodata is not None:
+        numpy.logical_and(
+            valid_count != 0, valid_count != n_arrays, out=nodata_mask)
+        numpy.logical_or(redo_mask, nodata_mask, out=redo_mask)
+    row_index = numpy.flatnonzero(redo_mask.any(axis=1))
+    if row_index.size:
+        # a slice of rows is a view, picking the rows out would copy them
+        row_slice = slice(row_index[0], row_index[-1]+1)
+        _masked_accumulate(
+            nodata, [array[row_slice] for array in array_list],
+            accumulator[row_slice], valid_count[row_slice])
+    numpy.equal(valid_count, 0, out=redo_mask)
+    numpy.copyto(accumulator, 0, where=redo_mask)
+    return accumulator, valid_count
+
+
+def sum_op(nodata, *array_list):
+    """Per pixel sum of the valid values, nodata where none are valid."""
+    accumulator, valid_count = accumulate(nodata, array_list)
+    result = accumulator.copy()
+    result[valid_count == 0] = nodata
+    return result
+
+
+def mean_op(nodata, *array_list):
+    """Per pixel mean of the valid values, nodata where none are valid."""
+    accumulator, valid_count = accumulate(nodata, array_list)
+    # a float32 by float32 divide rounds the same as float64 would and
+    # skips the promotion of an int32 divisor
+    result = valid_count.astype(numpy.float32)
+    with numpy.errstate(invalid='ignore'):
+        numpy.divide(accumulator, result, out=result)
+    result[valid_count == 0] = nodata
+    return result
+
+
+def count_op(nodata, *array_list):
+    """Per pixel number of valid values."""
+    _, valid_count = accumulate(nodata, array_list)
+    return valid_count.copy()
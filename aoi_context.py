@@ -0,0 +1,285 @@
+"""AOI geometry, pixel window and mask prepared once for every day.
+
+Not a command line script. ``fetch_data.fetch_and_clip`` reprojects and
+rasterizes the AOI again for every day it clips, but the days of a dataset
+are all on one grid. ``AoiContext.build`` does that vector work once
+against one of the days: it reprojects the AOI to the grid, finds the
+window of grid pixels its bounds cover and rasterizes an all-touched mask
+of the window. Clipping a day is then a window read and a masked
+assignment, the clip stays on the dataset's own grid.
+"""
+import hashlib
+import logging
+import math
+import os
+
+from rasterio.transform import Affine
+from rasterio.windows import Window
+import geopandas
+import numpy
+import rasterio
+import rasterio.features
+import shapely
+
+import netcdf_conversion
+import stage_profile
+
+try:
+    from ecoshard import fetch_data
+except RuntimeError as e:
+    print(f'Error when loading fetch_data: {e}')
+
+LOGGER = logging.getLogger(__name__)
+
+
+def aoi_id(aoi_path):
+    """Name of an AOI for cache directories, e.g. "watersheds_0a1b2c3d4e5f".
+
+    The AOI is identified by its path, size and modification time, so an
+    edited vector gets a new id.
+    """
+    aoi_stat = os.stat(aoi_path)
+    aoi_key = hashlib.sha1(repr((
+        os.path.abspath(aoi_path), aoi_stat.st_size,
+        aoi_stat.st_mtime)).encode('utf-8')).hexdigest()[:12]
+    aoi_basename = os.path.basename(os.path.splitext(aoi_path)[0])
+    return f'{aoi_basename}_{aoi_key}'
+
+
+class AoiContext:
+    """An AOI prepared for clipping rasters on one grid.
+
+    Attributes:
+        geometry_list (list): shapely geometries of the AOI's features in
+            the grid's projection.
+        window (rasterio.windows.Window): pixels of the grid the AOI's
+            bounds cover.
+        mask (numpy.ndarray): bool array of the window, True where the AOI
+            touches a pixel.
+        grid_shape (tuple): rows and columns of the grid.
+        grid_transform (affine.Affine): geotransform of the grid.
+        crs_wkt (str): projection of the grid.
+    """
+
+    def __init__(
+            self, geometry_list, window, mask, grid_shape, grid_transform,
+            crs_wkt):
+        """See the class attributes."""
+        self.geometry_list = list(geometry_list)
+        self.window = Window(*window)
+        self.mask = mask
+        self.grid_shape = tuple(grid_shape)
+        self.grid_transform = Affine(*grid_transform[:6])
+        self.crs_wkt = crs_wkt
+
+    @classmethod
+    def build(cls, aoi_path, grid_raster_path):
+        """Prepare the AOI of `aoi_path` for the grid of a raster.
+
+        Args:
+            aoi_path (str): path to a polygon vector.
+            grid_raster_path (str): path to a raster on the grid, e.g. any
+                day of the dataset.
+
+        Returns:
+            AoiContext
+        """
+        with rasterio.open(grid_raster_path) as raster:
+            grid_shape = raster.shape
+            grid_transform = raster.transform
+            crs = raster.crs
+        aoi_vector = geopandas.read_file(aoi_path)
+        if crs is not None and aoi_vector.crs is not None:
+            aoi_vector = aoi_vector.to_crs(crs)
+        geometry_list = [
+            geometry for geometry in aoi_vector.geometry
+            if geometry is not None and not geometry.is_empty]
+        if not geometry_list:
+            raise ValueError(f'{aoi_path} has no geometry')
+
+        # grid pixels the bounds cover, snapped outward and clipped to the
+        # grid
+        min_x, min_y, max_x, max_y = aoi_vector.total_bounds
+        inverse_transform = ~grid_transform
+        corner_list = [
+            inverse_transform * (x, y)
+            for x in (min_x, max_x) for y in (min_y, max_y)]
+        n_rows, n_cols = grid_shape
+        col_off = max(0, math.floor(min(col for col, _ in corner_list)))
+        col_end = min(n_cols, math.ceil(max(col for col, _ in corner_list)))
+        row_off = max(0, math.floor(min(row for _, row in corner_list)))
+        row_end = min(n_rows, math.ceil(max(row for _, row in corner_list)))
+        if col_end <= col_off or row_end <= row_off:
+            raise ValueError(
+                f'{aoi_path} does not overlap the grid of '
+                f'{grid_raster_path}')
+        window = Window(
+            col_off, row_off, col_end-col_off, row_end-row_off)
+        mask = rasterio.features.rasterize(
+            [(geometry, 1) for geometry in geometry_list],
+            out_shape=(window.height, window.width),
+            transform=rasterio.windows.transform(window, grid_transform),
+            fill=0, all_touched=True, dtype=numpy.uint8).astype(bool)
+        LOGGER.info(
+            f'prepared {aoi_path} as a {window.height}x{window.width} window '
+            f'of {grid_raster_path} with {numpy.count_nonzero(mask)} pixels '
+            'in the AOI')
+        return cls(
+            geometry_list, (col_off, row_off, window.width, window.height),
+            mask, grid_shape, grid_transform,
+            crs.to_wkt() if crs is not None else '')
+
+    @classmethod
+    def load(cls, context_path):
+        """Load a context saved by ``save``."""
+        with numpy.load(context_path) as saved:
+            wkb_bytes = saved['geometry_wkb'].tobytes()
+            wkb_end_list = saved['geometry_wkb_end']
+            return cls(
+                [shapely.from_wkb(wkb_bytes[start:end]) for start, end in zip(
+                    [0, *wkb_end_list[:-1]], wkb_end_list)],
+                saved['window'], saved['mask'], saved['grid_shape'],
+                saved['grid_transform'], str(saved['crs_wkt']))
+
+    def save(self, context_path):
+        """Save the context to a ``.npz`` file at `context_path`."""
+        # write then rename so a concurrent reader never sees a partial file
+        temp_path = f'{context_path}.{os.getpid()}.npz'
+        wkb_list = [
+            shapely.to_wkb(geometry) for geometry in self.geometry_list]
+        numpy.savez(
+            temp_path,
+            # the geometries' WKB back to back and where each one ends
+            geometry_wkb=numpy.frombuffer(
+                b''.join(wkb_list), dtype=numpy.uint8),
+            geometry_wkb_end=numpy.cumsum([len(wkb) for wkb in wkb_list]),
+            window=numpy.array([
+                self.window.col_off, self.window.row_off, self.window.width,
+                self.window.height]),
+            mask=self.mask, grid_shape=numpy.array(self.grid_shape),
+            grid_transform=numpy.array(tuple(self.grid_transform)[:6]),
+            crs_wkt=numpy.array(self.crs_wkt))
+        os.replace(temp_path, context_path)
+
+    def check_grid(self, raster_path, shape, transform):
+        """Raise ValueError unless a raster is on this context's grid.
+
+        Args:
+            raster_path (str): path of the raster, for the message.
+            shape (tuple): rows and columns of the raster.
+            transform (affine.Affine): geotransform of the raster.
+
+        Returns:
+            None
+        """
+        if tuple(shape) != self.grid_shape or not Affine(
+                *tuple(transform)[:6]).almost_equals(self.grid_transform):
+            raise ValueError(
+                f'{raster_path} is on a {tuple(shape)} grid at {transform} '
+                f'but the AOI was prepared for a {self.grid_shape} grid at '
+                f'{self.grid_transform}')
+
+    def clip(self, raster_path, target_path, target_mask_value):
+        """Clip band 1 of a raster on the grid to the AOI.
+
+        Args:
+            raster_path (str): path to a raster on this context's grid.
+            target_path (str): path to the GeoTIFF of the window to create.
+            target_mask_value (float): value of the pixels outside the AOI
+                and of nodata pixels, it is the nodata of the target.
+
+        Returns:
+            None
+        """
+        with rasterio.open(raster_path) as raster:
+            self.check_grid(raster_path, raster.shape, raster.transform)
+            array = raster.read(1, window=self.window)
+            nodata = raster.nodata
+        self.write_clip(array, nodata, target_path, target_mask_value)
+
+    def write_clip(self, array, nodata, target_path, target_mask_value):
+        """Mask the window `array` of a raster on the grid and write it.
+
+        Args:
+            array (numpy.ndarray): the context's window of a raster on the
+                grid, it is masked in place.
+            nodata (float): nodata of `array`, None if it has none.
+            target_path (str): see ``clip``.
+            target_mask_value (float): see ``clip``.
+
+        Returns:
+            None
+        """
+        invalid_mask = ~self.mask
+        if nodata is not None:
+            invalid_mask |= array == nodata
+        array[invalid_mask] = target_mask_value
+        profile = {
+            'driver': 'GTiff',
+            'height': self.window.height,
+            'width': self.window.width,
+            'count': 1,
+            'dtype': array.dtype,
+            'nodata': target_mask_value,
+            'crs': self.crs_wkt or None,
+            'transform': rasterio.windows.transform(
+                self.window, self.grid_transform),
+            **netcdf_conversion.DEFAULT_CREATION_OPTIONS,
+        }
+        with rasterio.open(target_path, 'w', **profile) as target_raster:
+            target_raster.write(array, 1)
+
+
+def build_cached(aoi_path, grid_raster_path, cache_dir):
+    """``AoiContext.build`` unless the same AOI and grid are cached.
+
+    The cache key covers the AOI's path, size and modification time and
+    the grid's shape, transform and projection. A cached context file is
+    never rewritten, so tasks that take its path as an argument stay
+    up to date.
+
+    Args:
+        aoi_path (str): see ``AoiContext.build``.
+        grid_raster_path (str): see ``AoiContext.build``.
+        cache_dir (str): directory of the cached contexts.
+
+    Returns:
+        path to the saved context, see ``AoiContext.load``.
+    """
+    with rasterio.open(grid_raster_path) as raster:
+        grid_key = (
+            raster.shape, tuple(raster.transform)[:6],
+            raster.crs.to_string() if raster.crs else None)
+    aoi_stat = os.stat(aoi_path)
+    cache_key = hashlib.sha1(repr((
+        os.path.abspath(aoi_path), aoi_stat.st_size, aoi_stat.st_mtime,
+        grid_key)).encode('utf-8')).hexdigest()
+    context_path = os.path.join(cache_dir, f'aoi_context_{cache_key}.npz')
+    if not os.path.exists(context_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        AoiContext.build(aoi_path, grid_raster_path).save(context_path)
+    return context_path
+
+
+def fetch_and_clip(
+        context_path, dataset_id, dataset_args, target_path,
+        target_mask_value):
+    """Fetch a raster of a fetch_data dataset and clip it to a saved AOI.
+
+    Args:
+        context_path (str): path to a context saved on the dataset's grid,
+            see ``build_cached``.
+        dataset_id (str): fetch_data dataset, e.g. "era5_daily".
+        dataset_args (dict): args of the raster in the dataset.
+        target_path (str): path to the clipped GeoTIFF to create.
+        target_mask_value (float): see ``AoiContext.clip``.
+
+    Returns:
+        None
+    """
+    # recorded apart when profiled to tell downloads from clipping
+    with stage_profile.task_stage('fetch_file'):
+        raster_path = fetch_data.fetch_file(dataset_id, dataset_args)
+    with stage_profile.task_stage('clip'):
+        AoiContext.load(context_path).clip(
+            raster_path, target_path, target_mask_value)
@@ -2,23 +2,11 @@
 import argparse
 import glob
 
-from osgeo import gdal
-from ecoshard import geoprocessing
+import streaming_reducer
 
 ERA5_RESOLUTION_M = 27830
 
 
-def average(nodata, *array_list):
-    nodata_mask = array_list[0] != nodata
-    running_sum = array_list[0]
-    for index, array in enumerate(array_list[1:]):
-        running_sum[nodata_mask] += array[nodata_mask]
-        print(index, array)
-    print(len(array_list))
-    running_sum[nodata_mask] /= len(array_list)-1
-    return running_sum
-
-
 def main():
     parser = argparse.ArgumentParser(description=(
         'Average the rasters in the argument list.'))
@@ -26,15 +14,27 @@ def main():
         'raster_path_pattern', help='Path to rasters')
     parser.add_argument(
         '--target_path', help='Path to target raster.')
+    parser.add_argument(
+        '--stat', default='mean', choices=streaming_reducer.STAT_LIST,
+        help=(
+            'per pixel statistic to calculate, nodata pixels are skipped, '
+            '"std" is the population standard deviation and "count" the '
+            'number of valid rasters'))
+    parser.add_argument(
+        '--max_open', type=int, default=4,
+        help='maximum number of rasters to have open at once')
+    parser.add_argument(
+        '--chunk_mb', type=float, default=256, help=(
+            'approximate memory budget, larger rasters are reduced in row '
+            'strips that fit in it'))
     args = parser.parse_args()
 
-    array_path_band_list = [(path, 1) for path in glob.glob(
-        args.raster_path_pattern)]
-    nodata = geoprocessing.get_raster_info(
-        array_path_band_list[0][0])['nodata'][0]
-    geoprocessing.raster_calculator(
-        [(nodata, 'raw')]+array_path_band_list, average, args.target_path,
-        gdal.GDT_Float32, nodata)
+    raster_path_list = sorted(glob.glob(args.raster_path_pattern))
+    if not raster_path_list:
+        raise ValueError(f'no rasters matched {args.raster_path_pattern}')
+    streaming_reducer.reduce_rasters(
+        raster_path_list, {args.stat: args.target_path},
+        max_open=args.max_open, chunk_mb=args.chunk_mb)
 
 
 if __name__ == '__main__':
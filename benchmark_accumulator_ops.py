@@ -0,0 +1,102 @@
+"""See `python scriptname.py --help"""
+import argparse
+import time
+import tracemalloc
+
+import numpy
+
+import accumulator_ops
+
+MASK_NODATA = -9999
+
+
+def _legacy_sum_op(*array_list):
+    """Stacking sum as it was done before."""
+    valid_mask = array_list[0] != MASK_NODATA
+    result = numpy.sum(array_list, axis=0)
+    result[~valid_mask] = MASK_NODATA
+    return result
+
+
+def _legacy_mean_op(*array_list):
+    """Stacking mean as it was done before."""
+    valid_mask = array_list[0] != MASK_NODATA
+    result = numpy.sum(array_list, axis=0) / len(array_list)
+    result[~valid_mask] = MASK_NODATA
+    return result
+
+
+def _time_op(op, args, n_repeats):
+    """Return (seconds per call, peak traced MB of one call)."""
+    op(*args)  # warm up buffers
+    start_time = time.perf_counter()
+    for _ in range(n_repeats):
+        op(*args)
+    elapsed = (time.perf_counter() - start_time) / n_repeats
+    tracemalloc.start()
+    op(*args)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak_bytes / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Compare the stacking _sum_op/_mean_op monthly ops to the '
+        'accumulator_ops on a synthetic stack of daily float32 blocks.'))
+    parser.add_argument(
+        '--n_days', type=int, default=31, help='number of daily blocks')
+    parser.add_argument(
+        '--block_shape', type=int, nargs=2, default=[256, 256],
+        help='rows and columns of a raster_calculator block')
+    parser.add_argument(
+        '--n_repeats', type=int, default=20, help='calls to time per op')
+    args = parser.parse_args()
+
+    random_state = numpy.random.RandomState(1)
+    array_list = [
+        random_state.random_sample(args.block_shape).astype(numpy.float32)
+        for _ in range(args.n_days)]
+    for array in array_list:
+        array[:10, :10] = MASK_NODATA
+    block_mb = array_list[0].nbytes / 2**20
+    input_mb = block_mb * args.n_days
+
+    print(
+        f'{args.n_days} days of {args.block_shape[0]}x{args.block_shape[1]} '
+        f'blocks ({block_mb:.2f}MB each)')
+    for label, legacy_op, new_op in [
+            ('sum', _legacy_sum_op, accumulator_ops.sum_op),
+            ('mean', _legacy_mean_op, accumulator_ops.mean_op)]:
+        legacy_time, legacy_peak = _time_op(
+            legacy_op, array_list, args.n_repeats)
+        new_time, new_peak = _time_op(
+            new_op, [MASK_NODATA] + array_list, args.n_repeats)
+        for name, op_time, peak_mb in [
+                (f'stacking {label}', legacy_time, legacy_peak),
+                (f'accumulator {label}', new_time, new_peak)]:
+            print(
+                f'{name:>16}: {op_time*1e3:.2f}ms per block, '
+                f'{input_mb/op_time:.0f}MB/s, peak '
+                f'{peak_mb/block_mb:.1f}x block')
+        print(f'{label} speedup: {legacy_time/new_time:.2f}x')
+
+    # a NaN is summed again with a mask, but only in its row, as are
+    # pixels that are nodata on some days but not all
+    nan_array_list = [array.copy() for array in array_list]
+    nan_array_list[0][-1, -1] = numpy.nan
+    varying_array_list = [array.copy() for array in array_list]
+    for array in varying_array_list:
+        array[random_state.random_sample(array.shape) < 0.01] = MASK_NODATA
+    for name, case_array_list in [
+            ('sum with a NaN', nan_array_list),
+            ('varying nodata', varying_array_list)]:
+        case_time, _ = _time_op(
+            accumulator_ops.sum_op, [MASK_NODATA] + case_array_list,
+            args.n_repeats)
+        print(
+            f'{name:>16}: {case_time*1e3:.2f}ms per block, '
+            f'{input_mb/case_time:.0f}MB/s')
+
+if __name__ == '__main__':
+    main()
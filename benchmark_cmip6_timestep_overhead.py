@@ -0,0 +1,101 @@
+"""See `python scriptname.py --help"""
+import argparse
+import time
+
+from rasterio.transform import Affine
+import numpy
+import pandas
+import xarray
+
+import cmip6_download
+
+
+def _legacy_timestep(dataset, variable, time_index, date):
+    """Per-day date conversion and grid probing as it was done before."""
+    daily_data = dataset[variable].isel(time=time_index)
+    date_str = None
+    for conversion_fn in [
+            lambda d: d.item().strftime('%Y-%m-%d'),
+            lambda d: d.time.strftime('%Y-%m-%d'),
+            lambda d: pandas.to_datetime(d.values).strftime('%Y-%m-%d'),
+            lambda d: pandas.to_datetime(d.item(), unit='D'),
+            lambda d: pandas.to_datetime(d, unit='D'),
+            lambda d: d.strftime('%Y-%m-%d'),
+            ]:
+        try:
+            date_str = conversion_fn(date)
+            break
+        except Exception:
+            continue
+    data_values = daily_data.values[numpy.newaxis, ...]
+    coord_list = []
+    res_list = []
+    for coord_id, field_options in zip(['x', 'y'], [
+            ['longitude', 'long', 'lon'],
+            ['latitude', 'lat']]):
+        for field_id in field_options:
+            try:
+                coord_array = dataset.coords[field_id]
+                res_list.append(float(
+                    (coord_array[-1] - coord_array[0]) /
+                    len(coord_array)))
+                coord_list.append(coord_array)
+                break
+            except KeyError:
+                pass
+    transform = Affine.translation(
+        *[a[0] for a in coord_list]) * Affine.scale(*res_list)
+    return date_str, data_values, transform
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Micro-benchmark of the per-timestep overhead (date decoding, grid '
+        'detection and slicing, no writing) when converting a synthetic '
+        'CMIP6 daily file to geotiffs.'))
+    parser.add_argument(
+        '--n_days', type=int, default=365, help='number of time steps')
+    parser.add_argument(
+        '--grid_shape', type=int, nargs=2, default=[192, 288],
+        help='rows and columns of the synthetic grid')
+    parser.add_argument(
+        '--calendar', default='noleap',
+        help='CF calendar of the time axis, e.g. standard, noleap, 360_day')
+    args = parser.parse_args()
+
+    n_rows, n_cols = args.grid_shape
+    time_index = xarray.date_range(
+        '2000-01-01', periods=args.n_days, calendar=args.calendar,
+        use_cftime=args.calendar != 'standard')
+    dataset = xarray.Dataset(
+        {'pr': (('time', 'lat', 'lon'), numpy.random.random(
+            (args.n_days, n_rows, n_cols)).astype(numpy.float32))},
+        coords={
+            'time': time_index,
+            'lat': numpy.linspace(-90, 90, n_rows),
+            'lon': numpy.linspace(0, 360, n_cols, endpoint=False)})
+
+    start_time = time.perf_counter()
+    for i, date in enumerate(dataset['time']):
+        _legacy_timestep(dataset, 'pr', i, date)
+    legacy_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    date_str_array, _ = cmip6_download.decode_time_coordinate(
+        dataset['time'])
+    geometry = cmip6_download.grid_geometry(dataset, 'pr', 'synthetic')
+    for i in range(len(date_str_array)):
+        cmip6_download._raster_block(dataset, 'pr', [i], geometry)
+    vectorized_time = time.perf_counter() - start_time
+
+    for label, total_time in [
+            ('per-day conversion', legacy_time),
+            ('vectorized decode', vectorized_time)]:
+        print(
+            f'{label:>20}: {total_time:.3f}s total, '
+            f'{total_time/args.n_days*1e6:.1f}us per timestep')
+    print(f'speedup: {legacy_time/vectorized_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
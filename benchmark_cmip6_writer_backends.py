@@ -0,0 +1,77 @@
+"""See `python scriptname.py --help"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+import pandas
+import xarray
+
+import cmip6_download
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Benchmark the pickle, shared_memory and thread writer backends of '
+        'cmip6_download on a synthetic 0.25 degree global daily file.'))
+    parser.add_argument(
+        '--n_days', type=int, default=31, help='number of days to write')
+    parser.add_argument(
+        '--n_workers', type=int, default=5, help='number of writers')
+    parser.add_argument(
+        '--workspace_dir', help=(
+            'directory to write the synthetic data and geotiffs to, '
+            'defaults to a temporary directory that is removed after'))
+    args = parser.parse_args()
+
+    workspace_dir = args.workspace_dir
+    if workspace_dir is None:
+        workspace_dir = tempfile.mkdtemp(prefix='writer_backend_benchmark_')
+    os.makedirs(workspace_dir, exist_ok=True)
+
+    n_rows, n_cols = 720, 1440
+    netcdf_path = os.path.join(workspace_dir, 'synthetic_pr.nc')
+    xarray.Dataset(
+        {'pr': (('time', 'lat', 'lon'), numpy.random.random(
+            (args.n_days, n_rows, n_cols)).astype(numpy.float32))},
+        coords={
+            'time': pandas.date_range('2000-01-01', periods=args.n_days),
+            'lat': numpy.linspace(-89.875, 89.875, n_rows),
+            'lon': numpy.linspace(0.125, 359.875, n_cols)}).to_netcdf(
+        netcdf_path)
+    target_vars = {
+        'variable': 'pr',
+        'scenario': 'synthetic',
+        'model': 'synthetic',
+        'variant': 'synthetic',
+    }
+    uncompressed_mb = args.n_days * n_rows * n_cols * 4 / 2**20
+
+    try:
+        for writer_backend, executor_type in [
+                ('pickle', ProcessPoolExecutor),
+                ('shared_memory', ProcessPoolExecutor),
+                ('thread', ThreadPoolExecutor)]:
+            target_path_pattern = os.path.join(
+                workspace_dir, writer_backend, '{variable}_{date}.tif')
+            start_time = time.perf_counter()
+            with executor_type(args.n_workers) as executor:
+                cmip6_download.process_cmip6_netcdf_to_geotiff(
+                    executor, netcdf_path, target_vars, target_path_pattern,
+                    writer_backend)
+            elapsed = time.perf_counter() - start_time
+            print(
+                f'{writer_backend:>13}: {elapsed:.2f}s for {args.n_days} '
+                f'days ({uncompressed_mb/elapsed:.1f}MB/s uncompressed)')
+            shutil.rmtree(os.path.join(workspace_dir, writer_backend))
+    finally:
+        if args.workspace_dir is None:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
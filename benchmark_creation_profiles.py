@@ -0,0 +1,100 @@
+"""See `python scriptname.py --help"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from rasterio.transform import Affine
+import numpy
+import rasterio
+
+import netcdf_conversion
+
+
+def _synthetic_day(day_index, n_rows, n_cols, random_state):
+    """Make a smooth temperature field and a mostly dry precip field."""
+    lat = numpy.linspace(90, -90, n_rows)[:, numpy.newaxis]
+    lon = numpy.linspace(-180, 180, n_cols, endpoint=False)[numpy.newaxis, :]
+    temperature = (
+        288 - 40*numpy.abs(numpy.sin(numpy.radians(lat))) +
+        5*numpy.sin(numpy.radians(lon*3 + day_index*10)) +
+        random_state.normal(0, 0.5, (n_rows, n_cols)))
+    precip = random_state.gamma(0.3, 2e-3, (n_rows, n_cols))
+    precip[precip < 1e-3] = 0
+    return [
+        ('temperature', temperature.astype(numpy.float32)),
+        ('precipitation', precip.astype(numpy.float32))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Write and read back a synthetic ERA5 sized (721x1440) daily stack '
+        'under each geotiff creation profile and report throughput and '
+        'size on disk.'))
+    parser.add_argument(
+        '--n_days', type=int, default=31, help='number of days to write')
+    parser.add_argument(
+        '--profiles', nargs='+',
+        default=list(netcdf_conversion.CREATION_PROFILES),
+        choices=list(netcdf_conversion.CREATION_PROFILES),
+        help='creation profiles to benchmark')
+    parser.add_argument(
+        '--workspace_dir', help=(
+            'directory to write the geotiffs to, defaults to a temporary '
+            'directory that is removed after'))
+    args = parser.parse_args()
+
+    workspace_dir = args.workspace_dir
+    if workspace_dir is None:
+        workspace_dir = tempfile.mkdtemp(prefix='creation_profile_benchmark_')
+    os.makedirs(workspace_dir, exist_ok=True)
+
+    n_rows, n_cols = 721, 1440
+    transform = Affine.translation(-180, 90) * Affine.scale(0.25, -0.25)
+    random_state = numpy.random.RandomState(1)
+    day_list = [
+        _synthetic_day(day_index, n_rows, n_cols, random_state)
+        for day_index in range(args.n_days)]
+    uncompressed_mb = sum(
+        array.nbytes for day in day_list for _, array in day) / 2**20
+
+    print(
+        f'{"profile":>8} {"write MB/s":>11} {"read MB/s":>10} '
+        f'{"disk MB":>8} {"ratio":>6}')
+    try:
+        for profile in args.profiles:
+            creation_options = netcdf_conversion.resolve_creation_options(
+                profile)
+            profile_dir = os.path.join(workspace_dir, profile)
+            path_list = []
+            start_time = time.perf_counter()
+            for day_index, day in enumerate(day_list):
+                for variable_id, array in day:
+                    target_path = os.path.join(
+                        profile_dir, f'{variable_id}_{day_index}.tif')
+                    netcdf_conversion.write_geotiff(
+                        target_path, array, transform,
+                        creation_options=creation_options)
+                    path_list.append(target_path)
+            write_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            for path in path_list:
+                with rasterio.open(path) as raster:
+                    raster.read()
+            read_time = time.perf_counter() - start_time
+
+            disk_mb = sum(os.path.getsize(path) for path in path_list) / 2**20
+            print(
+                f'{profile:>8} {uncompressed_mb/write_time:>11.1f} '
+                f'{uncompressed_mb/read_time:>10.1f} {disk_mb:>8.1f} '
+                f'{uncompressed_mb/disk_mb:>6.2f}')
+            shutil.rmtree(profile_dir)
+    finally:
+        if args.workspace_dir is None:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""See `python scriptname.py --help"""
+import argparse
+import time
+
+import numpy
+
+import storm_event_detection
+
+MASK_NODATA = -9999
+
+
+def _legacy_process_month_op(rain_event_threshold, *precip_array):
+    """Pairwise 48hr average op as it was done before."""
+    result = numpy.zeros(precip_array[0].shape, dtype=int)
+    valid_mask = numpy.zeros(result.shape, dtype=bool)
+    for precip_a, precip_b in zip(precip_array[:-1], precip_array[1:]):
+        local_mask = (precip_a+precip_b)/2 >= rain_event_threshold
+        result += local_mask
+        valid_mask |= local_mask
+    result[~valid_mask] = MASK_NODATA
+    return result
+
+
+def _time_op(op, args, n_repeats):
+    """Return seconds per call of ``op(*args)``."""
+    op(*args)  # warm up
+    start_time = time.perf_counter()
+    for _ in range(n_repeats):
+        op(*args)
+    return (time.perf_counter() - start_time) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Compare the pairwise 48hr storm event op to '
+        'storm_event_detection.count_storm_events on a synthetic month of '
+        'daily float32 precip blocks.'))
+    parser.add_argument(
+        '--n_days', type=int, default=32,
+        help='number of daily blocks, a month and its one day halo')
+    parser.add_argument(
+        '--block_shape', type=int, nargs=2, default=[256, 256],
+        help='rows and columns of a raster_calculator block')
+    parser.add_argument(
+        '--rain_event_threshold', type=float, default=10,
+        help='average daily precip of an event window')
+    parser.add_argument(
+        '--window_days', type=int, nargs='+', default=[2, 3, 7],
+        help='window lengths to time count_storm_events with')
+    parser.add_argument(
+        '--n_repeats', type=int, default=20, help='calls to time per op')
+    args = parser.parse_args()
+
+    random_state = numpy.random.RandomState(1)
+    precip_array_list = [
+        random_state.gamma(0.5, 8, args.block_shape).astype(numpy.float32)
+        for _ in range(args.n_days)]
+    for precip_array in precip_array_list:
+        precip_array[:10, :10] = MASK_NODATA
+
+    legacy_result = _legacy_process_month_op(
+        args.rain_event_threshold, *precip_array_list)
+    new_result = storm_event_detection.count_storm_events(
+        precip_array_list, MASK_NODATA, args.rain_event_threshold, 2)
+    if not numpy.array_equal(legacy_result, new_result):
+        raise RuntimeError('2 day event counts differ from the pairwise op')
+
+    print(
+        f'{args.n_days} days of {args.block_shape[0]}x{args.block_shape[1]} '
+        f'blocks')
+    legacy_time = _time_op(
+        _legacy_process_month_op,
+        [args.rain_event_threshold] + precip_array_list, args.n_repeats)
+    print(f'{"pairwise 2 day":>20}: {legacy_time*1e3:.2f}ms per block')
+    for window_days in args.window_days:
+        new_time = _time_op(
+            storm_event_detection.count_storm_events,
+            [precip_array_list, MASK_NODATA, args.rain_event_threshold,
+             window_days], args.n_repeats)
+        print(
+            f'{f"window {window_days} day":>20}: {new_time*1e3:.2f}ms per '
+            f'block, {legacy_time/new_time:.2f}x the pairwise op')
+
+
+if __name__ == '__main__':
+    main()
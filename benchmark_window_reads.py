@@ -0,0 +1,184 @@
+"""See `python scriptname.py --help"""
+import argparse
+import functools
+import http.server
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.request
+
+from rasterio.transform import Affine
+import geopandas
+import numpy
+import rasterio
+import shapely
+
+import aoi_context
+import netcdf_conversion
+import window_read
+
+MASK_NODATA = -9999
+
+
+class _RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves a directory with single byte range GETs, counting the bytes.
+
+    A stand-in for an object store, the server's ``bytes_sent`` is what a
+    client downloaded.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        file_size = os.path.getsize(path)
+        start, end = 0, file_size - 1
+        match = re.fullmatch(
+            r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(end, int(match.group(2)))
+            self.send_response(206)
+            self.send_header(
+                'Content-Range', f'bytes {start}-{end}/{file_size}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with open(path, 'rb') as source_file:
+            source_file.seek(start)
+            data = source_file.read(end - start + 1)
+        self.wfile.write(data)
+        with self.server.lock:
+            self.server.bytes_sent += len(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Clip synthetic ERA5 sized (721x1440) days served by a local HTTP '
+        'range server to a small square AOI, once by downloading each day '
+        'whole and once by reading only the AOI window, and report the '
+        'bytes transferred and time of each.'))
+    parser.add_argument(
+        '--n_days', type=int, default=31, help='number of days to clip')
+    parser.add_argument(
+        '--aoi_size_deg', type=float, default=0.1, help=(
+            'side of the square AOI in degrees, 0.1 is about 100 km2 at '
+            'the equator'))
+    parser.add_argument(
+        '--creation_profile', default='cog',
+        choices=list(netcdf_conversion.CREATION_PROFILES),
+        help='creation profile of the served days')
+    parser.add_argument(
+        '--workspace_dir', help=(
+            'directory to write the days and clips to, defaults to a '
+            'temporary directory that is removed after'))
+    args = parser.parse_args()
+
+    workspace_dir = args.workspace_dir
+    if workspace_dir is None:
+        workspace_dir = tempfile.mkdtemp(prefix='window_read_benchmark_')
+    os.makedirs(workspace_dir, exist_ok=True)
+    serve_dir = os.path.join(workspace_dir, 'served')
+    clip_dir = os.path.join(workspace_dir, 'clip')
+    os.makedirs(clip_dir, exist_ok=True)
+
+    n_rows, n_cols = 721, 1440
+    transform = (
+        Affine.translation(-180.125, 90.125) * Affine.scale(0.25, -0.25))
+    creation_options = netcdf_conversion.resolve_creation_options(
+        args.creation_profile)
+    random_state = numpy.random.RandomState(1)
+    key_list = []
+    for day_index in range(args.n_days):
+        key = f'precip_{day_index:03d}.tif'
+        netcdf_conversion.write_geotiff(
+            os.path.join(serve_dir, key),
+            random_state.gamma(0.3, 2, (n_rows, n_cols)).astype(
+                numpy.float32),
+            transform, nodata=MASK_NODATA, creation_options=creation_options)
+        key_list.append(key)
+
+    half_size = args.aoi_size_deg / 2
+    aoi_path = os.path.join(workspace_dir, 'aoi.gpkg')
+    geopandas.GeoDataFrame(geometry=[shapely.box(
+        36.8-half_size, -1.3-half_size, 36.8+half_size, -1.3+half_size)],
+        crs='EPSG:4326').to_file(aoi_path)
+
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(
+            _RangeRequestHandler, directory=serve_dir))
+    server.bytes_sent = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    root_url = f'http://127.0.0.1:{server.server_port}'
+
+    try:
+        context_path = aoi_context.build_cached(
+            aoi_path, os.path.join(serve_dir, key_list[0]),
+            os.path.join(workspace_dir, 'aoi_context'))
+        file_mb = sum(
+            os.path.getsize(os.path.join(serve_dir, key))
+            for key in key_list) / 2**20
+
+        server.bytes_sent = 0
+        start_time = time.perf_counter()
+        context = aoi_context.AoiContext.load(context_path)
+        for key in key_list:
+            download_path = os.path.join(workspace_dir, 'download.tif')
+            urllib.request.urlretrieve(f'{root_url}/{key}', download_path)
+            context.clip(
+                download_path, os.path.join(clip_dir, f'full_{key}'),
+                MASK_NODATA)
+        full_time = time.perf_counter() - start_time
+        full_mb = server.bytes_sent / 2**20
+
+        server.bytes_sent = 0
+        start_time = time.perf_counter()
+        transfer_list = [
+            window_read.clip_window(
+                context_path, window_read.gdal_path(root_url, key),
+                os.path.join(clip_dir, f'window_{key}'), MASK_NODATA)
+            for key in key_list]
+        window_time = time.perf_counter() - start_time
+        window_mb = server.bytes_sent / 2**20
+
+        for key in key_list:
+            with rasterio.open(os.path.join(clip_dir, f'full_{key}')) as a, \
+                    rasterio.open(
+                        os.path.join(clip_dir, f'window_{key}')) as b:
+                if not numpy.array_equal(a.read(), b.read()):
+                    raise RuntimeError(f'clips of {key} differ')
+
+        print(
+            f'{args.n_days} days, {file_mb:.2f}MB served, '
+            f'{args.creation_profile} profile, '
+            f'{args.aoi_size_deg} degree AOI')
+        print(f'{"path":>7} {"MB sent":>8} {"% of full":>9} {"seconds":>8}')
+        for label, sent_mb, elapsed in [
+                ('full', full_mb, full_time),
+                ('window', window_mb, window_time)]:
+            print(
+                f'{label:>7} {sent_mb:>8.3f} {100*sent_mb/full_mb:>9.2f} '
+                f'{elapsed:>8.2f}')
+        print(f'gdal: {window_read.transfer_summary(transfer_list)}')
+    finally:
+        server.shutdown()
+        if args.workspace_dir is None:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,12 +14,14 @@ import requests
 from ecoshard import geoprocessing
 from osgeo import gdal
 import matplotlib.pyplot as plt
-import numpy
 import ee
 import geemap
 import geopandas
+import numpy
 import pandas
 
+import raster_expr
+
 logging.basicConfig(
     level=logging.WARNING,
     format=(
@@ -38,6 +40,17 @@ BAND_NAMES = ['tasmin', 'tasmax', 'pr']
 MODEL_LIST = ['ACCESS1-0', 'bcc-csm1-1', 'BNU-ESM', 'CanESM2', 'CCSM4', 'CESM1-BGC', 'CNRM-CM5', 'CSIRO-Mk3-6-0', 'GFDL-CM3', 'GFDL-ESM2G', 'GFDL-ESM2M', 'inmcm4', 'IPSL-CM5A-LR', 'IPSL-CM5A-MR', 'MIROC-ESM', 'MIROC-ESM-CHEM', 'MIROC5', 'MPI-ESM-LR', 'MPI-ESM-MR', 'MRI-CGCM3', 'NorESM1-M']
 MODELS_BY_DATE_CACHEFILE = '_cimp5_models_by_date.dat'
 QUOTA_READS_PER_MINUTE = 3000
+# names of the basins of the original study, used for HYBAS_ID values when
+# no --watershed_name_field is given
+WATERSHED_NAME_BY_HYBAS_ID = {
+    4030050220: 'Amu Darya',
+    2030065840: 'Atrek',
+    4030050230: 'Balkhash-Alakol',
+    3030001840: 'Ob',
+    4030050240: 'Syr Darya',
+    4030050210: 'Tarim',
+    2030066850: 'Ural-Emba',
+    }
 
 
 def _throttle_query():
@@ -133,6 +146,14 @@ def main():
     parser.add_argument(
         '--authenticate', action='store_true',
         help='Pass this flag if you need to reauthenticate with GEE')
+    parser.add_argument(
+        '--watershed_field', default='HYBAS_ID', help=(
+            'field of the aoi to group the precip change by, features with '
+            'the same value are one group'))
+    parser.add_argument(
+        '--watershed_name_field', help=(
+            'field of the aoi to label the groups with in the tables and '
+            'plot, defaults to the --watershed_field value'))
     args = parser.parse_args()
     aoi_vector = geopandas.read_file(args.aoi_vector_path)
 
@@ -195,7 +216,8 @@ def main():
 
     calc_historical_precip(
         time_range_list, models_by_date, cmip5_dataset, vector_basename,
-        local_shapefile_path, ee_poly)
+        local_shapefile_path, ee_poly, watershed_field=args.watershed_field,
+        watershed_name_field=args.watershed_name_field)
     # os.remove(local_shapefile_path)
     LOGGER.info('done!')
 
@@ -258,7 +280,6 @@ def calc_historical_temp(
     nodata_target = -9999
     for model_id in model_list:
         historic_temp_path = temp_model_by_time_range[model_id][time_range_list[0]]
-        nodata = geoprocessing.get_raster_info(historic_temp_path)['nodata'][0]
         for future_time_range in time_range_list[1:]:
             _, _, scenario_id = future_time_range
             target_raster_path = os.path.join(
@@ -266,16 +287,10 @@ def calc_historical_temp(
             future_temp_path = temp_model_by_time_range[
                 model_id][future_time_range]
 
-            def _sub_op(raster_a, raster_b):
-                valid_mask = (raster_a != nodata) & (raster_b != nodata)
-                result = numpy.empty(raster_a.shape, dtype=numpy.float32)
-                result[:] = nodata
-                result[valid_mask] = raster_a[valid_mask]-raster_b[valid_mask]
-                return result
-
-            geoprocessing.raster_calculator(
-                [(future_temp_path, 1), (historic_temp_path, 1)], _sub_op,
-                target_raster_path, gdal.GDT_Float32, nodata_target)
+            raster_expr.evaluate_expression(
+                'future - historic',
+                {'future': future_temp_path, 'historic': historic_temp_path},
+                target_raster_path, target_nodata=nodata_target)
             change_in_temp_list_by_scenario[scenario_id].append(
                 target_raster_path)
 
@@ -284,23 +299,17 @@ def calc_historical_temp(
     for future_time_range in time_range_list[1:]:
         _, _, scenario_id = future_time_range
 
-        def _mean_op(*raster_list):
-            valid_mask = numpy.ones(raster_list[0].shape, dtype=bool)
-            for raster in raster_list:
-                valid_mask &= raster != nodata_target
-            result = numpy.zeros(raster_list[0].shape, dtype=numpy.float32)
-            for raster in raster_list:
-                result[valid_mask] += raster[valid_mask]
-            result[valid_mask] /= len(raster_list)
-            result[~valid_mask] = nodata_target
-            return result
-
+        # mean across models, nodata wherever any model is nodata
+        change_path_by_name = {
+            f'model_{index}': path for index, path in enumerate(
+                change_in_temp_list_by_scenario[scenario_id])}
         historic_mean_temp_difference_path = os.path.join(
             workspace_dir, f'historic_mean_temp_difference_{scenario_id}_BASE.tif')
-        geoprocessing.raster_calculator(
-            [(path, 1) for path in change_in_temp_list_by_scenario[
-             scenario_id]], _mean_op, historic_mean_temp_difference_path,
-            gdal.GDT_Float32, nodata_target)
+        raster_expr.evaluate_expression(
+            f'({" + ".join(change_path_by_name)}) / '
+            f'{len(change_path_by_name)}',
+            change_path_by_name, historic_mean_temp_difference_path,
+            target_nodata=nodata_target)
 
         raster_info = geoprocessing.get_raster_info(
             historic_mean_temp_difference_path)
@@ -320,9 +329,59 @@ def calc_historical_temp(
             f'{band_min} / {band_max}')
 
 
+def watershed_label_raster(
+        vector_path, base_raster_path, watershed_field, watershed_name_field,
+        target_label_raster_path):
+    """Rasterize the watershed groups of `vector_path` as labels 0..n-1.
+
+    Grouping values of any type are factorized into an integer field of a
+    local copy of the vector so ``geoprocessing.rasterize`` can burn them.
+
+    Args:
+        vector_path (str): path to the watershed vector.
+        base_raster_path (str): raster whose grid the labels are on.
+        watershed_field (str): features with the same value of this field
+            are one group.
+        watershed_name_field (str): field to name the groups with, if None
+            groups are named by their `watershed_field` value, or by
+            ``WATERSHED_NAME_BY_HYBAS_ID`` for known HYBAS_IDs.
+        target_label_raster_path (str): path to the int32 label raster to
+            create, pixels outside every watershed are -1.
+
+    Returns:
+        list of group names indexed by label.
+    """
+    vector = geopandas.read_file(vector_path)
+    label_array, group_values = pandas.factorize(vector[watershed_field])
+    if watershed_name_field is not None:
+        name_by_value = dict(
+            zip(vector[watershed_field], vector[watershed_name_field]))
+        name_list = [name_by_value[value] for value in group_values]
+    else:
+        name_list = [
+            WATERSHED_NAME_BY_HYBAS_ID.get(value, str(value))
+            if watershed_field == 'HYBAS_ID' else str(value)
+            for value in group_values]
+
+    label_vector_path = (
+        f'{os.path.splitext(target_label_raster_path)[0]}.json')
+    vector['_watershed_label'] = label_array.astype(numpy.int32)
+    vector[['_watershed_label', 'geometry']].to_file(
+        label_vector_path, driver='GeoJSON')
+    geoprocessing.new_raster_from_base(
+        base_raster_path, target_label_raster_path, gdal.GDT_Int32, [-1],
+        fill_value_list=[-1])
+    geoprocessing.rasterize(
+        label_vector_path, target_label_raster_path,
+        option_list=['ATTRIBUTE=_watershed_label'])
+    os.remove(label_vector_path)
+    return name_list
+
+
 def calc_historical_precip(
         time_range_list, models_by_date, cmip5_dataset, vector_basename,
-        vector_path, ee_poly):
+        vector_path, ee_poly, watershed_field='HYBAS_ID',
+        watershed_name_field=None):
     # calcualte historical precip
     historic_time_range = time_range_list[0]
     historic_start_year, historic_end_year, historic_scenario_id = (
@@ -386,25 +445,18 @@ def calc_historical_precip(
                 future_precip_by_model_scenario_and_year[
                     model_id][scenario_id][year] = raster_path
 
-    # rasterize watersheds onto a raster
+    # rasterize watersheds onto a raster once, every percent change raster
+    # is then reduced per watershed with one bincount
     vector_mask_raster_path = os.path.join(
-        workspace_dir, f'{vector_basename}.tif')
-    geoprocessing.new_raster_from_base(
-        raster_path, vector_mask_raster_path, gdal.GDT_Float64, [-1])
-    geoprocessing.rasterize(
-        vector_path, vector_mask_raster_path,
-        option_list=["ATTRIBUTE=HYBAS_ID"])
+        workspace_dir, f'{vector_basename}_{watershed_field}.tif')
+    watershed_name_list = watershed_label_raster(
+        vector_path, raster_path, watershed_field, watershed_name_field,
+        vector_mask_raster_path)
     mask_array = gdal.OpenEx(vector_mask_raster_path).ReadAsArray()
-
-    watershed_id_to_name = {
-        4030050220: 'Amu Darya',
-        2030065840: 'Atrek',
-        4030050230: 'Balkhash-Alakol',
-        3030001840: 'Ob',
-        4030050240: 'Syr Darya',
-        4030050210: 'Tarim',
-        2030066850: 'Ural-Emba',
-        }
+    watershed_mask = mask_array != -1
+    watershed_label = mask_array[watershed_mask]
+    watershed_pixel_count = numpy.bincount(
+        watershed_label, minlength=len(watershed_name_list))
 
     # loop through historic precip
     data_by_scenario = {}
@@ -421,10 +473,13 @@ def calc_historical_precip(
                         model_id][scenario_id][year],
                     gdal.OF_RASTER).ReadAsArray()
                 percent_change = (future_array/historic_array-1)*100
-                percent_change[mask_array == -1] = -1
+                percent_change[~watershed_mask] = -1
                 # at a particular scenario and year, break out by watershed
+                watershed_sum = numpy.bincount(
+                    watershed_label, weights=percent_change[watershed_mask],
+                    minlength=len(watershed_name_list))
                 values_by_scenario_then_watershed[scenario_id]['all'].append(
-                    percent_change[mask_array != -1].mean())
+                    watershed_sum.sum() / watershed_pixel_count.sum())
                 geoprocessing.numpy_array_to_raster(
                     percent_change, -1, raster_info['pixel_size'],
                     [raster_info['geotransform'][i] for i in (0, 3)],
@@ -432,9 +487,12 @@ def calc_historical_precip(
                     os.path.join(
                         workspace_dir,
                         f'percent_change_{model_id}_{year}_{scenario_id}.tif'))
-                for watershed_id, watershed_name in watershed_id_to_name.items():
-                    values_by_scenario_then_watershed[scenario_id][watershed_name].append(
-                        percent_change[mask_array == watershed_id].mean())
+                with numpy.errstate(invalid='ignore', divide='ignore'):
+                    watershed_mean = watershed_sum / watershed_pixel_count
+                for watershed_name, mean_change in zip(
+                        watershed_name_list, watershed_mean):
+                    values_by_scenario_then_watershed[scenario_id][
+                        watershed_name].append(mean_change)
 
     fig, axes = plt.subplots(nrows=2, ncols=1, figsize=(14, 10))
     for index, (scenario_id, value_dict) in enumerate(
@@ -0,0 +1,178 @@
+"""Per-pixel monthly climatologies that are updated as new months arrive.
+
+Not a command line script. The climatology of a calendar month is one
+float64 raster with "mean", "std" and "count" bands. The year-months it
+already includes are listed in its tags, so updating it only reads months
+that are new and a month is never counted twice. Updates use Welford's
+algorithm from ``streaming_reducer.BlockAccumulator`` one row strip at a
+time.
+"""
+import os
+
+from rasterio.windows import Window
+import numpy
+import rasterio
+
+import netcdf_conversion
+import streaming_reducer
+
+STATE_BAND_LIST = ['mean', 'std', 'count']
+# tag of the state raster that lists the year-months it includes
+MONTHS_TAG = 'CLIMATOLOGY_MONTHS'
+DEFAULT_NODATA = -9999
+
+
+def climatology_path(climatology_dir, prefix, month_id):
+    """Path to the climatology of calendar month `month_id` (e.g. "01")."""
+    return os.path.join(
+        climatology_dir, f'{prefix}_climatology_{month_id}.tif')
+
+
+def included_months(climatology_raster_path):
+    """Return the year-months already in a climatology, [] if it is new."""
+    if not os.path.exists(climatology_raster_path):
+        return []
+    with rasterio.open(climatology_raster_path) as climatology_raster:
+        month_str = climatology_raster.tags().get(MONTHS_TAG, '')
+    return [month_key for month_key in month_str.split(',') if month_key]
+
+
+def update_climatology(
+        climatology_raster_path, raster_path_by_month, chunk_mb=64):
+    """Fold monthly rasters into the climatology of their calendar month.
+
+    Months the climatology already includes are skipped without being
+    read, so the cost depends only on the new months. The updated state is
+    written next to the old one and swapped in when complete.
+
+    Args:
+        climatology_raster_path (str): path to the climatology raster, it is
+            created if it doesn't exist.
+        raster_path_by_month (dict): maps year-month keys such as
+            "1990-01" to single band rasters of that month, all on the grid
+            of the climatology.
+        chunk_mb (float): approximate memory budget of a row strip.
+
+    Returns:
+        sorted list of the year-months the climatology includes.
+    """
+    month_list = included_months(climatology_raster_path)
+    new_raster_path_by_month = {
+        month_key: raster_path
+        for month_key, raster_path in sorted(raster_path_by_month.items())
+        if month_key not in month_list}
+    if not new_raster_path_by_month:
+        return sorted(month_list)
+
+    new_raster_path_list = list(new_raster_path_by_month.values())
+    with rasterio.open(new_raster_path_list[0]) as base_raster:
+        n_rows, n_cols = base_raster.shape
+        profile = {
+            'driver': 'GTiff',
+            'height': n_rows,
+            'width': n_cols,
+            'count': len(STATE_BAND_LIST),
+            'dtype': 'float64',
+            'nodata': DEFAULT_NODATA,
+            'crs': base_raster.crs,
+            'transform': base_raster.transform,
+            **netcdf_conversion.DEFAULT_CREATION_OPTIONS,
+        }
+    state_exists = os.path.exists(climatology_raster_path)
+    if state_exists:
+        with rasterio.open(climatology_raster_path) as climatology_raster:
+            if climatology_raster.shape != (n_rows, n_cols):
+                raise ValueError(
+                    f'{new_raster_path_list[0]} is {(n_rows, n_cols)} but '
+                    f'the climatology {climatology_raster_path} is '
+                    f'{climatology_raster.shape}')
+
+    target_dir = os.path.dirname(climatology_raster_path)
+    if target_dir:
+        os.makedirs(target_dir, exist_ok=True)
+    temp_path = f'{climatology_raster_path}.{os.getpid()}.tmp.tif'
+    # count, mean and m2 accumulators, the state strip and temporaries
+    bytes_per_pixel = 8 * 10
+    rows_per_strip = max(
+        1, int(chunk_mb * 2**20 // (bytes_per_pixel * n_cols)))
+    with rasterio.open(temp_path, 'w', **profile) as target_raster:
+        for band_index, band_name in enumerate(STATE_BAND_LIST, start=1):
+            target_raster.set_band_description(band_index, band_name)
+        for row_off in range(0, n_rows, rows_per_strip):
+            window = Window(
+                0, row_off, n_cols, min(rows_per_strip, n_rows-row_off))
+            accumulator = streaming_reducer.BlockAccumulator(
+                (window.height, window.width), ['mean', 'std'])
+            if state_exists:
+                with rasterio.open(climatology_raster_path) as state_raster:
+                    mean, std, count = state_raster.read(window=window)
+                count = count.astype(numpy.int64)
+                accumulator.load_moments(
+                    count, numpy.where(count > 0, mean, 0),
+                    numpy.where(count > 0, std**2 * count, 0))
+            for array, nodata in streaming_reducer.read_windows(
+                    new_raster_path_list, window, 4, (n_rows, n_cols)):
+                accumulator.add(
+                    array, streaming_reducer.valid_pixel_mask(array, nodata))
+            target_raster.write(numpy.stack([
+                accumulator.result('mean', DEFAULT_NODATA),
+                accumulator.result('std', DEFAULT_NODATA),
+                accumulator.result('count', DEFAULT_NODATA)]), window=window)
+        month_list = sorted(month_list + list(new_raster_path_by_month))
+        target_raster.update_tags(**{MONTHS_TAG: ','.join(month_list)})
+    os.replace(temp_path, climatology_raster_path)
+    return month_list
+
+
+def standardized_anomaly(
+        climatology_raster_path, raster_path, target_path, min_count=2,
+        target_nodata=DEFAULT_NODATA):
+    """Write ``(month - mean) / std`` of a month against its climatology.
+
+    Pixels are nodata where the month is nodata, or where the climatology
+    has fewer than `min_count` months or no spread.
+
+    Args:
+        climatology_raster_path (str): climatology of the month's calendar
+            month, see ``update_climatology``.
+        raster_path (str): single band raster of the month, on the grid of
+            the climatology.
+        target_path (str): path to the float32 anomaly raster to create.
+        min_count (int): minimum months in the climatology of a pixel.
+        target_nodata (float): nodata of the target.
+
+    Returns:
+        None
+    """
+    with rasterio.open(raster_path) as month_raster, \
+            rasterio.open(climatology_raster_path) as climatology_raster:
+        if month_raster.shape != climatology_raster.shape:
+            raise ValueError(
+                f'{raster_path} is {month_raster.shape} but the climatology '
+                f'{climatology_raster_path} is {climatology_raster.shape}')
+        profile = {
+            'driver': 'GTiff',
+            'height': month_raster.height,
+            'width': month_raster.width,
+            'count': 1,
+            'dtype': 'float32',
+            'nodata': target_nodata,
+            'crs': month_raster.crs,
+            'transform': month_raster.transform,
+            **netcdf_conversion.DEFAULT_CREATION_OPTIONS,
+        }
+        with rasterio.open(target_path, 'w', **profile) as target_raster:
+            for _, window in month_raster.block_windows(1):
+                array = month_raster.read(1, window=window).astype(
+                    numpy.float64)
+                mean, std, count = climatology_raster.read(window=window)
+                valid_mask = (
+                    streaming_reducer.valid_pixel_mask(
+                        array, month_raster.nodata) &
+                    (count >= min_count) & (std > 0))
+                anomaly = numpy.full(
+                    array.shape, target_nodata, dtype=numpy.float64)
+                anomaly[valid_mask] = (
+                    array[valid_mask] - mean[valid_mask]) / std[valid_mask]
+                target_raster.write(
+                    anomaly.astype(numpy.float32), 1, window=window)
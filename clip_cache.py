@@ -0,0 +1,107 @@
+"""Clipped days of an AOI shared by every date range of a run.
+
+Not a command line script. Clips are kept in a cache directory by AOI,
+dataset, variable and date, so date ranges that overlap, in one run or in
+later ones, fetch and clip a shared day once. ``ClipCache.schedule`` adds
+the clip task of a day to a task graph the first time the day is asked for
+and returns that task after, date ranges scheduled from several threads on
+one task graph can share a cache.
+"""
+import os
+import threading
+
+import aoi_context
+import key_manifest
+import window_read
+
+try:
+    from ecoshard import fetch_data
+except RuntimeError as e:
+    print(f'Error when loading fetch_data: {e}')
+
+
+class ClipCache:
+    """Clip tasks of the days of a dataset over one AOI."""
+
+    def __init__(
+            self, cache_dir, aoi_path, dataset_id, target_mask_value,
+            window_read_root=None):
+        """Set up the cache, nothing is fetched until a day is scheduled.
+
+        Args:
+            cache_dir (str): directory of the clips of every AOI, this
+                AOI's are under a directory named by ``aoi_context.aoi_id``.
+            aoi_path (str): path to the AOI vector.
+            dataset_id (str): fetch_data dataset, e.g. "era5_daily".
+            target_mask_value (float): see ``aoi_context.AoiContext.clip``.
+            window_read_root (str): if not None, days are clipped by
+                reading the AOI window of their key under this root with
+                ``window_read.clip_window`` instead of fetching them whole.
+        """
+        self.aoi_path = aoi_path
+        self.aoi_dir = os.path.join(cache_dir, aoi_context.aoi_id(aoi_path))
+        self.dataset_id = dataset_id
+        self.target_mask_value = target_mask_value
+        self.window_read_root = window_read_root
+        # tasks whose results are ``window_read.clip_window`` transfers
+        self.window_read_task_list = []
+        self._context_path = None
+        self._task_by_path = {}
+        self._lock = threading.Lock()
+
+    def clip_path(self, dataset_args):
+        """Path of the clip of the day `dataset_args` refer to."""
+        return os.path.join(
+            self.aoi_dir, self.dataset_id, dataset_args['variable'],
+            f'clip_{dataset_args["date"]}.tif')
+
+    def schedule(self, task_graph, dataset_args):
+        """Add the task that clips a day, once per day.
+
+        The AOI is prepared, see ``aoi_context.build_cached``, on the grid
+        of the first day that is scheduled.
+
+        Args:
+            task_graph (taskgraph.TaskGraph): graph to add the task to, the
+                same graph for every call.
+            dataset_args (dict): "date" and "variable" of the day.
+
+        Returns:
+            (clip path, taskgraph.Task that makes it)
+        """
+        clip_path = self.clip_path(dataset_args)
+        with self._lock:
+            if clip_path in self._task_by_path:
+                return clip_path, self._task_by_path[clip_path]
+            source_path = None
+            if self.window_read_root is not None:
+                source_path = window_read.gdal_path(
+                    self.window_read_root,
+                    key_manifest.dataset_key(self.dataset_id, dataset_args))
+            if self._context_path is None:
+                self._context_path = aoi_context.build_cached(
+                    self.aoi_path,
+                    source_path or fetch_data.fetch_file(
+                        self.dataset_id, dataset_args),
+                    self.aoi_dir)
+            os.makedirs(os.path.dirname(clip_path), exist_ok=True)
+            if source_path is None:
+                clip_task = task_graph.add_task(
+                    func=aoi_context.fetch_and_clip,
+                    args=(
+                        self._context_path, self.dataset_id, dataset_args,
+                        clip_path),
+                    kwargs={'target_mask_value': self.target_mask_value},
+                    target_path_list=[clip_path],
+                    task_name=f'fetch and clip {clip_path}')
+            else:
+                clip_task = task_graph.add_task(
+                    func=window_read.clip_window,
+                    args=(self._context_path, source_path, clip_path),
+                    kwargs={'target_mask_value': self.target_mask_value},
+                    target_path_list=[clip_path],
+                    store_result=True,
+                    task_name=f'window read and clip {clip_path}')
+                self.window_read_task_list.append(clip_task)
+            self._task_by_path[clip_path] = clip_task
+        return clip_path, clip_task
@@ -1,8 +1,10 @@
 """See `python scriptname.py --help"""
 from concurrent.futures import as_completed
 from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import argparse
 import collections
+import hashlib
 import logging
 import multiprocessing
 import os
@@ -15,18 +17,31 @@ import time
 import zipfile
 
 from rasterio.transform import Affine
-from scipy.interpolate import griddata
+from scipy.spatial import Delaunay
+import cftime
 import numpy
-import pandas
-import rasterio
+import scipy.sparse
 import xarray
 
+import netcdf_conversion
+
 BASE_URL = 'https://esgf-node.llnl.gov/esg-search/search'
 BASE_SEARCH_URL = 'https://esgf-node.llnl.gov/search_files'
 VARIANT_SUFFIX = 'i1p1f1'
 LOCAL_CACHE_DIR = '_cmip6_local_cache'
 HOT_DIR = 'D:/hot_cache'
 PROCESSED_FILES_PICKLE = os.path.join(HOT_DIR, 'processed_files.pkl')
+INTERPOLATION_CACHE_DIR = os.path.join(
+    LOCAL_CACHE_DIR, 'interpolation_weights')
+YEAR_CUBE_CREATION_OPTIONS = {
+    'tiled': 'YES',
+    'BLOCKXSIZE': 64,
+    'BLOCKYSIZE': 64,
+    'INTERLEAVE': 'PIXEL',
+    'BIGTIFF': 'IF_SAFER',
+    'COMPRESS': 'LZW',
+    'PREDICTOR': 2,
+}
 for dir_path in [LOCAL_CACHE_DIR, HOT_DIR]:
     os.makedirs(dir_path, exist_ok=True)
 
@@ -40,6 +55,9 @@ LOGGER = logging.getLogger(os.path.splitext(os.path.basename(__file__))[0])
 LOGGER.setLevel(logging.DEBUG)
 logging.getLogger('fetch_data').setLevel(logging.INFO)
 
+# interpolation weights already loaded in this process, by coordinate hash
+_INTERPOLATION_WEIGHTS = {}
+
 
 class ProcessedFiles:
     def __init__(self, pickle_path, manager):
@@ -77,7 +95,9 @@ def handle_retry_error(retry_state):
             str(last_exception.statistics).replace('\n', '<enter>')+"\n")
 
 
-def _download_and_process_file(processed_files, args):
+def _download_and_process_file(
+        processed_files, output_format, writer_backend, creation_options,
+        args):
     try:
         netcdf_path = None
         local_hot_dir = None
@@ -103,10 +123,22 @@ def _download_and_process_file(processed_files, args):
             HOT_DIR, base_path_pattern)
         LOGGER.info(f'process {os.path.basename(url)}')
 
-        with ProcessPoolExecutor(5) as executor:
-            raster_by_year_map = process_cmip6_netcdf_to_geotiff(
-                executor, netcdf_path, target_vars,
-                local_geotiff_path_pattern)
+        if output_format == 'year_cube':
+            with netcdf_conversion.writer_pool(
+                    writer_backend, 5) as executor:
+                process_cmip6_netcdf_to_year_cubes(
+                    executor, netcdf_path, target_vars,
+                    local_geotiff_path_pattern,
+                    os.path.join(LOCAL_CACHE_DIR, base_path_pattern),
+                    writer_backend, creation_options)
+            raster_by_year_map = {}
+        else:
+            with netcdf_conversion.writer_pool(
+                    writer_backend, 5) as executor:
+                raster_by_year_map = process_cmip6_netcdf_to_geotiff(
+                    executor, netcdf_path, target_vars,
+                    local_geotiff_path_pattern, writer_backend,
+                    creation_options)
         for year, file_list in raster_by_year_map.items():
             zip_path_pattern = base_path_pattern.format(
                 **{**target_vars, **{'date': year}}).replace(
@@ -189,141 +221,376 @@ def _download_file(target_dir, url):
             os.remove(stream_path)
 
 
+def decode_time_coordinate(time_var):
+    """Convert a whole cmip6 time coordinate to date strings at once.
+
+    Handles numpy datetime64 times, cftime times from non-standard
+    calendars (noleap, 360_day, ...) and undecoded numeric times that
+    carry CF `units` and `calendar` attributes.
+
+    Args:
+        time_var (xarray.DataArray): the `time` coordinate of a dataset.
+
+    Returns:
+        (date_str_array, year_array) numpy string arrays of YYYY-MM-DD
+        dates and YYYY years, one per time step.
+    """
+    time_values = time_var.values
+    if numpy.issubdtype(time_values.dtype, numpy.datetime64):
+        date_str_array = numpy.datetime_as_string(time_values, unit='D')
+    elif numpy.issubdtype(time_values.dtype, numpy.number):
+        date_str_array = numpy.array([
+            date.strftime('%Y-%m-%d') for date in cftime.num2date(
+                time_values, time_var.attrs.get(
+                    'units', 'days since 1970-01-01'),
+                calendar=time_var.attrs.get('calendar', 'standard'))])
+    else:
+        date_str_array = time_var.dt.strftime('%Y-%m-%d').values
+    date_str_array = date_str_array.astype('<U10')
+    return date_str_array, date_str_array.astype('<U4')
+
+
+def grid_geometry(dataset, variable, netcdf_path):
+    """Detect the output grid of `variable` once for a whole file.
+
+    Args:
+        dataset (xarray.Dataset): open cmip6 dataset.
+        variable (str): variable that will be extracted.
+        netcdf_path (str): path to the dataset, used in error messages.
+
+    Returns:
+        dict with `coord_list`, the x and y coordinates of the output
+        grid, `transform`, its affine transform, and `regrid`, which is
+        None for 2D grids. For 1D (unstructured) grids it is the
+        ``(weight_matrix, outside_hull, (n_lat, n_lon))`` needed to
+        linearly interpolate onto a 0.25 degree grid.
+    """
+    try:
+        coord_list = list(netcdf_conversion.detect_coordinates(dataset))
+    except ValueError:
+        raise ValueError(f'coord list not fully defined for {netcdf_path}')
+    transform = netcdf_conversion.grid_transform(
+        *coord_list, convention='span')
+    regrid = None
+    if dataset[variable].ndim == 2:
+        # this is 1D data over time, need to re-create 2D grid
+        lon, lat = coord_list
+        # Define the grid
+        grid_size = 0.25
+        n_lat = int(numpy.round((lat.max()-lat.min())/grid_size))
+        n_lon = int(numpy.round((lon.max()-lon.min())/grid_size))
+        lats = numpy.linspace(lat.min(), lat.max(), n_lat)
+        lons = numpy.linspace(lon.min(), lon.max(), n_lon)
+
+        coord_list = [lons, lats]
+        transform = Affine.translation(lons[0], lats[0]) * Affine.scale(
+            grid_size, grid_size)
+        weight_matrix, outside_hull = _interpolation_weights(
+            lon, lat, lons, lats)
+        regrid = (weight_matrix, outside_hull, (n_lat, n_lon))
+    return {
+        'coord_list': coord_list,
+        'transform': transform,
+        'regrid': regrid,
+    }
+
+
+def _raster_block(dataset, variable, time_index_list, geometry):
+    """Extract days of `variable` as a (n_days, rows, cols) array.
+
+    Args:
+        dataset (xarray.Dataset): open cmip6 dataset.
+        variable (str): variable to extract.
+        time_index_list (list): indexes into the time coordinate.
+        geometry (dict): result of ``grid_geometry`` for this file.
+
+    Returns:
+        numpy array of the days stacked in `time_index_list` order, 1D
+        grids are regridded for every day in one sparse product.
+    """
+    data_values = dataset[variable].isel(time=time_index_list).values
+    if geometry['regrid'] is not None:
+        weight_matrix, outside_hull, grid_shape = geometry['regrid']
+        # Perform the 2D interpolation
+        data_values = (weight_matrix @ data_values.T).T
+        data_values[:, outside_hull] = numpy.nan
+        data_values = data_values.reshape((-1,) + grid_shape)
+    return data_values
+
+
+def _interpolation_weights(lon, lat, target_lons, target_lats):
+    """Get linear interpolation weights from scattered points to a grid.
+
+    The weights reproduce ``griddata(..., method='linear')`` but the
+    Delaunay triangulation is only built once per source grid. They are
+    kept in memory and in ``INTERPOLATION_CACHE_DIR`` keyed by a hash of
+    the source and target coordinates.
+
+    Args:
+        lon, lat (numpy.ndarray): 1D source point coordinates.
+        target_lons, target_lats (numpy.ndarray): 1D target grid axes.
+
+    Returns:
+        (weight_matrix, outside_hull) where weight_matrix is a sparse
+        (n_target, n_source) matrix so that ``weight_matrix @ values``
+        interpolates the source values onto the row major target grid and
+        outside_hull is a boolean array of the target pixels outside the
+        source points, these are NaN in griddata.
+    """
+    coord_hash = hashlib.sha1()
+    for array in [lon, lat, target_lons, target_lats]:
+        coord_hash.update(numpy.ascontiguousarray(
+            array, dtype=numpy.float64).tobytes())
+    cache_key = coord_hash.hexdigest()
+    if cache_key in _INTERPOLATION_WEIGHTS:
+        return _INTERPOLATION_WEIGHTS[cache_key]
+
+    cache_path = os.path.join(INTERPOLATION_CACHE_DIR, f'{cache_key}.npz')
+    n_target = len(target_lons) * len(target_lats)
+    if os.path.exists(cache_path):
+        LOGGER.debug(f'loading interpolation weights from {cache_path}')
+        with numpy.load(cache_path) as weights:
+            weight_matrix = scipy.sparse.csr_matrix(
+                (weights['data'], weights['indices'], weights['indptr']),
+                shape=(n_target, len(lon)))
+            outside_hull = weights['outside_hull']
+    else:
+        LOGGER.info(f'triangulating {len(lon)} points for {cache_path}')
+        lon_grid, lat_grid = numpy.meshgrid(target_lons, target_lats)
+        target_points = numpy.column_stack(
+            (lon_grid.ravel(), lat_grid.ravel()))
+        triangulation = Delaunay(numpy.column_stack((lon, lat)))
+        simplex_index = triangulation.find_simplex(target_points)
+        outside_hull = simplex_index < 0
+        inside_index = numpy.nonzero(~outside_hull)[0]
+        affine = triangulation.transform[simplex_index[inside_index]]
+        barycentric = numpy.einsum(
+            'ijk,ik->ij', affine[:, :2, :],
+            target_points[inside_index] - affine[:, 2, :])
+        weights = numpy.column_stack(
+            (barycentric, 1 - barycentric.sum(axis=1)))
+        vertices = triangulation.simplices[simplex_index[inside_index]]
+        weight_matrix = scipy.sparse.csr_matrix(
+            (weights.ravel(),
+             (numpy.repeat(inside_index, 3), vertices.ravel())),
+            shape=(n_target, len(lon)))
+        os.makedirs(INTERPOLATION_CACHE_DIR, exist_ok=True)
+        # save under a temp name so other processes never see half a file
+        temp_path = f'{cache_path}.{os.getpid()}.npz'
+        numpy.savez(
+            temp_path, data=weight_matrix.data,
+            indices=weight_matrix.indices, indptr=weight_matrix.indptr,
+            outside_hull=outside_hull)
+        os.replace(temp_path, cache_path)
+    _INTERPOLATION_WEIGHTS[cache_key] = (weight_matrix, outside_hull)
+    return weight_matrix, outside_hull
+
+
 def process_cmip6_netcdf_to_geotiff(
-        executor, netcdf_path, target_vars, target_path_pattern):
+        executor, netcdf_path, target_vars, target_path_pattern,
+        writer_backend='pickle', creation_options=None):
     """Convert era5 netcdf files to geotiff
 
     Args:
+        executor (concurrent.futures.Executor): executor to write the
+            daily rasters on, a ThreadPoolExecutor for the `thread`
+            backend and a ProcessPoolExecutor otherwise.
         netcdf_path (str): path to netcdf file
-        date_str (str): formatted version of the date to use in the target
-            file
+        target_vars (dict): `variable`, `scenario`, `model` and `variant`
+            values to fill in `target_path_pattern`.
         target_path_pattern (str): pattern that will allow the replacement
             of `variable` and `date` strings with the appropriate variable
             date strings in the netcdf variables.
+        writer_backend (str): how daily arrays reach the writers. "pickle"
+            sends each day through the executor, "shared_memory" publishes
+            each year of data once in shared memory and sends only an
+            offset, "thread" shares the array directly with writer threads.
+        creation_options (dict): GDAL creation options for the daily
+            geotiffs, defaults to
+            ``netcdf_conversion.DEFAULT_CREATION_OPTIONS``.
 
     Returns:
-        list of (file, variable_id) tuples created by this process
+        dict indexing year to the list of daily geotiff paths in that year
     """
     try:
         dataset = xarray.open_dataset(netcdf_path)
         time_var = dataset['time']
         variable = target_vars['variable']
-        future_list = []
         raster_by_year = collections.defaultdict(list)
-        previous_year = None
         LOGGER.debug(f'processing {netcdf_path} for time {time_var}')
-        for i, date in enumerate(time_var):
-            daily_data = dataset[variable].isel(time=i)
-            date_str = None
-            for conversion_fn in [
-                    lambda d: d.item().strftime('%Y-%m-%d'),
-                    lambda d: d.time.strftime('%Y-%m-%d'),
-                    lambda d: pandas.to_datetime(d.values).strftime('%Y-%m-%d'),
-                    lambda d: pandas.to_datetime(d.item(), unit='D'),
-                    lambda d: pandas.to_datetime(d, unit='D'),
-                    lambda d: d.strftime('%Y-%m-%d'),
-                    ]:
-                try:
-                    date_str = conversion_fn(date)
-                    break
-                except Exception:
-                    #LOGGER.exception(f'could not convert, trying again')
+        date_str_array, year_array = decode_time_coordinate(time_var)
+        geometry = grid_geometry(dataset, variable, netcdf_path)
+        for year in numpy.unique(year_array).tolist():
+            index_list = []
+            target_path_list = []
+            for i in numpy.nonzero(year_array == year)[0].tolist():
+                target_path = target_path_pattern.format(
+                    **{**target_vars, **{'date': date_str_array[i]}})
+                raster_by_year[year].append(target_path)
+                if os.path.exists(target_path):
+                    LOGGER.debug(
+                        f'{target_path} exists no need to re-make')
                     continue
-            if date_str is None:
-                raise ValueError(f'could not convert {date}')
-            year = date_str[0:4]
-
-            target_path = target_path_pattern.format(
-                **{**target_vars, **{'date': date_str}})
-            raster_by_year[year].append(target_path)
-            if os.path.exists(target_path):
-                LOGGER.debug(f'{target_path} exists no need to re-make')
+                index_list.append(i)
+                target_path_list.append(target_path)
+            if not index_list:
                 continue
 
-            if previous_year != year:
-                LOGGER.info(f'iterating on {year}: {netcdf_path}')
-                previous_year = year
-            data_values = daily_data.values[numpy.newaxis, ...]
-            coord_list = []
-            coord_id_list = []
-            res_list = []
-            for coord_id, field_options in zip(['x', 'y'], [
-                    ['longitude', 'long', 'lon'],
-                    ['latitude', 'lat']]):
-                for field_id in field_options:
+            LOGGER.info(f'iterating on {year}: {netcdf_path}')
+            # decode the year once, each writer gets one day of it
+            year_block = _raster_block(
+                dataset, variable, index_list, geometry).astype(
+                numpy.float32, copy=False)
+            shared_block = None
+            try:
+                if writer_backend == 'shared_memory':
+                    shared_block = netcdf_conversion.publish_shared_block(
+                        year_block)
+                    future_list = [
+                        executor.submit(
+                            netcdf_conversion.write_geotiff_from_shared_block,
+                            shared_block.name, year_block.shape,
+                            year_block.dtype,
+                            slice(day_offset, day_offset+1), target_path,
+                            geometry['transform'],
+                            creation_options=creation_options)
+                        for day_offset, target_path in enumerate(
+                            target_path_list)]
+                else:
+                    future_list = [
+                        executor.submit(
+                            _write_raster, year_block[day_offset:day_offset+1],
+                            geometry['transform'], target_path,
+                            creation_options)
+                        for day_offset, target_path in enumerate(
+                            target_path_list)]
+                year_block = None
+                for future in future_list:
                     try:
-                        coord_array = dataset.coords[field_id]
-                        res_list.append(float(
-                            (coord_array[-1] - coord_array[0]) /
-                            len(coord_array)))
-                        coord_list.append(coord_array)
-                        coord_id_list.append(field_id)
-                        break
-                    except KeyError:
-                        pass
-            if len(coord_list) != 2:
-                raise ValueError(
-                    f'coord list not fully defined for {netcdf_path}')
-            if len(daily_data.values.shape) == 1:
-                # this is 1D data, need to re-create 2D grid
-                lon = coord_list[0].values
-                lat = coord_list[1].values
-                # Define the grid
-                grid_size = 0.25
-                n_lat = int(numpy.round((lat.max()-lat.min())/grid_size))
-                n_lon = int(numpy.round((lon.max()-lon.min())/grid_size))
-                lats = numpy.linspace(lat.min(), lat.max(), n_lat)
-                lons = numpy.linspace(lon.min(), lon.max(), n_lon)
-                lon_grid, lat_grid = numpy.meshgrid(lons, lats)
-
-                res_list = [grid_size, grid_size]
-                coord_list = [lons, lats]
-
-                # Perform the 2D interpolation
-                data_values = griddata(
-                    (lon, lat), daily_data, (lon_grid, lat_grid),
-                    method='linear')
-                data_values = data_values[numpy.newaxis, ...]
-            transform = Affine.translation(
-                *[a[0] for a in coord_list]) * Affine.scale(*res_list)
-            future = executor.submit(
-                _write_raster, data_values, coord_list, transform, target_path)
-            future_list.append(future)
-        for future in future_list:
+                        # This will raise an exception if the worker
+                        # function failed
+                        _ = future.result()
+                    except Exception:
+                        LOGGER.exception(
+                            'something failed on process CMIP6 data '
+                            f'{target_vars}')
+                        executor.shutdown(wait=False)
+                        raise
+            finally:
+                if shared_block is not None:
+                    shared_block.close()
+                    shared_block.unlink()
+        return raster_by_year
+    except Exception:
+        LOGGER.exception(f'error on {netcdf_path}')
+        raise
+
+
+def process_cmip6_netcdf_to_year_cubes(
+        executor, netcdf_path, target_vars, local_path_pattern,
+        target_path_pattern, writer_backend='pickle',
+        creation_options=None):
+    """Convert a cmip6 netcdf file to one multi-band geotiff per year.
+
+    Each cube has one band per day, in time order, whose band description
+    is the YYYY-MM-DD date of that band.
+
+    Args:
+        executor (concurrent.futures.Executor): executor to write cubes on.
+        netcdf_path (str): path to netcdf file
+        target_vars (dict): `variable`, `scenario`, `model` and `variant`
+            values to fill in the path patterns.
+        local_path_pattern (str): pattern for the scratch path a cube is
+            written to, `date` is replaced with the year.
+        target_path_pattern (str): same as `local_path_pattern` but for the
+            final location the finished cube is moved to.
+        writer_backend (str): how a year reaches the writer, see
+            ``process_cmip6_netcdf_to_geotiff``. "shared_memory" publishes
+            each year once and the writer reads the cube from it.
+        creation_options (dict): if not None, its compression options
+            replace those of ``YEAR_CUBE_CREATION_OPTIONS``, the cube
+            tiling and interleaving are kept.
+
+    Returns:
+        dict indexing year to the target cube path for that year
+    """
+    try:
+        dataset = xarray.open_dataset(netcdf_path)
+        variable = target_vars['variable']
+        date_str_array, year_array = decode_time_coordinate(
+            dataset['time'])
+        geometry = grid_geometry(dataset, variable, netcdf_path)
+
+        def _wait_for_cube(future):
             try:
-                # This will raise an exception if the worker function failed
                 _ = future.result()
             except Exception:
                 LOGGER.exception(
                     f'something failed on process CMIP6 data {target_vars}')
                 executor.shutdown(wait=False)
                 raise
-        return raster_by_year
+
+        def _release(shared_block):
+            if shared_block is not None:
+                shared_block.close()
+                shared_block.unlink()
+
+        cube_by_year = {}
+        pending_future = None
+        pending_shared_block = None
+        shared_block = None
+        try:
+            for year in numpy.unique(year_array).tolist():
+                index_list = numpy.nonzero(year_array == year)[0]
+                local_path, target_path = [
+                    pattern.format(**{**target_vars, **{'date': year}})
+                    for pattern in [local_path_pattern, target_path_pattern]]
+                cube_by_year[year] = target_path
+                if os.path.exists(target_path):
+                    LOGGER.debug(f'{target_path} exists no need to re-make')
+                    continue
+                LOGGER.info(f'building {year} cube: {netcdf_path}')
+                data_values = _raster_block(
+                    dataset, variable, index_list, geometry)
+                cube_args = (
+                    list(date_str_array[index_list]), geometry['transform'],
+                    local_path, target_path, creation_options)
+                if writer_backend == 'shared_memory':
+                    shared_block = netcdf_conversion.publish_shared_block(
+                        data_values)
+                    data_args = (
+                        shared_block.name, data_values.shape,
+                        data_values.dtype)
+                    write_func = _write_year_cube_from_shared_block
+                else:
+                    data_args = (data_values,)
+                    write_func = _write_year_cube
+                data_values = None
+                # the previous year is written while this one is decoded, so
+                # no more than two years of a long file are in memory at once
+                if pending_future is not None:
+                    _wait_for_cube(pending_future)
+                    _release(pending_shared_block)
+                    pending_shared_block = None
+                pending_future = executor.submit(
+                    write_func, *data_args, *cube_args)
+                pending_shared_block, shared_block = shared_block, None
+            if pending_future is not None:
+                _wait_for_cube(pending_future)
+        finally:
+            _release(shared_block)
+            _release(pending_shared_block)
+        return cube_by_year
     except Exception:
         LOGGER.exception(f'error on {netcdf_path}')
         raise
 
 
-def _write_raster(data_values, coord_list, transform, target_path):
+def _write_raster(data_values, transform, target_path, creation_options=None):
     try:
-        #LOGGER.info(f'processing {target_path}')
-        os.makedirs(os.path.dirname(target_path), exist_ok=True)
-        with rasterio.open(
-            target_path,
-            mode="w",
-            driver="GTiff",
-            height=len(coord_list[1]),
-            width=len(coord_list[0]),
-            count=1,
-            dtype=numpy.float32,
-            nodata=None,
-            crs="+proj=latlong",
-            transform=transform,
-            **{
-                'tiled': 'YES',
-                'COMPRESS': 'LZW',
-                'PREDICTOR': 2}) as new_dataset:
-            new_dataset.write(data_values)
+        netcdf_conversion.write_geotiff(
+            target_path, data_values, transform,
+            creation_options=creation_options)
         LOGGER.debug(f'wrote the file {target_path}')
         return target_path
     except Exception:
@@ -331,11 +598,79 @@ def _write_raster(data_values, coord_list, transform, target_path):
         raise
 
 
+def _write_year_cube(
+        data_values, date_list, transform, local_path, target_path,
+        creation_options=None):
+    """Write a (day, row, col) stack as a tiled multi-band geotiff.
+
+    Pixel interleaving and small tiles keep a single pixel's whole year in
+    one compressed block so readers can get it in one windowed read. The
+    cube is written to `local_path` and then moved to `target_path`.
+    """
+    cube_creation_options = YEAR_CUBE_CREATION_OPTIONS
+    if creation_options is not None:
+        cube_creation_options = {
+            **YEAR_CUBE_CREATION_OPTIONS,
+            **netcdf_conversion.compression_options(creation_options)}
+    try:
+        netcdf_conversion.write_geotiff(
+            local_path, data_values, transform,
+            creation_options=cube_creation_options,
+            band_descriptions=date_list)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        shutil.move(local_path, target_path)
+        LOGGER.info(f'wrote year cube {target_path}')
+        return target_path
+    except Exception:
+        LOGGER.exception(f'error on _write_year_cube for {target_path}')
+        raise
+
+
+def _write_year_cube_from_shared_block(
+        shared_block_name, block_shape, block_dtype, *args, **kwargs):
+    """``_write_year_cube`` of a ``publish_shared_block`` block.
+
+    Args:
+        shared_block_name (str): name of the published (day, row, col)
+            block.
+        block_shape (tuple): shape of the published array.
+        block_dtype (numpy.dtype): dtype of the published array.
+        args, kwargs: the rest of the ``_write_year_cube`` arguments.
+
+    Returns:
+        the target path of the cube
+    """
+    shared_block = shared_memory.SharedMemory(name=shared_block_name)
+    try:
+        data_values = numpy.ndarray(
+            block_shape, dtype=block_dtype, buffer=shared_block.buf)
+        return _write_year_cube(data_values, *args, **kwargs)
+    finally:
+        data_values = None
+        shared_block.close()
+
+
 def main():
     parser = argparse.ArgumentParser(description=(
         'Process CMIP6 raw urls to geotiff.'))
     parser.add_argument('url_list_path', help='url list')
+    parser.add_argument(
+        '--output_format', default='daily_zip',
+        choices=['daily_zip', 'year_cube'], help=(
+            '"daily_zip" zips one geotiff per day into a file per year, '
+            '"year_cube" writes one multi-band geotiff per year with a '
+            'band per day'))
+    parser.add_argument(
+        '--writer_backend', default='pickle',
+        choices=['pickle', 'shared_memory', 'thread'], help=(
+            'how daily arrays reach the geotiff writers: "pickle" sends '
+            'each day to a worker process, "shared_memory" publishes each '
+            'year once and sends workers an offset, "thread" writes from '
+            'threads that share the array'))
+    netcdf_conversion.add_creation_arguments(parser)
     args = parser.parse_args()
+    creation_options = netcdf_conversion.resolve_creation_options(
+        args.creation_profile, args.creation_options)
     with multiprocessing.Manager() as manager:
         processed_files = ProcessedFiles(PROCESSED_FILES_PICKLE, manager)
 
@@ -355,7 +690,8 @@ def main():
             future_list = {
                 global_executor.submit(
                     _download_and_process_file, processed_files,
-                    param_and_url_arg)
+                    args.output_format, args.writer_backend,
+                    creation_options, param_and_url_arg)
                 for param_and_url_arg in param_and_url_list}
 
             for future in as_completed(future_list):
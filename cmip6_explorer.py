@@ -21,7 +21,7 @@ os.makedirs(LOCAL_WORKSPACE, exist_ok=True)
 def iterate_files(directory, start_year, end_year):
     for root, dirs, files in os.walk(directory):
         for file in files:
-            if not file.endswith('.zip'):
+            if not file.endswith(('.zip', '.tif')):
                 continue
             year = file[-8:-4]
             if start_year <= year <= end_year:
@@ -47,6 +47,23 @@ def unzip_and_iterate_pr(zip_filepath, point):
     return val_list
 
 
+def iterate_year_cube_pr(cube_path, point):
+    """Read a year of daily pr at `point` from a multi-band year cube."""
+    raster = gdal.Open(cube_path)
+    gt = raster.GetGeoTransform()
+    x_pixel = int((point[0] - gt[0]) / gt[1])
+    y_pixel = int((point[1] - gt[3]) / gt[5])
+    # one windowed read gets the pixel across every band/day
+    pixel_values = raster.ReadAsArray(x_pixel, y_pixel, 1, 1)
+    val_list = []
+    for band_index, pixel_value in enumerate(pixel_values.reshape(-1)):
+        date = raster.GetRasterBand(band_index+1).GetDescription()
+        date_as_int = [int(v) for v in date.split('-')]
+        val_list.append(
+            (datetime.date(*date_as_int), pixel_value*86400))  # mm
+    return val_list
+
+
 def get_val(file_path, point):
     raster = gdal.Open(file_path)
     gt = raster.GetGeoTransform()
@@ -81,10 +98,15 @@ def main():
             if model not in model_index:
                 model_index[model] = len(model_index)
             zip_path = os.path.join(LOCAL_WORKSPACE, os.path.basename(file_path))
-            if not os.path.exists(zip_path):
+            if file_path.endswith('.zip') and not os.path.exists(zip_path):
                 shutil.copy(file_path, zip_path)
             try:
-                val_list = unzip_and_iterate_pr(zip_path, [float(v) for v in args.point])
+                if file_path.endswith('.tif'):
+                    val_list = iterate_year_cube_pr(
+                        file_path, [float(v) for v in args.point])
+                else:
+                    val_list = unzip_and_iterate_pr(
+                        zip_path, [float(v) for v in args.point])
                 model_to_variant_data[(variable, scenario, model)].append(
                     (variant, val_list))
                 variant_to_model_data[(variable, scenario, variant)].append(
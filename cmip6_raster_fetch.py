@@ -15,8 +15,11 @@ from osgeo import gdal
 import ee
 import geemap
 import geopandas
+import rasterio
 import requests
 
+from zone_index import ZoneIndex
+
 
 logging.basicConfig(
     level=logging.WARNING,
@@ -200,7 +203,20 @@ def main():
         '--table_path', help='Desired output table path.')
     parser.add_argument(
         '--n_day_window', default=10, type=int, help='Number of days in which to average around')
+    parser.add_argument(
+        '--zonal_stat', default='mean', help=(
+            'statistic of each aggregate reported in the table: "mean" '
+            '(weighted by pixel coverage), "min", "max", or a percentile '
+            'such as "p50"'))
     args = parser.parse_args()
+    if args.zonal_stat.startswith('p'):
+        percentile_list = [float(args.zonal_stat[1:])]
+        # normalize so it matches the key zonal_statistics reports
+        args.zonal_stat = f'p{percentile_list[0]:g}'
+    elif args.zonal_stat in ('mean', 'min', 'max'):
+        percentile_list = []
+    else:
+        raise ValueError(f'unknown --zonal_stat {args.zonal_stat}')
 
     authenticate()
 
@@ -298,8 +314,8 @@ def main():
     LOGGER.debug('waiting for shutdown')
     executor.shutdown()
     LOGGER.debug('processing results to table')
-    aoi_vector = gdal.OpenEx(args.aoi_vector_path)
-    aoi_layer = aoi_vector.GetLayer()
+    # rasters usually share one grid, so the AOI is rasterized once per grid
+    zone_index_list = []
     result_dict = collections.defaultdict(
         lambda:collections.defaultdict(lambda: None))
     scenario_key_set = set()
@@ -307,18 +323,20 @@ def main():
             raster_path_map.items():
         if julian_day == 0:
             julian_day = 'year'
-        zonal_working_dir = os.path.join(
-            WORKSPACE_DIR, os.path.basename(os.path.splitext(raster_path)[0]))
-        os.makedirs(zonal_working_dir, exist_ok=True)
-        zonal_stats_map = geoprocessing.zonal_statistics(
-            (raster_path, 1), args.aoi_vector_path,
-            polygons_might_overlap=False,
-            working_dir=zonal_working_dir)
-        shutil.rmtree(zonal_working_dir)
-        for fid, stats_map in zonal_stats_map.items():
-            feature = aoi_layer.GetFeature(fid)
-            aggregate_id = feature.GetField(args.field_id_for_aggregate)
-            val = (stats_map['max']+stats_map['min'])/2
+        with rasterio.open(raster_path) as raster:
+            zone_index = next((
+                zone_index for zone_index in zone_index_list
+                if zone_index.on_grid_of(raster)), None)
+        if zone_index is None:
+            zone_index = ZoneIndex.load_or_build(
+                args.aoi_vector_path, raster_path,
+                os.path.join(WORKSPACE_DIR, 'zone_index'),
+                zone_field=args.field_id_for_aggregate)
+            zone_index_list.append(zone_index)
+        zonal_stats_map = zone_index.zonal_statistics(
+            raster_path, percentile_list=percentile_list)
+        for aggregate_id, stats_map in zonal_stats_map.items():
+            val = stats_map[args.zonal_stat]
             scenario_key = f'{start_end_year} - {scenario_id}'
             scenario_key_set.add(scenario_key)
             result_dict[(aggregate_id, variable_id, model_id, julian_day)][scenario_key] = val
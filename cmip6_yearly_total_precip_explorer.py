@@ -29,7 +29,7 @@ def line_seg(n, max_n):
 def iterate_files(directory):
     for root, dirs, files in os.walk(directory):
         for file in files:
-            if not file.endswith('.zip'):
+            if not file.endswith(('.zip', '.tif')):
                 continue
             yield(os.path.join(root, file))
 
@@ -50,6 +50,17 @@ def unzip_and_sum_yearly_pr(zip_filepath, point):
     return running_val
 
 
+def sum_year_cube_pr(cube_path, point):
+    """Sum a year of daily pr at `point` from a multi-band year cube."""
+    raster = gdal.Open(cube_path)
+    gt = raster.GetGeoTransform()
+    x_pixel = int((point[0] - gt[0]) / gt[1])
+    y_pixel = int((point[1] - gt[3]) / gt[5])
+    # one windowed read gets the pixel across every band/day
+    pixel_values = raster.ReadAsArray(x_pixel, y_pixel, 1, 1)
+    return float(numpy.sum(pixel_values))*86400  # convert to mm
+
+
 def get_val(file_path, point):
     raster = gdal.Open(file_path)
     gt = raster.GetGeoTransform()
@@ -62,6 +73,9 @@ def get_val(file_path, point):
 
 def process_file(file_path, zip_path, point):
     print(f'processing {zip_path}')
+    if file_path.endswith('.tif'):
+        # year cubes are read in place, no copy or unzip needed
+        return sum_year_cube_pr(file_path, [float(v) for v in point])
     tries = 0
     while True:
         if not os.path.exists(zip_path):
@@ -0,0 +1,184 @@
+"""Memory-mapped per-AOI cubes of clipped daily rasters.
+
+Not a command line script. Clipped days of a variable are appended to one
+(day, row, col) float32 file per AOI and variable, with a JSON sidecar that
+indexes the dates and records the grid. Later runs, even over other date
+ranges, only clip the days the cube doesn't have yet and read the rest as
+memory-mapped slices.
+
+A cube has a single writer: append from one process, threads of that
+process share the cube of ``open_cube``. Reads can happen from any number
+of processes.
+"""
+import json
+import os
+import threading
+
+from ecoshard import geoprocessing
+from osgeo import gdal
+import numpy
+
+import aoi_context
+
+CUBE_DTYPE = numpy.float32
+_CUBE_BY_DIR = {}
+_CUBE_BY_DIR_LOCK = threading.Lock()
+
+
+def aoi_cube_dir(cache_dir, aoi_path, dataset_id, variable_id):
+    """Return the directory of the cube of a variable over an AOI.
+
+    The AOI is identified by ``aoi_context.aoi_id``, so an edited vector
+    gets a new cube.
+    """
+    return os.path.join(
+        cache_dir, aoi_context.aoi_id(aoi_path), dataset_id, variable_id)
+
+
+def open_cube(cube_dir):
+    """Return this process's ``DailyCube`` of `cube_dir`.
+
+    Threads that open the same directory share one cube, so its index stays
+    consistent and their appends are serialized.
+    """
+    with _CUBE_BY_DIR_LOCK:
+        cube_dir = os.path.abspath(cube_dir)
+        if cube_dir not in _CUBE_BY_DIR:
+            _CUBE_BY_DIR[cube_dir] = DailyCube(cube_dir)
+        return _CUBE_BY_DIR[cube_dir]
+
+
+class DailyCube:
+    """Appendable (day, row, col) cube of daily rasters on one grid."""
+
+    def __init__(self, cube_dir):
+        """Open the cube in `cube_dir`, it is created on the first append.
+
+        Args:
+            cube_dir (str): directory of the cube, see ``aoi_cube_dir``.
+        """
+        self.cube_dir = cube_dir
+        self.data_path = os.path.join(cube_dir, 'cube.f32')
+        self.index_path = os.path.join(cube_dir, 'index.json')
+        self.grid = None
+        self.date_list = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+            self.grid = index['grid']
+            self.date_list = index['date_list']
+        self._index_by_date = {
+            date: index for index, date in enumerate(self.date_list)}
+        self._append_lock = threading.Lock()
+
+    def __contains__(self, date_str):
+        """True if the day `date_str` (YYYY-MM-DD) is in the cube."""
+        return date_str in self._index_by_date
+
+    @property
+    def nodata(self):
+        """Nodata value of the cube's days."""
+        return self.grid['nodata']
+
+    def _frame_bytes(self):
+        return (
+            self.grid['shape'][0] * self.grid['shape'][1] *
+            numpy.dtype(CUBE_DTYPE).itemsize)
+
+    def append(self, date_str, raster_path):
+        """Append band 1 of `raster_path` as the day `date_str`.
+
+        Days already in the cube are skipped. The first day sets the grid,
+        later days must be on the same one.
+
+        Args:
+            date_str (str): day in the form YYYY-MM-DD.
+            raster_path (str): path to the clipped raster of that day.
+
+        Returns:
+            None
+        """
+        with self._append_lock:
+            if date_str in self:
+                return
+            raster_info = geoprocessing.get_raster_info(raster_path)
+            n_cols, n_rows = raster_info['raster_size']
+            if self.grid is None:
+                os.makedirs(self.cube_dir, exist_ok=True)
+                self.grid = {
+                    'shape': [n_rows, n_cols],
+                    'geotransform': list(raster_info['geotransform']),
+                    'projection_wkt': raster_info['projection_wkt'],
+                    'nodata': raster_info['nodata'][0],
+                }
+            elif [n_rows, n_cols] != self.grid['shape'] or not numpy.allclose(
+                    raster_info['geotransform'], self.grid['geotransform']):
+                raise ValueError(
+                    f'{raster_path} is not on the grid of the cube in '
+                    f'{self.cube_dir}: {raster_info["raster_size"]} at '
+                    f'{raster_info["geotransform"]} vs {self.grid}')
+
+            raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+            array = raster.GetRasterBand(1).ReadAsArray().astype(CUBE_DTYPE)
+            raster = None
+            with open(self.data_path, 'ab') as data_file:
+                # drop a day a crashed append wrote but didn't index
+                data_file.truncate(len(self.date_list) * self._frame_bytes())
+                data_file.write(array.tobytes())
+            self.date_list.append(date_str)
+            self._index_by_date[date_str] = len(self.date_list) - 1
+            temp_index_path = f'{self.index_path}.tmp'
+            with open(temp_index_path, 'w') as index_file:
+                json.dump({
+                    'grid': self.grid,
+                    'date_list': self.date_list}, index_file)
+            os.replace(temp_index_path, self.index_path)
+
+    def read(self, date_list):
+        """Return the (day, row, col) array of the days in `date_list`.
+
+        Days that were appended consecutively, the usual case, are a
+        read-only view of the memory-mapped cube, otherwise they are
+        gathered into a new array.
+
+        Args:
+            date_list (list): days in the form YYYY-MM-DD, all in the cube.
+
+        Returns:
+            numpy array or read-only numpy.memmap
+        """
+        missing_date_list = [
+            date_str for date_str in date_list if date_str not in self]
+        if missing_date_list:
+            raise KeyError(
+                f'{missing_date_list} are not in the cube in '
+                f'{self.cube_dir}')
+        cube = numpy.memmap(
+            self.data_path, dtype=CUBE_DTYPE, mode='r',
+            shape=(len(self.date_list), *self.grid['shape']))
+        index_list = [self._index_by_date[date] for date in date_list]
+        if index_list == list(range(
+                index_list[0], index_list[0] + len(index_list))):
+            return cube[index_list[0]:index_list[-1]+1]
+        return cube[index_list]
+
+    def write_raster(self, array, target_path, nodata=None):
+        """Write `array` to a GeoTIFF on the cube's grid.
+
+        Args:
+            array (numpy.ndarray): (row, col) array, its dtype is the
+                raster's.
+            target_path (str): path to the raster to create.
+            nodata (float): nodata of the raster, defaults to the cube's.
+
+        Returns:
+            None
+        """
+        if nodata is None:
+            nodata = self.nodata
+        geotransform = self.grid['geotransform']
+        geoprocessing.numpy_array_to_raster(
+            array, nodata, (geotransform[1], geotransform[5]),
+            (geotransform[0], geotransform[3]), self.grid['projection_wkt'],
+            target_path)
+
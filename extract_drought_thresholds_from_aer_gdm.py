@@ -13,9 +13,10 @@ from rasterio.transform import Affine
 import geopandas
 import numpy
 import pandas
-import rasterio
 import xarray
 
+import netcdf_conversion
+
 try:
     from ecoshard import fetch_data
 except RuntimeError as e:
@@ -58,7 +59,8 @@ class ValidateYearMonthFormat(argparse.Action):
         setattr(args, self.dest, f"{year}-{month:02d}")
 
 
-def process_netcat_to_geotiff(netcat_path, date_str, target_path_pattern):
+def process_netcat_to_geotiff(
+        netcat_path, date_str, target_path_pattern, creation_options=None):
     """Convert era5 netcat files to geotiff
 
     Args:
@@ -68,49 +70,22 @@ def process_netcat_to_geotiff(netcat_path, date_str, target_path_pattern):
         target_path_pattern (str): pattern that will allow the replacement
             of `variable` and `date` strings with the appropriate variable
             date strings in the netcat variables.
+        creation_options (dict): GDAL creation options, defaults to
+            ``netcdf_conversion.DEFAULT_CREATION_OPTIONS``.
 
     Returns:
         list of (file, variable_id) tuples created by this process
     """
     LOGGER.info(f'processing {netcat_path}')
     dataset = xarray.open_dataset(netcat_path)
-
-    res_list = []
-    coord_list = []
-    for coord_id, field_id in zip(['x', 'y'], ['longitude', 'latitude']):
-        coord_array = dataset.coords[field_id]
-        res_list.append(float(
-            (coord_array[-1] - coord_array[0]) / len(coord_array)))
-        coord_list.append(coord_array)
-
-    transform = Affine.translation(
-        *[a[0] for a in coord_list]) * Affine.scale(*res_list)
-
-    target_path_variable_id_list = []
-    for variable_id, data_array in dataset.items():
-        target_path = target_path_pattern.format(**{
+    # legacy "span" georeferencing keeps outputs identical to earlier runs
+    return netcdf_conversion.convert_dataset_variables(
+        dataset,
+        lambda variable_id: target_path_pattern.format(**{
             'date': date_str,
             'variable': variable_id
-            })
-        os.makedirs(os.path.dirname(target_path), exist_ok=True)
-        with rasterio.open(
-            target_path,
-            mode="w",
-            driver="GTiff",
-            height=len(coord_list[1]),
-            width=len(coord_list[0]),
-            count=1,
-            dtype=numpy.float32,
-            nodata=None,
-            crs="+proj=latlong",
-            transform=transform,
-            **{
-                'tiled': 'YES',
-                'COMPRESS': 'LZW',
-                'PREDICTOR': 2}) as new_dataset:
-            new_dataset.write(data_array)
-        target_path_variable_id_list.append((target_path, variable_id))
-    return target_path_variable_id_list
+            }),
+        convention='span', creation_options=creation_options)
 
 
 def main():
@@ -135,7 +110,10 @@ def main():
     parser.add_argument(
         '--filter_aoi_by_field', help=(
             'an argument of the form FIELDNAME=VALUE such as `sov_a3=AFG`'))
+    netcdf_conversion.add_creation_arguments(parser)
     args = parser.parse_args()
+    creation_options = netcdf_conversion.resolve_creation_options(
+        args.creation_profile, args.creation_options)
 
     # aoi_vector_path = 'drycorridor.shp'
     # start_date = '1979-01-01'
@@ -270,21 +248,10 @@ def main():
     LOGGER.debug(valid_mask.shape)
     LOGGER.debug(running_drought_count_array.shape)
     running_drought_count_array[~(valid_mask.transpose())] = nodata
-    new_dataset = rasterio.open(
-        raster_path,
-        'w',
-        driver='GTiff',
-        height=running_drought_count_array.shape[0],
-        width=running_drought_count_array.shape[1],
-        count=1,
-        dtype=running_drought_count_array.dtype,
-        crs='+proj=latlong',
-        transform=transform,
-        nodata=nodata,
-    )
-    new_dataset.write(running_drought_count_array, 1)
-    new_dataset.close()
-    new_dataset = None
+    netcdf_conversion.write_geotiff(
+        raster_path, running_drought_count_array, transform, nodata=nodata,
+        crs='+proj=latlong', creation_options=creation_options,
+        dtype=running_drought_count_array.dtype)
 
     LOGGER.info(
         f'All done\n'
@@ -10,12 +10,11 @@ import tempfile
 
 from osgeo import gdal
 from ecoshard import geoprocessing
-from rasterio.transform import Affine
 import geopandas
-import numpy
-import rasterio
 import xarray
 
+import netcdf_conversion
+
 try:
     from ecoshard import fetch_data
 except RuntimeError as e:
@@ -33,7 +32,8 @@ logging.getLogger('fetch_data').setLevel(logging.INFO)
 
 
 def process_era5_anomaly_to_geotiff(
-        netcdf_path, year_month_str, target_path_pattern):
+        netcdf_path, year_month_str, target_path_pattern,
+        creation_options=None):
     """Convert era5 anomaly to geotiff
 
     Args:
@@ -43,59 +43,34 @@ def process_era5_anomaly_to_geotiff(
         target_path_pattern (str): pattern that will allow the replacement
             of `variable` and `date` strings with the appropriate variable
             date strings in the netcat variables.
+        creation_options (dict): GDAL creation options, defaults to
+            ``netcdf_conversion.DEFAULT_CREATION_OPTIONS``.
 
     Returns:
         list of (file, variable_id) tuples created by this process
     """
     LOGGER.info(f'processing {netcdf_path}')
     dataset = xarray.open_dataset(netcdf_path)
-
-    res_list = []
-    coord_list = []
-    for coord_id, field_id in zip(['x', 'y'], ['longitude', 'latitude']):
-        coord_array = dataset.coords[field_id]
-        res_list.append(float(
-            (coord_array[-1] - coord_array[0]) / len(coord_array)))
-        coord_list.append(coord_array)
-
-    transform = Affine.translation(
-        *[a[0] for a in coord_list]) * Affine.scale(*res_list)
-
-    target_path_variable_id_list = []
-    for variable_id, data_array in dataset.items():
-        target_path = target_path_pattern.format(**{
+    # legacy "span" georeferencing keeps outputs identical to earlier runs
+    return netcdf_conversion.convert_dataset_variables(
+        dataset,
+        lambda variable_id: target_path_pattern.format(**{
             'year_month': year_month_str,
             'variable': variable_id
-            })
-        os.makedirs(os.path.dirname(target_path), exist_ok=True)
-        with rasterio.open(
-            target_path,
-            mode="w",
-            driver="GTiff",
-            height=len(coord_list[1]),
-            width=len(coord_list[0]),
-            count=1,
-            dtype=numpy.float32,
-            nodata=None,
-            crs="+proj=latlong",
-            transform=transform,
-            **{
-                'tiled': 'YES',
-                'COMPRESS': 'LZW',
-                'PREDICTOR': 2}) as new_dataset:
-            new_dataset.write(data_array)
-        target_path_variable_id_list.append((target_path, variable_id))
-    return target_path_variable_id_list
-
-
-def download_and_repack(year_month, target_path_pattern, aoi_path, clip_id):
+            }),
+        convention='span', creation_options=creation_options)
+
+
+def download_and_repack(
+        year_month, target_path_pattern, aoi_path, clip_id,
+        creation_options=None):
     try:
         LOGGER.info(f'fetching {year_month}')
         netcdf_path = fetch_data.fetch_file(
             'era5_anomaly', {'year_month': year_month})
         LOGGER.info(f'downloaded to {netcdf_path}')
         geotiff_path_variable_id_list = process_era5_anomaly_to_geotiff(
-            netcdf_path, year_month, target_path_pattern)
+            netcdf_path, year_month, target_path_pattern, creation_options)
         for geotiff_path, variable_id in geotiff_path_variable_id_list:
             # do the clip here
             print(geotiff_path, variable_id)
@@ -139,7 +114,10 @@ def main():
     parser.add_argument(
         '--filter_aoi_by_field', help=(
             'an argument of the form FIELDNAME=VALUE such as `sov_a3=AFG`'))
+    netcdf_conversion.add_creation_arguments(parser)
     args = parser.parse_args()
+    creation_options = netcdf_conversion.resolve_creation_options(
+        args.creation_profile, args.creation_options)
 
     path_to_aoi = scrub_windows_sep_chars(args.path_to_aoi)
     temp_dir = None
@@ -177,7 +155,8 @@ def main():
     with ThreadPoolExecutor(max_workers=50) as executor:
         _ = list(executor.map(partial(
             download_and_repack, target_path_pattern=target_path_pattern,
-            aoi_path=aoi_path, clip_id=args.filter_aoi_by_field), date_list))
+            aoi_path=aoi_path, clip_id=args.filter_aoi_by_field,
+            creation_options=creation_options), date_list))
 
     print(f'all done, files located at {target_path_pattern}')
 
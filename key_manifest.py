@@ -0,0 +1,245 @@
+"""Bulk existence checks of fetch_data keys from a listing of their prefix.
+
+Not a command line script. ``fetch_data.file_exists`` is a request per key,
+a date range over a few variables is thousands of them. A ``KeyManifest``
+lists the prefix that the keys of a variable share once, answers existence
+checks from that listing and probes with ``fetch_data.file_exists`` only the
+keys the listing doesn't have, such as days published after it was made.
+
+The listed root is a local mirror of the dataset, e.g. the workspace of
+``update_era5.py``, or an ``s3://bucket/prefix`` URL, any S3 compatible
+endpoint such as minio or moto can be given with ``endpoint_url``.
+Listings can be cached as JSON for a time to live so consecutive runs
+share one listing.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    from ecoshard import fetch_data
+except RuntimeError as e:
+    print(f'Error when loading fetch_data: {e}')
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_TTL_HOURS = 24
+# concurrent fetch_data.file_exists probes of keys missing from a listing
+PROBE_WORKERS = 16
+# stands in for the varying field to find the literal prefix of a key
+_FIELD_SENTINEL = '\0'
+
+
+def add_manifest_arguments(parser):
+    """Add ``--manifest_root`` and its options to `parser`.
+
+    Use ``manifest_from_args(dataset_id, args)`` on the parsed arguments.
+    """
+    parser.add_argument(
+        '--manifest_root', help=(
+            'local directory or s3://bucket/prefix URL the dataset keys are '
+            'stored under, if set each variable is listed once per run '
+            'instead of testing every day for existence'))
+    parser.add_argument(
+        '--manifest_endpoint_url', help=(
+            'endpoint of an S3 compatible store for an s3:// '
+            '--manifest_root, e.g. a minio server'))
+    parser.add_argument(
+        '--manifest_cache_dir', help=(
+            'if set, listings are cached in this directory and reused '
+            'until they are --manifest_ttl_hours old'))
+    parser.add_argument(
+        '--manifest_ttl_hours', type=float, default=DEFAULT_TTL_HOURS,
+        help='hours a cached listing is reused for')
+
+
+def manifest_from_args(dataset_id, args):
+    """``KeyManifest`` of `dataset_id` from ``add_manifest_arguments``."""
+    return KeyManifest(
+        dataset_id, root=args.manifest_root,
+        endpoint_url=args.manifest_endpoint_url,
+        cache_dir=args.manifest_cache_dir, ttl_hours=args.manifest_ttl_hours)
+
+
+def dataset_key(dataset_id, dataset_args):
+    """Key of the object `dataset_args` refer to in a fetch_data dataset."""
+    return fetch_data.GLOBAL_CONFIG[dataset_id]['file_format'].format(
+        **dataset_args)
+
+
+def list_keys(root, prefix, endpoint_url=None):
+    """List the keys under `root` that start with `prefix`.
+
+    Args:
+        root (str): local directory or ``s3://bucket/prefix`` URL.
+        prefix (str): "/" separated key prefix relative to `root`.
+        endpoint_url (str): endpoint of an S3 compatible store, None for
+            AWS or a local `root`.
+
+    Returns:
+        list of "/" separated keys relative to `root`.
+    """
+    if root.startswith('s3://'):
+        # only needed for object store roots
+        import boto3
+        bucket, _, root_prefix = root[len('s3://'):].partition('/')
+        root_prefix = root_prefix.strip('/')
+        if root_prefix:
+            root_prefix += '/'
+        client = boto3.client('s3', endpoint_url=endpoint_url)
+        key_list = []
+        for page in client.get_paginator('list_objects_v2').paginate(
+                Bucket=bucket, Prefix=root_prefix+prefix):
+            key_list.extend(
+                item['Key'][len(root_prefix):]
+                for item in page.get('Contents', []))
+        return key_list
+
+    key_list = []
+    for dir_path, _, file_list in os.walk(
+            os.path.join(root, os.path.dirname(prefix))):
+        relative_dir = os.path.relpath(dir_path, root).replace(os.sep, '/')
+        for filename in file_list:
+            key = (
+                filename if relative_dir == '.'
+                else f'{relative_dir}/{filename}')
+            if key.startswith(prefix):
+                key_list.append(key)
+    return key_list
+
+
+class KeyManifest:
+    """Existence of the keys of a fetch_data dataset from prefix listings.
+
+    A key is ``GLOBAL_CONFIG[dataset_id]['file_format']`` formatted with the
+    dataset args. The args other than `vary_field` pick a prefix, e.g. a
+    variable's days, that is listed the first time it is needed.
+    """
+
+    def __init__(
+            self, dataset_id, root=None, file_format=None, vary_field='date',
+            endpoint_url=None, cache_dir=None, ttl_hours=DEFAULT_TTL_HOURS):
+        """Set up the manifest, nothing is listed until it is queried.
+
+        Args:
+            dataset_id (str): fetch_data dataset, e.g. "era5_daily".
+            root (str): local directory or ``s3://bucket/prefix`` URL the
+                keys are stored under, if None every key is probed with
+                ``fetch_data.file_exists``.
+            file_format (str): key format, defaults to the dataset's
+                ``fetch_data.GLOBAL_CONFIG`` entry.
+            vary_field (str): field of the format that varies between the
+                keys of one listing.
+            endpoint_url (str): see ``list_keys``.
+            cache_dir (str): if not None, listings are cached here as JSON.
+            ttl_hours (float): hours a cached listing is reused for.
+        """
+        self.dataset_id = dataset_id
+        self.root = root
+        if file_format is None and root is not None:
+            file_format = fetch_data.GLOBAL_CONFIG[dataset_id]['file_format']
+        self.file_format = file_format
+        self.vary_field = vary_field
+        self.endpoint_url = endpoint_url
+        self.cache_dir = cache_dir
+        self.ttl_hours = ttl_hours
+        self._key_set_by_prefix = {}
+        # date ranges processed in threads share a manifest
+        self._lock = threading.Lock()
+
+    def key(self, dataset_args):
+        """Key of the object `dataset_args` refer to."""
+        return self.file_format.format(**dataset_args)
+
+    def _prefix(self, dataset_args):
+        return self.file_format.format(
+            **{**dataset_args, self.vary_field: _FIELD_SENTINEL}).split(
+            _FIELD_SENTINEL)[0]
+
+    def _cache_path(self, prefix):
+        cache_key = hashlib.sha1(repr((
+            self.root, self.endpoint_url, prefix)).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'manifest_{cache_key}.json')
+
+    def _key_set(self, prefix):
+        """Listed keys under `prefix`, listed or loaded once per instance."""
+        with self._lock:
+            if prefix in self._key_set_by_prefix:
+                return self._key_set_by_prefix[prefix]
+            cache_path = None
+            if self.cache_dir is not None:
+                cache_path = self._cache_path(prefix)
+                if os.path.exists(cache_path):
+                    with open(cache_path) as cache_file:
+                        cached = json.load(cache_file)
+                    cache_age = time.time() - cached['listed_at']
+                    if cache_age < self.ttl_hours * 3600:
+                        key_set = set(cached['key_list'])
+                        self._key_set_by_prefix[prefix] = key_set
+                        return key_set
+
+            start_time = time.time()
+            key_list = list_keys(self.root, prefix, self.endpoint_url)
+            LOGGER.info(
+                f'listed {len(key_list)} keys under {self.root}/{prefix} in '
+                f'{time.time()-start_time:.2f}s')
+            if cache_path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                temp_path = f'{cache_path}.{os.getpid()}.tmp'
+                with open(temp_path, 'w') as cache_file:
+                    json.dump({
+                        'root': self.root,
+                        'prefix': prefix,
+                        'listed_at': start_time,
+                        'key_list': key_list}, cache_file)
+                os.replace(temp_path, cache_path)
+            key_set = set(key_list)
+            self._key_set_by_prefix[prefix] = key_set
+            return key_set
+
+    def exists(self, dataset_args):
+        """True if the key of `dataset_args` exists.
+
+        Answered from the listing of its prefix, a key that isn't listed is
+        probed with ``fetch_data.file_exists``.
+        """
+        return not self.missing([dataset_args])
+
+    def missing(self, dataset_args_list):
+        """Return the dataset args whose keys don't exist.
+
+        Args:
+            dataset_args_list (list): dicts of the args of the dataset's
+                file format.
+
+        Returns:
+            list of the elements of `dataset_args_list` that don't exist, in
+            order.
+        """
+        if self.root is None:
+            unlisted_args_list = list(dataset_args_list)
+        else:
+            unlisted_args_list = [
+                dataset_args for dataset_args in dataset_args_list
+                if self.key(dataset_args) not in self._key_set(
+                    self._prefix(dataset_args))]
+        if not unlisted_args_list:
+            return []
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+            exists_list = list(executor.map(
+                lambda dataset_args: fetch_data.file_exists(
+                    self.dataset_id, dataset_args),
+                unlisted_args_list))
+        missing_args_list = []
+        for dataset_args, exists in zip(unlisted_args_list, exists_list):
+            if not exists:
+                missing_args_list.append(dataset_args)
+            elif self.root is not None:
+                # published after the listing, remember it for this run
+                self._key_set(self._prefix(dataset_args)).add(
+                    self.key(dataset_args))
+        return missing_args_list
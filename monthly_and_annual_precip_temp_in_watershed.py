@@ -1,4 +1,5 @@
 """See `python scriptname.py --help"""
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import calendar
 import collections
@@ -13,17 +14,20 @@ import os
 import sys
 import time
 import tempfile
+import threading
 
-from osgeo import osr
 from ecoshard import geoprocessing
 from ecoshard import taskgraph
 from osgeo import gdal
 import numpy
 
-try:
-    from ecoshard import fetch_data
-except RuntimeError as e:
-    print(f'Error when loading fetch_data: {e}')
+from clip_cache import ClipCache
+import accumulator_ops
+import climatology
+import daily_cube
+import key_manifest
+import stage_profile
+import window_read
 
 logging.basicConfig(
     level=logging.INFO,
@@ -39,8 +43,6 @@ DATASET_ID = 'era5_daily'
 VARIABLE_ID_LIST = ['sum_tp_mm', 'mean_t2m_c']
 MASK_NODATA = -9999
 
-ERA5_RESOLUTION_M = 27830
-ERA5_RESOLUTION_DEG = 0.25
 CSV_BANDS_TO_DISPLAY = ['mean_precip (mm)', 'mean_2m_air_temp (C)']
 
 
@@ -76,37 +78,66 @@ def build_monthly_ranges(start_date, end_date):
 
 
 def daterange(start_date, end_date):
-    """Generator produces all ``datetimes`` between start and end."""
-    if start_date == end_date:
-        yield start_date
-        return
-    for n in range(int((end_date - start_date).days)):
+    """Generator produces all ``datetimes`` from start to end inclusive."""
+    for n in range(int((end_date - start_date).days) + 1):
         yield start_date + datetime.timedelta(n)
 
 
-def _sum_op(*array_list):
-    LOGGER.debug(len(array_list))
-    valid_mask = array_list[0] != MASK_NODATA
-    LOGGER.debug(valid_mask.shape)
-    result = numpy.sum(array_list, axis=0)
-    LOGGER.debug(result.shape)
-    result[~valid_mask] = MASK_NODATA
-    return result
+class _ValidMean:
+    """Running float64 mean of the non-nodata pixels of a series of arrays."""
 
+    def __init__(self, nodata):
+        self.nodata = nodata
+        self.value_sum = 0.0
+        self.value_count = 0
 
-def _mean_op(*array_list):
-    valid_mask = array_list[0] != MASK_NODATA
-    result = numpy.sum(array_list, axis=0) / len(array_list)
-    result[~valid_mask] = MASK_NODATA
-    return result
+    def add(self, array):
+        valid_array = array[array != self.nodata]
+        self.value_sum += numpy.sum(valid_array, dtype=numpy.float64)
+        self.value_count += valid_array.size
 
+    def mean(self):
+        """Mean of the valid pixels, ``MASK_NODATA`` if there were none."""
+        if self.value_count > 0:
+            return self.value_sum / self.value_count
+        return MASK_NODATA
 
-def mean_of_raster_op(raster_path):
-    raster_array = gdal.OpenEx(raster_path, gdal.OF_RASTER).ReadAsArray()
-    valid_array = raster_array[raster_array != MASK_NODATA]
-    if valid_array.size > 0:
-        return numpy.mean(valid_array)
-    return -9999
+
+def _reduce_month(raster_path_band_list, reduce_op, target_path):
+    """Reduce daily rasters with `reduce_op` and return the result's mean.
+
+    The mean of the target's valid pixels is tallied as
+    ``raster_calculator`` writes each block, so the target isn't read back.
+
+    Args:
+        raster_path_band_list (list): (path, band) daily rasters.
+        reduce_op (callable): ``accumulator_ops`` op to reduce with.
+        target_path (str): path to the float32 raster to create.
+
+    Returns:
+        mean of the valid pixels of the target.
+    """
+    valid_mean = _ValidMean(MASK_NODATA)
+
+    def _reduce_and_tally_op(nodata, *array_list):
+        result = reduce_op(nodata, *array_list)
+        valid_mean.add(result)
+        return result
+
+    geoprocessing.raster_calculator(
+        [(MASK_NODATA, 'raw')] + raster_path_band_list,
+        _reduce_and_tally_op, target_path, gdal.GDT_Float32, MASK_NODATA)
+    return valid_mean.mean()
+
+
+def _reduce_month_from_cube(cube_dir, date_list, reduce_op, target_path):
+    """``_reduce_month`` over days of a ``daily_cube.DailyCube``."""
+    cube = daily_cube.DailyCube(cube_dir)
+    result = reduce_op(cube.nodata, *cube.read(date_list))
+    cube.write_raster(result, target_path)
+    valid_mean = _ValidMean(cube.nodata)
+    valid_mean.add(result)
+    return valid_mean.mean()
 
 
 def main():
@@ -126,7 +157,35 @@ def main():
     parser.add_argument(
         '--filter_aoi_by_field', help=(
             'an argument of the form FIELDNAME=VALUE such as `sov_a3=AFG`'))
+    parser.add_argument(
+        '--cube_cache_dir', help=(
+            'if set, clipped days are kept in memory-mapped per-AOI cubes in '
+            'this directory and reused across runs and date ranges'))
+    parser.add_argument(
+        '--climatology_dir', help=(
+            'directory of per-pixel monthly climatology rasters (mean, std, '
+            'count) of the AOI, standardized anomaly rasters of each month '
+            'are written against them'))
+    parser.add_argument(
+        '--update_climatology', action='store_true', help=(
+            'fold the months of this run into the --climatology_dir '
+            'climatologies first, months they already include are skipped'))
+    key_manifest.add_manifest_arguments(parser)
+    parser.add_argument(
+        '--window_read_root', help=(
+            'local directory, s3://bucket/prefix or http(s):// URL of tiled '
+            'copies of the dataset keys, if set only the AOI window of each '
+            'day is read from it with range requests instead of '
+            'downloading the whole day'))
+    parser.add_argument(
+        '--clip_cache_dir', default='era5_clip_cache', help=(
+            'directory the clipped days are kept in by AOI, variable and '
+            'date, every date range of this and later runs shares them'))
+    stage_profile.add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.update_climatology and not args.climatology_dir:
+        raise ValueError('--update_climatology needs --climatology_dir')
+    profile = stage_profile.profile_from_args(args)
 
     temp_dir = None
     if args.filter_aoi_by_field:
@@ -144,11 +203,41 @@ def main():
     else:
         aoi_path = args.path_to_aoi
 
-    result_workspace_path_list = []
-    for start_date, end_date in args.date_range:
-        result_workspace_path = process_date_range(
-            aoi_path, start_date, end_date)
-        result_workspace_path_list.append(result_workspace_path)
+    manifest = key_manifest.manifest_from_args(DATASET_ID, args)
+    clip_cache = ClipCache(
+        args.clip_cache_dir, aoi_path, DATASET_ID, MASK_NODATA,
+        window_read_root=args.window_read_root)
+    task_graph = taskgraph.TaskGraph(
+        args.clip_cache_dir, multiprocessing.cpu_count(), 15.0)
+    climatology_months = _ClimatologyMonths()
+    profile.start_summary()
+    try:
+        # date ranges are scheduled side by side on one graph, days they
+        # share are clipped once and their months are reduced together
+        with ThreadPoolExecutor(
+                max_workers=len(args.date_range)) as executor:
+            result_workspace_path_list = list(executor.map(
+                lambda date_range: process_date_range(
+                    aoi_path, *date_range,
+                    cube_cache_dir=args.cube_cache_dir,
+                    climatology_dir=args.climatology_dir,
+                    update_climatology=args.update_climatology,
+                    manifest=manifest, clip_cache=clip_cache,
+                    task_graph=task_graph, profile=profile,
+                    climatology_months=climatology_months),
+                args.date_range))
+        if args.climatology_dir is not None:
+            # once every date range has added its months
+            climatology_months.schedule(
+                task_graph, args.climatology_dir, args.update_climatology)
+        if clip_cache.window_read_task_list:
+            LOGGER.info(window_read.transfer_summary([
+                clip_task.get()
+                for clip_task in clip_cache.window_read_task_list]))
+    finally:
+        task_graph.join()
+        task_graph.close()
+        profile.write_report()
 
     if temp_dir is not None:
         shutil.rmtree(temp_dir, ignore_errors=True)
@@ -158,8 +247,189 @@ def main():
         'in:\n\t* ' + '\n\t* '.join(result_workspace_path_list))
 
 
-def process_date_range(path_to_aoi, start_date, end_date):
-    """Process a given date range and return the workspace."""
+def _schedule_month_reduction(
+        task_graph, variable_list_set, cube, date_str_list, reduce_op,
+        target_path, profile):
+    """Add the task that reduces a month of a variable to a raster.
+
+    The task's result is the mean of the raster's valid pixels.
+
+    Args:
+        task_graph (taskgraph.TaskGraph): graph to add the task to.
+        variable_list_set (dict): the variable's 'rasters' (path, band)
+            list and the 'tasks' that clip them.
+        cube (daily_cube.DailyCube): cube of the variable, if None the
+            clipped rasters are stacked with ``raster_calculator``.
+        date_str_list (list): days of the month, the clipped days of the
+            month are appended to `cube` first.
+        reduce_op (callable): ``accumulator_ops`` op to reduce with.
+        target_path (str): path to the raster to create.
+        profile (stage_profile.StageProfile): records the appends.
+
+    Returns:
+        the reduction's taskgraph.Task
+    """
+    if cube is None:
+        return task_graph.add_task(
+            func=_reduce_month,
+            args=(variable_list_set['rasters'], reduce_op, target_path),
+            dependent_task_list=variable_list_set['tasks'],
+            target_path_list=[target_path],
+            store_result=True,
+            task_name=f'reduce {target_path}')
+
+    # appends happen here, in one process, so the cube has a single writer
+    for date_str, (clip_path, _), clip_task in zip(
+            variable_list_set['dates'], variable_list_set['rasters'],
+            variable_list_set['tasks']):
+        clip_task.join()
+        with profile.stage('append_cube'):
+            cube.append(date_str, clip_path)
+    return task_graph.add_task(
+        func=_reduce_month_from_cube,
+        args=(cube.cube_dir, date_str_list, reduce_op, target_path),
+        target_path_list=[target_path],
+        store_result=True,
+        task_name=f'reduce {target_path}')
+
+
+class _ClimatologyMonths:
+    """Monthly rasters of the date ranges of a run, by climatology prefix.
+
+    Date ranges scheduled from several threads on one task graph add their
+    months here and ``schedule`` is called once they all have, so every
+    climatology is updated by a single task with the months of all of them
+    and every anomaly is taken against that update. Separate updates of a
+    climatology would race and the last one to finish would drop the
+    other's months.
+    """
+
+    def __init__(self):
+        self._month_list_by_prefix = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, prefix, month_list):
+        """Add (year-month, raster path, task that makes it, anomaly path)
+        tuples of the climatology named `prefix`, see
+        ``climatology.climatology_path``.
+        """
+        with self._lock:
+            self._month_list_by_prefix[prefix].extend(month_list)
+
+    def schedule(self, task_graph, climatology_dir, update_climatology):
+        """Add the climatology update and anomaly tasks of every prefix.
+
+        Args:
+            task_graph (taskgraph.TaskGraph): graph to add the tasks to.
+            climatology_dir (str): directory of the climatologies.
+            update_climatology (bool): if True the months are folded into
+                the climatologies before the anomalies are taken.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            for prefix, month_list in sorted(
+                    self._month_list_by_prefix.items()):
+                _schedule_climatology(
+                    task_graph, month_list, climatology_dir, prefix,
+                    update_climatology)
+            self._month_list_by_prefix.clear()
+
+
+def _schedule_climatology(
+        task_graph, month_list, climatology_dir, prefix,
+        update_climatology):
+    """Add the climatology update and anomaly tasks of a variable.
+
+    Args:
+        task_graph (taskgraph.TaskGraph): graph to add the tasks to.
+        month_list (list): (year-month, raster path, task that makes it,
+            anomaly path) of the variable's monthly rasters, a month may
+            be listed by several date ranges.
+        climatology_dir (str): directory of the climatologies.
+        prefix (str): climatology name prefix, see
+            ``climatology.climatology_path``.
+        update_climatology (bool): if True the months are folded into the
+            climatologies before the anomalies are taken.
+
+    Returns:
+        None
+    """
+    month_list_by_month_id = collections.defaultdict(list)
+    for month in month_list:
+        month_list_by_month_id[month[0][5:7]].append(month)
+
+    for month_id, calendar_month_list in sorted(
+            month_list_by_month_id.items()):
+        climatology_path = climatology.climatology_path(
+            climatology_dir, prefix, month_id)
+        dependent_task_list = [
+            raster_task for _, _, raster_task, _ in calendar_month_list]
+        if update_climatology:
+            dependent_task_list = [task_graph.add_task(
+                func=climatology.update_climatology,
+                args=(climatology_path, {
+                    month_key: raster_path
+                    for month_key, raster_path, _, _ in calendar_month_list}),
+                dependent_task_list=dependent_task_list,
+                # the climatology may change between runs, it skips the
+                # months it has itself
+                transient_run=True,
+                task_name=f'update climatology {climatology_path}')]
+        elif not os.path.exists(climatology_path):
+            LOGGER.warning(
+                f'no climatology {climatology_path}, no anomalies for month '
+                f'{month_id}')
+            continue
+        for _, raster_path, _, anomaly_path in calendar_month_list:
+            task_graph.add_task(
+                func=climatology.standardized_anomaly,
+                args=(climatology_path, raster_path, anomaly_path),
+                dependent_task_list=dependent_task_list,
+                target_path_list=[anomaly_path],
+                task_name=f'anomaly {anomaly_path}')
+
+
+def process_date_range(
+        path_to_aoi, start_date, end_date, cube_cache_dir=None,
+        climatology_dir=None, update_climatology=False, manifest=None,
+        clip_cache=None, task_graph=None, profile=None,
+        climatology_months=None):
+    """Process a given date range and return the workspace.
+
+    Args:
+        path_to_aoi (str): path to the AOI vector.
+        start_date (str): first day in the form YYYY-MM-DD.
+        end_date (str): last day in the form YYYY-MM-DD.
+        cube_cache_dir (str): if not None, clipped days are appended to
+            ``daily_cube`` cubes in this directory and monthly rasters are
+            reduced from the cubes, days already in them aren't fetched.
+        climatology_dir (str): if not None, standardized anomaly rasters of
+            each month are written against the per-pixel climatologies in
+            this directory.
+        update_climatology (bool): if True, the months are folded into the
+            `climatology_dir` climatologies first.
+        manifest (key_manifest.KeyManifest): answers whether the days
+            exist, if None every day is probed with
+            ``fetch_data.file_exists``.
+        clip_cache (clip_cache.ClipCache): cache the days are clipped into,
+            shared by the date ranges of a run, if None they are clipped
+            into the workspace.
+        task_graph (taskgraph.TaskGraph): graph the date range is scheduled
+            on, shared by the date ranges of a run. If None the date range
+            gets its own that is closed before returning, otherwise the
+            caller closes it.
+        profile (stage_profile.StageProfile): if not None, the tasks and
+            stages of the date range are recorded to it.
+        climatology_months (_ClimatologyMonths): if not None, the months
+            of the date range are added to it and the caller schedules the
+            climatology tasks of all the date ranges sharing `task_graph`,
+            otherwise they are scheduled here.
+
+    Returns:
+        path to the workspace of the results.
+    """
     monthly_date_range_list = build_monthly_ranges(
         start_date, end_date)
 
@@ -169,11 +439,20 @@ def process_date_range(path_to_aoi, start_date, end_date):
         f'month_and_annual_precp_temp_{vector_basename}_{start_date}_'
         f'{end_date}')
     workspace_dir = f'workspace_{project_basename}'
-    task_graph = taskgraph.TaskGraph(
-        workspace_dir, multiprocessing.cpu_count(), 15.0)
-
-    clip_dir = os.path.join(workspace_dir, 'clip')
-    os.makedirs(clip_dir, exist_ok=True)
+    owns_task_graph = task_graph is None
+    if owns_task_graph:
+        task_graph = taskgraph.TaskGraph(
+            workspace_dir, multiprocessing.cpu_count(), 15.0)
+    if profile is None:
+        profile = stage_profile.StageProfile()
+    task_graph = profile.wrap(task_graph)
+
+    if clip_cache is None:
+        clip_cache = ClipCache(
+            os.path.join(workspace_dir, 'clip'), path_to_aoi, DATASET_ID,
+            MASK_NODATA)
+    if manifest is None:
+        manifest = key_manifest.KeyManifest(DATASET_ID)
     monthly_precip_dir = os.path.join(
         workspace_dir, 'monthly_precip_rasters')
     os.makedirs(monthly_precip_dir, exist_ok=True)
@@ -181,7 +460,16 @@ def process_date_range(path_to_aoi, start_date, end_date):
         workspace_dir, 'monthly_temp_rasters')
     os.makedirs(monthly_temp_dir, exist_ok=True)
 
-    monthly_mean_list = []
+    cube_by_variable = collections.defaultdict(lambda: None)
+    if cube_cache_dir is not None:
+        cube_by_variable.update({
+            variable_id: daily_cube.open_cube(daily_cube.aoi_cube_dir(
+                cube_cache_dir, path_to_aoi, DATASET_ID, variable_id))
+            for variable_id in VARIABLE_ID_LIST})
+
+    # every month's clips are scheduled before any is reduced so they all
+    # download in parallel
+    month_plan_list = []
     for start_date, end_date in monthly_date_range_list:
         month_start_day = datetime.datetime.strptime(start_date, '%Y-%m-%d')
         month_end_day = datetime.datetime.strptime(end_date, '%Y-%m-%d')
@@ -190,112 +478,83 @@ def process_date_range(path_to_aoi, start_date, end_date):
             variable_id: collections.defaultdict(list)
             for variable_id in VARIABLE_ID_LIST}
         existance_set = {}
-        for date in daterange(month_start_day, month_end_day):
+        date_str_list = [
+            date.strftime('%Y-%m-%d')
+            for date in daterange(month_start_day, month_end_day)]
+        for date_str in date_str_list:
             for variable_id in VARIABLE_ID_LIST:
-                date_str = date.strftime('%Y-%m-%d')
-                clip_path = os.path.join(
-                    clip_dir, f'clip_{DATASET_ID}_{variable_id}_{date_str}')
-
-                vector_info = geoprocessing.get_vector_info(
-                    path_to_aoi)
-                vector_projection = osr.SpatialReference()
-                vector_projection.ImportFromWkt(vector_info['projection_wkt'])
-                if vector_projection.IsProjected():
-                    clip_cell_size = (ERA5_RESOLUTION_M, -ERA5_RESOLUTION_M)
-                else:
-                    clip_cell_size = (ERA5_RESOLUTION_DEG, -ERA5_RESOLUTION_DEG)
-
+                cube = cube_by_variable[variable_id]
+                if cube is not None and date_str in cube:
+                    continue
                 dataset_args = {
                     'date': date_str,
                     'variable': variable_id
                 }
-
-                fetch_and_clip_args = (
-                    DATASET_ID, dataset_args,
-                    clip_cell_size,
-                    path_to_aoi, clip_path)
-
-                exists_task = task_graph.add_task(
-                    func=fetch_data.file_exists,
-                    args=(DATASET_ID, dataset_args),
-                    store_result=True,
-                    transient_run=True,
-                    task_name=(
-                        f'test if {DATASET_ID}/{variable_id}/{date_str} '
-                        'exists'))
                 existance_set[f'{DATASET_ID}/{variable_id}/{date_str}'] = (
-                    exists_task, variable_id, (fetch_and_clip_args, clip_path))
+                    variable_id, dataset_args)
 
+        with profile.stage('check_exists'):
+            missing_args_list = manifest.missing([
+                dataset_args for _, dataset_args in existance_set.values()])
         missing_file_list = [
-            variable_str
-            for variable_str, (_, exist_task, _) in existance_set.items()
-            if not exists_task.get()]
+            f'{DATASET_ID}/{dataset_args["variable"]}/{dataset_args["date"]}'
+            for dataset_args in missing_args_list]
         if missing_file_list:
-            task_graph.join()
-            task_graph.close()
+            if owns_task_graph:
+                task_graph.join()
+                task_graph.close()
             raise RuntimeError(
                 'The following data cannot be found in the cloud: ' +
                 ', '.join(missing_file_list))
 
-        for _, variable_id, (fetch_args, clip_path) in existance_set.values():
-            LOGGER.info(f'clip path: {clip_path}')
-            clip_task = task_graph.add_task(
-                func=fetch_data.fetch_and_clip,
-                args=fetch_args,
-                kwargs={
-                    'all_touched': True,
-                    'target_mask_value': MASK_NODATA},
-                target_path_list=[clip_path],
-                task_name=f'fetch and clip {clip_path}')
-            raster_list_set[variable_id]['rasters'].append((clip_path, 1))
-            raster_list_set[variable_id]['tasks'].append(clip_task)
+        with profile.stage('schedule_clips'):
+            for variable_id, dataset_args in existance_set.values():
+                clip_path, clip_task = clip_cache.schedule(
+                    task_graph, dataset_args)
+                LOGGER.info(f'clip path: {clip_path}')
+                raster_list_set[variable_id]['dates'].append(
+                    dataset_args['date'])
+                raster_list_set[variable_id]['rasters'].append(
+                    (clip_path, 1))
+                raster_list_set[variable_id]['tasks'].append(clip_task)
+        month_plan_list.append(
+            (start_date, end_date, date_str_list, raster_list_set))
 
+    monthly_mean_list = []
+    monthly_raster_list_by_variable = collections.defaultdict(list)
+    for start_date, end_date, date_str_list, raster_list_set in \
+            month_plan_list:
         # calculate monthly precip sum
         month_precip_path = os.path.join(monthly_precip_dir, (
             f"{vector_basename}_monthly_precip_sum_"
             f"{start_date}_{end_date}.tif"))
 
         LOGGER.info(raster_list_set['sum_tp_mm']['rasters'])
-        month_precip_task = task_graph.add_task(
-            func=geoprocessing.raster_calculator,
-            args=(
-                raster_list_set['sum_tp_mm']['rasters'], _sum_op,
-                month_precip_path, gdal.GDT_Float32, MASK_NODATA),
-            dependent_task_list=raster_list_set['sum_tp_mm']['tasks'],
-            target_path_list=[month_precip_path],
-            task_name=f'sum {month_precip_path}')
-
-        precip_mean_task = task_graph.add_task(
-            func=mean_of_raster_op,
-            args=(month_precip_path,),
-            store_result=True,
-            dependent_task_list=[month_precip_task],
-            task_name=f'mean of {month_precip_path}')
+        month_precip_task = _schedule_month_reduction(
+            task_graph, raster_list_set['sum_tp_mm'],
+            cube_by_variable['sum_tp_mm'], date_str_list,
+            accumulator_ops.sum_op, month_precip_path, profile)
 
         # calculate monthly temp mean
         month_temp_path = os.path.join(monthly_temp_dir, (
             f"{vector_basename}_monthly_temp_mean_"
             f"{start_date}_{end_date}.tif"))
-        month_temp_task = task_graph.add_task(
-            func=geoprocessing.raster_calculator,
-            args=(
-                raster_list_set['mean_t2m_c']['rasters'], _mean_op,
-                month_temp_path, gdal.GDT_Float32, MASK_NODATA),
-            dependent_task_list=raster_list_set['mean_t2m_c']['tasks'],
-            target_path_list=[month_temp_path],
-            task_name=f'sum {month_temp_path}')
-
-        temp_mean_task = task_graph.add_task(
-            func=mean_of_raster_op,
-            args=(month_temp_path,),
-            store_result=True,
-            dependent_task_list=[month_temp_task],
-            task_name=f'mean of {month_temp_path}')
+        month_temp_task = _schedule_month_reduction(
+            task_graph, raster_list_set['mean_t2m_c'],
+            cube_by_variable['mean_t2m_c'], date_str_list,
+            accumulator_ops.mean_op, month_temp_path, profile)
 
         year = start_date[:4]
         month = start_date[5:7]
         monthly_mean_list.append(
-            (year, month, precip_mean_task, temp_mean_task))
+            (year, month, month_precip_task, month_temp_task))
+        # a partial month at either end of the range isn't a monthly value
+        if start_date[8:] == '01' and int(end_date[8:]) == (
+                calendar.monthrange(int(year), int(month))[1]):
+            monthly_raster_list_by_variable['precip'].append(
+                (f'{year}-{month}', month_precip_path, month_precip_task))
+            monthly_raster_list_by_variable['temp'].append(
+                (f'{year}-{month}', month_temp_path, month_temp_task))
 
     # create table that lists precip and temp means per month
     target_base = (
@@ -307,12 +566,15 @@ def process_date_range(path_to_aoi, start_date, end_date):
     precip_by_year = collections.defaultdict(list)
     precip_by_month = collections.defaultdict(list)
     temp_by_month = collections.defaultdict(list)
-    with open(target_table_path, 'w') as monthly_table_file:
+    # the months are waited for first so the write is timed on its own
+    monthly_value_list = [
+        (year, month, precip_task.get(), temp_task.get())
+        for year, month, precip_task, temp_task in monthly_mean_list]
+    with profile.stage('write_tables'), \
+            open(target_table_path, 'w') as monthly_table_file:
         monthly_table_file.write(
             'date,' + ','.join(CSV_BANDS_TO_DISPLAY) + '\n')
-        for year, month, precip_task, temp_task in monthly_mean_list:
-            precip_val = precip_task.get()
-            temp_val = temp_task.get()
+        for year, month, precip_val, temp_val in monthly_value_list:
             monthly_table_file.write(
                 f'{year}-{month},{precip_val},{temp_val}\n')
             precip_by_year[year].append(precip_val)
@@ -327,8 +589,8 @@ def process_date_range(path_to_aoi, start_date, end_date):
             f"{vector_basename}_monthly_{table_type}_normal_"
             f"{start_date}_{end_date}.csv")
         target_table_path = os.path.join(workspace_dir, f"{target_base}.csv")
-        with open(monthly_normal_table_path, 'w') as \
-                monthly_normal_table:
+        with profile.stage('write_tables'), \
+                open(monthly_normal_table_path, 'w') as monthly_normal_table:
             monthly_normal_table.write(f'month,avg {table_type}\n')
             for month_id, data_list in sorted(dict_by_month.items()):
                 monthly_normal_table.write(
@@ -339,7 +601,8 @@ def process_date_range(path_to_aoi, start_date, end_date):
         f"{start_date}_{end_date}")
     target_table_path = os.path.join(workspace_dir, f"{target_base}.csv")
     print(f'generating summary table to {target_table_path}')
-    with open(target_table_path, 'w') as table_file:
+    with profile.stage('write_tables'), \
+            open(target_table_path, 'w') as table_file:
         table_file.write(f'date,yearly sum of {CSV_BANDS_TO_DISPLAY[0]}\n')
         total_sum = 0
         total_months = 0
@@ -376,8 +639,9 @@ def process_date_range(path_to_aoi, start_date, end_date):
     _ = task_graph.add_task(
         func=geoprocessing.raster_calculator,
         args=(
-            precip_raster_path_list, _sum_op,
-            total_precip_path, gdal.GDT_Float32, MASK_NODATA),
+            [(MASK_NODATA, 'raw')] + precip_raster_path_list,
+            accumulator_ops.sum_op, total_precip_path, gdal.GDT_Float32,
+            MASK_NODATA),
         target_path_list=[total_precip_path],
         task_name=f'generate total precip {total_precip_path}')
 
@@ -385,14 +649,37 @@ def process_date_range(path_to_aoi, start_date, end_date):
     _ = task_graph.add_task(
         func=geoprocessing.raster_calculator,
         args=(
-            temp_raster_path_list, _mean_op,
-            total_temp_mean_path, gdal.GDT_Float32, MASK_NODATA),
+            [(MASK_NODATA, 'raw')] + temp_raster_path_list,
+            accumulator_ops.mean_op, total_temp_mean_path, gdal.GDT_Float32,
+            MASK_NODATA),
         dependent_task_list=raster_list_set['mean_t2m_c']['tasks'],
         target_path_list=[total_temp_mean_path],
         task_name=f'man total temp {total_temp_mean_path}')
 
-    task_graph.join()
-    task_graph.close()
+    if climatology_dir is not None:
+        owns_climatology_months = climatology_months is None
+        if owns_climatology_months:
+            climatology_months = _ClimatologyMonths()
+        for variable_label, monthly_raster_list in \
+                monthly_raster_list_by_variable.items():
+            anomaly_dir = os.path.join(
+                workspace_dir, f'monthly_{variable_label}_anomaly_rasters')
+            os.makedirs(anomaly_dir, exist_ok=True)
+            climatology_months.add(
+                f'{vector_basename}_{variable_label}', [
+                    (month_key, raster_path, raster_task, os.path.join(
+                        anomaly_dir,
+                        f'{os.path.splitext(os.path.basename(raster_path))[0]}'
+                        '_anomaly.tif'))
+                    for month_key, raster_path, raster_task
+                    in monthly_raster_list])
+        if owns_climatology_months:
+            climatology_months.schedule(
+                task_graph, climatology_dir, update_climatology)
+
+    if owns_task_graph:
+        task_graph.join()
+        task_graph.close()
     return workspace_dir
 
 
@@ -1,22 +1,31 @@
 """See `python scriptname.py --help"""
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import glob
+import json
+import os
+import sqlite3
+import sys
+
+import cftime
+import netCDF4
+import numpy
 import rioxarray
 import xarray
 
+TIME_FIELDS = ['time', 't']
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Dump netcdf info on a file to command line.')
-    parser.add_argument('raster_path', help='path to netcdf file')
-    args = parser.parse_args()
+
+def print_info(raster_path):
+    """Print the full xarray view of `raster_path` and all its attributes."""
     decode_times = True
     while True:
         try:
             print(rioxarray.open_rasterio(
-                args.raster_path, decode_times=decode_times))
+                raster_path, decode_times=decode_times))
             print('DETAILS OF ALL VARS: ')
             nc_file = xarray.open_dataset(
-                args.raster_path, decode_times=decode_times)
+                raster_path, decode_times=decode_times)
             for var in nc_file.variables:
                 print(f"{var}:")
                 for attr_name, attr_value in nc_file[var].attrs.items():
@@ -39,5 +48,219 @@ def main():
             decode_times = False
 
 
+def _json_default(value):
+    """Make numpy attribute values json serializable."""
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+
+def _time_range(nc_file):
+    """Decode only the first and last value of the time variable.
+
+    Returns:
+        dict of the time variable name, start and end iso dates, calendar,
+        units and number of steps, or None if there is no time variable.
+    """
+    time_var = None
+    for var_name, var in nc_file.variables.items():
+        if var_name in TIME_FIELDS or getattr(var, 'axis', None) == 'T' or (
+                getattr(var, 'standard_name', None) == 'time'):
+            time_var = var
+            break
+    if time_var is None or time_var.ndim != 1 or time_var.size == 0:
+        return None
+    units = getattr(time_var, 'units', None)
+    calendar = getattr(time_var, 'calendar', 'standard')
+    time_range = {
+        'variable': time_var.name,
+        'units': units,
+        'calendar': calendar,
+        'n_steps': int(time_var.size),
+        'start': None,
+        'end': None,
+    }
+    time_var.set_auto_maskandscale(False)
+    end_values = numpy.array([time_var[0], time_var[-1]])
+    try:
+        start, end = cftime.num2date(end_values, units, calendar=calendar)
+        time_range['start'] = start.isoformat()
+        time_range['end'] = end.isoformat()
+    except (TypeError, ValueError):
+        # undecodable units, report the raw values
+        time_range['start'], time_range['end'] = end_values.tolist()
+    return time_range
+
+
+def read_header(nc_path):
+    """Summarize the header of a netcdf file without reading its data.
+
+    Args:
+        nc_path (str): path to a netcdf file.
+
+    Returns:
+        dict with the `path`, `mtime`, `size`, `format`, `dims`,
+        `unlimited` dims, `variables` (dims, shape, dtype, units, chunking
+        and compression filters of each), `grid_mappings` and `time` range
+        of the file. If the file can't be opened only `path`, `mtime`,
+        `size` and an `error` message are set.
+    """
+    file_stat = os.stat(nc_path)
+    record = {
+        'path': nc_path,
+        'mtime': file_stat.st_mtime,
+        'size': file_stat.st_size,
+    }
+    try:
+        with netCDF4.Dataset(nc_path, 'r') as nc_file:
+            record['format'] = nc_file.data_model
+            record['dims'] = {
+                dim_name: len(dim)
+                for dim_name, dim in nc_file.dimensions.items()}
+            record['unlimited'] = [
+                dim_name for dim_name, dim in nc_file.dimensions.items()
+                if dim.isunlimited()]
+            variables = {}
+            grid_mappings = {}
+            for var_name, var in nc_file.variables.items():
+                variables[var_name] = {
+                    'dims': list(var.dimensions),
+                    'shape': list(var.shape),
+                    'dtype': str(var.dtype),
+                    'units': getattr(var, 'units', None),
+                    'chunking': var.chunking(),
+                    'filters': var.filters(),
+                }
+                grid_mapping = getattr(var, 'grid_mapping', None)
+                if grid_mapping in nc_file.variables and (
+                        grid_mapping not in grid_mappings):
+                    mapping_var = nc_file.variables[grid_mapping]
+                    grid_mappings[grid_mapping] = {
+                        attr_name: mapping_var.getncattr(attr_name)
+                        for attr_name in mapping_var.ncattrs()}
+            record['variables'] = variables
+            record['grid_mappings'] = grid_mappings
+            record['time'] = _time_range(nc_file)
+    except (OSError, RuntimeError, ValueError) as e:
+        record['error'] = str(e)
+    return record
+
+
+def _open_index(index_path):
+    """Open the sqlite header index and load every record in it.
+
+    Returns:
+        (connection, dict indexing path to (mtime, size, json record))
+    """
+    connection = sqlite3.connect(index_path)
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS file_header ('
+        'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, record TEXT)')
+    cached_headers = {
+        path: (mtime, size, record)
+        for path, mtime, size, record in connection.execute(
+            'SELECT path, mtime, size, record FROM file_header')}
+    return connection, cached_headers
+
+
+def _header_line(nc_path):
+    """Return the header record of `nc_path` as a json line."""
+    return json.dumps(read_header(nc_path), default=_json_default)
+
+
+def scan_headers(path_list, n_workers, index_path=None):
+    """Read the headers of `path_list` on a process pool.
+
+    netCDF-C isn't thread safe, so headers are read in separate processes
+    rather than on threads of this one.
+
+    Args:
+        path_list (list): netcdf paths to scan.
+        n_workers (int): number of reader processes.
+        index_path (str): if not None, sqlite database of previously read
+            headers, a file is only re-read if its mtime or size changed.
+
+    Yields:
+        json line for each path in `path_list`, in order.
+    """
+    connection = None
+    cached_headers = {}
+    if index_path is not None:
+        connection, cached_headers = _open_index(index_path)
+
+    cached_line_list = []
+    new_path_list = []
+    for nc_path in path_list:
+        cached_line = None
+        if nc_path in cached_headers:
+            file_stat = os.stat(nc_path)
+            mtime, size, record = cached_headers[nc_path]
+            if (mtime, size) == (file_stat.st_mtime, file_stat.st_size):
+                cached_line = record
+        if cached_line is None:
+            new_path_list.append(nc_path)
+        cached_line_list.append(cached_line)
+
+    try:
+        with ProcessPoolExecutor(n_workers) as executor:
+            # headers are quick to read, batch them to amortize the IPC
+            new_line_iter = executor.map(
+                _header_line, new_path_list,
+                chunksize=max(1, len(new_path_list) // (4*n_workers)))
+            for nc_path, cached_line in zip(path_list, cached_line_list):
+                if cached_line is not None:
+                    yield cached_line
+                    continue
+                line = next(new_line_iter)
+                if connection is not None:
+                    record = json.loads(line)
+                    connection.execute(
+                        'INSERT OR REPLACE INTO file_header '
+                        '(path, mtime, size, record) VALUES (?, ?, ?, ?)',
+                        (nc_path, record['mtime'], record['size'], line))
+                    connection.commit()
+                yield line
+    finally:
+        if connection is not None:
+            connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Dump netcdf info on a file to command line.')
+    parser.add_argument(
+        'raster_path', help='path or glob pattern to netcdf files')
+    parser.add_argument(
+        '--json', action='store_true', help=(
+            'print one json line of header metadata per file (dims, '
+            'variables, grid mapping, time range, calendar, chunking and '
+            'compression) without reading any data'))
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='number of processes reading files in --json mode')
+    parser.add_argument(
+        '--index_path', help=(
+            'sqlite file to cache --json headers in, files whose mtime and '
+            'size are unchanged since the last scan are not re-read'))
+    args = parser.parse_args()
+    path_list = sorted(glob.glob(args.raster_path))
+    if not path_list:
+        raise ValueError(f'no files matched the path {args.raster_path}')
+
+    if not args.json:
+        for raster_path in path_list:
+            print_info(raster_path)
+        return
+
+    for line in scan_headers(
+            [os.path.abspath(path) for path in path_list], args.workers,
+            args.index_path):
+        sys.stdout.write(line + '\n')
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,527 @@
+"""Shared NetCDF to GeoTIFF conversion engine.
+
+Not a command line script. ``update_era5``, ``fetch_aer_anomalies``,
+``extract_drought_thresholds_from_aer_gdm``, ``cmip6_download`` and
+``netcdf_to_geotiff`` all go through ``write_geotiff`` so a speed up or fix
+to how grids are detected, georeferenced or written lands everywhere.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import contextlib
+import os
+import uuid
+
+from rasterio.transform import Affine
+from rasterio.windows import Window
+import numpy
+import rasterio
+import rasterio.shutil
+import xarray
+
+DEFAULT_CREATION_OPTIONS = {
+    'tiled': 'YES',
+    'COMPRESS': 'LZW',
+    'PREDICTOR': 2,
+}
+# PREDICTOR=3 is the floating point predictor, 2 only helps integers
+CREATION_PROFILES = {
+    'legacy': DEFAULT_CREATION_OPTIONS,
+    'fast': {
+        'tiled': 'YES',
+        'COMPRESS': 'ZSTD',
+        'ZSTD_LEVEL': 1,
+        'PREDICTOR': 3,
+    },
+    'small': {
+        'tiled': 'YES',
+        'COMPRESS': 'ZSTD',
+        'ZSTD_LEVEL': 19,
+        'PREDICTOR': 3,
+    },
+    # the COG driver can't be written in place, see ``write_geotiff``
+    'cog': {
+        'driver': 'COG',
+        'COMPRESS': 'ZSTD',
+        'LEVEL': 1,
+        'PREDICTOR': 'FLOATING_POINT',
+        'BLOCKSIZE': 512,
+    },
+}
+# options that only change how tiles are compressed
+COMPRESSION_OPTION_KEYS = {
+    'COMPRESS', 'PREDICTOR', 'ZSTD_LEVEL', 'ZLEVEL', 'LEVEL'}
+LONGITUDE_FIELDS = ['longitude', 'long', 'lon']
+LATITUDE_FIELDS = ['latitude', 'lat']
+LATLNG_CRS = '+proj=latlong'
+GRID_CONVENTIONS = ['center', 'span', 'offset']
+
+
+def resolve_creation_options(profile='legacy', option_list=None):
+    """Combine a creation profile with ``KEY=VALUE`` overrides.
+
+    Args:
+        profile (str): key in ``CREATION_PROFILES``.
+        option_list (list): ``KEY=VALUE`` strings, GDAL creation options
+            that replace or add to those of `profile`.
+
+    Returns:
+        dict of creation options to pass to ``write_geotiff``.
+    """
+    if profile not in CREATION_PROFILES:
+        raise ValueError(
+            f'unknown creation profile {profile}, expected one of '
+            f'{list(CREATION_PROFILES)}')
+    creation_options = dict(CREATION_PROFILES[profile])
+    for option in option_list or []:
+        if '=' not in option:
+            raise ValueError(
+                f'expected creation options as KEY=VALUE but got {option}')
+        key, value = option.split('=', 1)
+        creation_options[key] = value
+    return creation_options
+
+
+def compression_options(creation_options):
+    """Keep only the options of `creation_options` that pick the codec.
+
+    Used by writers with their own tiling/layout such as the cmip6 year
+    cubes, so a profile changes their compression but not their layout.
+    COG options are translated to their GTiff names.
+    """
+    options = {
+        key.upper(): value for key, value in creation_options.items()
+        if key.upper() in COMPRESSION_OPTION_KEYS}
+    if creation_options.get('driver') == 'COG':
+        if 'LEVEL' in options:
+            level_key = 'ZSTD_LEVEL'
+            if options.get('COMPRESS') == 'DEFLATE':
+                level_key = 'ZLEVEL'
+            options[level_key] = options.pop('LEVEL')
+        if 'PREDICTOR' in options:
+            options['PREDICTOR'] = {
+                'NO': 1, 'YES': 2, 'STANDARD': 2, 'FLOATING_POINT': 3}[
+                options['PREDICTOR']]
+    return options
+
+
+def add_creation_arguments(parser):
+    """Add ``--creation_profile`` and ``--creation_options`` to `parser`.
+
+    Use ``resolve_creation_options(args.creation_profile,
+    args.creation_options)`` on the parsed arguments.
+    """
+    parser.add_argument(
+        '--creation_profile', default='legacy',
+        choices=list(CREATION_PROFILES), help=(
+            'GeoTIFF compression preset: "legacy" is LZW with the integer '
+            'predictor, "fast" is ZSTD level 1 with the floating point '
+            'predictor, "small" is ZSTD level 19, "cog" writes cloud '
+            'optimized geotiffs'))
+    parser.add_argument(
+        '--creation_options', action='append', metavar='KEY=VALUE', help=(
+            'a GDAL creation option that overrides the profile, may be '
+            'repeated, e.g. --creation_options COMPRESS=DEFLATE '
+            '--creation_options ZLEVEL=9'))
+
+
+def detect_coordinates(
+        dataset, x_fields=LONGITUDE_FIELDS, y_fields=LATITUDE_FIELDS):
+    """Find the x and y coordinate arrays of a dataset.
+
+    Args:
+        dataset (xarray.Dataset): open dataset.
+        x_fields (list): candidate names for the x coordinate, the first
+            one found in ``dataset.coords`` is used.
+        y_fields (list): same as `x_fields` for the y coordinate.
+
+    Returns:
+        (x_coords, y_coords) tuple of 1D numpy arrays.
+    """
+    coord_list = []
+    for field_options in [x_fields, y_fields]:
+        for field_id in field_options:
+            if field_id in dataset.coords:
+                coord_list.append(dataset.coords[field_id].values)
+                break
+        else:
+            raise ValueError(
+                f'Expected one of {field_options} in coordinates but only '
+                f'found {list(dataset.coords.keys())}')
+    return tuple(coord_list)
+
+
+def grid_transform(x_coords, y_coords, convention='center'):
+    """Build the affine transform of a grid from its coordinate arrays.
+
+    Args:
+        x_coords, y_coords (numpy.ndarray): 1D coordinate arrays.
+        convention (str): how the coordinates relate to the pixels.
+            "center" treats them as pixel centers with the median spacing as
+            the resolution, so the grid starts half a pixel before the first
+            coordinate. "span" and "offset" reproduce the transforms the
+            converters built before this engine existed. "span" uses
+            ``(last - first) / n`` as the resolution and the first coordinate
+            as the corner. "offset" uses the median spacing and puts the
+            corner half a pixel after the first coordinate.
+
+            The converters default to their legacy convention: ERA5 and AER
+            days already in the buckets, and the caches and clips built
+            from them, are on the legacy grids, and a half pixel shift
+            would put new days on a different grid than the old ones.
+            ``netcdf_to_geotiff --grid_convention center`` writes the
+            pixel center grid.
+
+    Returns:
+        rasterio.transform.Affine
+    """
+    if convention == 'span':
+        res_list = [
+            float((coords[-1] - coords[0]) / len(coords))
+            for coords in [x_coords, y_coords]]
+        origin = [float(x_coords[0]), float(y_coords[0])]
+    elif convention in ('center', 'offset'):
+        res_list = [
+            float(numpy.median(numpy.diff(coords)))
+            for coords in [x_coords, y_coords]]
+        if convention == 'center':
+            origin = [
+                float(coords[0]) - res/2
+                for coords, res in zip([x_coords, y_coords], res_list)]
+        else:
+            # the y offset was added in the coordinate dtype
+            origin = [
+                float(x_coords[0]) + res_list[0]/2,
+                float(y_coords[0] + res_list[1]/2)]
+    else:
+        raise ValueError(
+            f'unknown coordinate convention {convention}, expected one of '
+            f'{GRID_CONVENTIONS}')
+    return Affine.translation(*origin) * Affine.scale(*res_list)
+
+
+def longitude_roll(x_origin, x_res, n_cols):
+    """Find the column roll that moves a 0-360 global grid to -180-180.
+
+    Args:
+        x_origin (float): left edge of the first column.
+        x_res (float): column width in degrees.
+        n_cols (int): number of columns.
+
+    Returns:
+        (x_roll, new_x_origin) tuple, rolling the columns left by `x_roll`
+        puts the grid at `new_x_origin`. `x_roll` is 0 if the grid doesn't
+        cross 180 or isn't a full 360 degree band, in which case
+        `new_x_origin` is `x_origin`.
+    """
+    if x_res <= 0 or x_origin + n_cols*x_res <= 180:
+        return 0, x_origin
+    if abs(n_cols*x_res - 360) > x_res/2:
+        return 0, x_origin
+    # first column whose left edge is at or past 180
+    x_roll = int(numpy.ceil((180 - x_origin) / x_res - 1e-6)) % n_cols
+    return x_roll, x_origin + x_roll*x_res - 360
+
+
+def iter_chunk_windows(n_bands, n_rows, n_cols, block_shape, chunk_mb):
+    """Split a (band, row, col) raster into windows of about `chunk_mb`.
+
+    Windows are whole rows of tiles across every band when they fit, then
+    single tiles across every band, and only as a last resort band ranges
+    of a single tile. Staying on tile boundaries means each tile is
+    compressed exactly once, just like a single whole-array write.
+
+    Args:
+        n_bands, n_rows, n_cols (int): shape of the target raster.
+        block_shape (tuple): (rows, cols) tile size of the target raster.
+        chunk_mb (float): approximate memory budget per window in MB.
+
+    Yields:
+        (band_slice, rasterio.windows.Window) tuples covering the raster.
+    """
+    budget_pixels = max(1, int(chunk_mb * 2**20 / 8))  # read as float64
+    block_rows, block_cols = block_shape
+    rows_per_chunk = (
+        budget_pixels // (n_bands * n_cols) // block_rows) * block_rows
+    if rows_per_chunk > 0:
+        cols_per_chunk = n_cols
+        bands_per_chunk = n_bands
+    else:
+        rows_per_chunk = block_rows
+        cols_per_chunk = (
+            budget_pixels // (n_bands * block_rows) // block_cols) * (
+            block_cols)
+        bands_per_chunk = n_bands
+        if cols_per_chunk == 0:
+            cols_per_chunk = block_cols
+            bands_per_chunk = max(
+                1, budget_pixels // (block_rows * block_cols))
+
+    for row_off in range(0, n_rows, rows_per_chunk):
+        n_win_rows = min(rows_per_chunk, n_rows - row_off)
+        for col_off in range(0, n_cols, cols_per_chunk):
+            n_win_cols = min(cols_per_chunk, n_cols - col_off)
+            for band_off in range(0, n_bands, bands_per_chunk):
+                yield (
+                    slice(band_off, min(band_off+bands_per_chunk, n_bands)),
+                    Window(col_off, row_off, n_win_cols, n_win_rows))
+
+
+def _read_block(src_array, band_slice, row_slice, col_slice, nodata):
+    """Read a (band, row, col) block of a numpy or lazy xarray array."""
+    if isinstance(src_array, xarray.DataArray):
+        band_dim, y_dim, x_dim = src_array.dims
+        src_array = src_array.isel({
+            band_dim: band_slice, y_dim: row_slice, x_dim: col_slice})
+        block = src_array.values
+    else:
+        block = src_array[band_slice, row_slice, col_slice]
+    if nodata is not None:
+        block = numpy.where(numpy.isnan(block), nodata, block)
+    return block
+
+
+def write_in_chunks(target_dataset, src_array, nodata, chunk_mb, x_roll=0):
+    """Write a (band, y, x) array to `target_dataset` window by window.
+
+    Only one window of `src_array` is read into memory at a time, nodata
+    filling happens per window, and the values written are the same as a
+    single whole-array write would produce.
+
+    Args:
+        target_dataset (rasterio.DatasetWriter): open target raster whose
+            shape matches `src_array`.
+        src_array (numpy.ndarray or xarray.DataArray): 3D array ordered as
+            band, y, x, a DataArray is only read a window at a time.
+        nodata (float): if not None, NaNs are replaced with this.
+        chunk_mb (float): approximate memory budget per window in MB.
+        x_roll (int): if not 0, target column ``c`` is read from source
+            column ``(c + x_roll) % width``, see ``longitude_roll``.
+
+    Returns:
+        None
+    """
+    n_cols = target_dataset.width
+    for band_slice, window in iter_chunk_windows(
+            target_dataset.count, target_dataset.height,
+            n_cols, target_dataset.block_shapes[0], chunk_mb):
+        # a rolled window may wrap past the last source column
+        col_start = (window.col_off + x_roll) % n_cols
+        col_stop = col_start + window.width
+        if col_stop <= n_cols:
+            col_slice_list = [slice(col_start, col_stop)]
+        else:
+            col_slice_list = [
+                slice(col_start, n_cols), slice(0, col_stop - n_cols)]
+        row_slice = slice(window.row_off, window.row_off+window.height)
+        block = numpy.concatenate([
+            _read_block(src_array, band_slice, row_slice, col_slice, nodata)
+            for col_slice in col_slice_list], axis=2)
+        target_dataset.write(
+            block,
+            indexes=list(range(band_slice.start+1, band_slice.stop+1)),
+            window=window)
+
+
+@contextlib.contextmanager
+def open_geotiff(target_path, creation_options=None, **profile):
+    """Open `target_path` for writing with a creation profile.
+
+    Every writer that takes ``--creation_profile`` options should open its
+    target here rather than spreading the options into ``rasterio.open``,
+    the "cog" profile carries its own `driver` and COG can't be written
+    window by window.
+
+    Args:
+        target_path (str): path to the raster to create.
+        creation_options (dict): GDAL creation options, defaults to
+            ``DEFAULT_CREATION_OPTIONS``. A `driver` key picks a driver
+            other than GTiff, "COG" is written as a tiled GTiff next to
+            the target and copied to it on close.
+        profile: height, width, count, dtype, nodata, crs, transform and
+            any other ``rasterio.open`` keywords, but not `driver`.
+
+    Yields:
+        the open rasterio dataset.
+    """
+    if creation_options is None:
+        creation_options = DEFAULT_CREATION_OPTIONS
+    creation_options = dict(creation_options)
+    driver = creation_options.pop('driver', 'GTiff')
+    if not numpy.issubdtype(
+            numpy.dtype(profile.get('dtype', numpy.float32)), numpy.floating):
+        # the floating point predictor of the float profiles rejects
+        # integer targets such as counts, use the integer one for those
+        for key, value in creation_options.items():
+            if key.upper() == 'PREDICTOR' and str(value).upper() in (
+                    '3', 'FLOATING_POINT'):
+                creation_options[key] = (
+                    'STANDARD' if driver == 'COG' else 2)
+    if driver == 'COG':
+        # COG is copy-only, write a plain tiled GTiff next to the target
+        write_path = f'{target_path}.{uuid.uuid4().hex}.tmp.tif'
+        try:
+            with rasterio.open(
+                    write_path, 'w', driver='GTiff', tiled='YES',
+                    **profile) as target_dataset:
+                yield target_dataset
+            rasterio.shutil.copy(
+                write_path, target_path, driver='COG', **creation_options)
+        finally:
+            if os.path.exists(write_path):
+                os.remove(write_path)
+    else:
+        with rasterio.open(
+                target_path, 'w', driver=driver, **profile,
+                **creation_options) as target_dataset:
+            yield target_dataset
+
+
+def write_geotiff(
+        target_path, src_array, transform, nodata=None, crs=LATLNG_CRS,
+        creation_options=None, chunk_mb=None, x_roll=0,
+        band_descriptions=None, dtype=numpy.float32):
+    """Write a 2D or (band, y, x) array as a GeoTIFF.
+
+    Args:
+        target_path (str): path to the GeoTIFF to create, its directory is
+            created if needed.
+        src_array (numpy.ndarray or xarray.DataArray): (y, x) or
+            (band, y, x) data to write.
+        transform (rasterio.transform.Affine): transform of the grid, see
+            ``grid_transform``.
+        nodata (float): nodata value of the target, if not None NaNs are
+            replaced with it.
+        crs (str): target coordinate reference system.
+        creation_options (dict): GDAL creation options, see
+            ``open_geotiff``.
+        chunk_mb (float): if not None, write window by window holding
+            about this many MB at a time, see ``write_in_chunks``.
+        x_roll (int): roll the columns left by this much while writing,
+            see ``longitude_roll``.
+        band_descriptions (list): if not None, one description per band.
+        dtype (numpy.dtype): target data type.
+
+    Returns:
+        `target_path`
+    """
+    target_dir = os.path.dirname(target_path)
+    if target_dir:
+        os.makedirs(target_dir, exist_ok=True)
+    if src_array.ndim == 2:
+        if isinstance(src_array, xarray.DataArray):
+            src_array = src_array.expand_dims('band')
+        else:
+            src_array = src_array[numpy.newaxis, ...]
+    n_bands, n_rows, n_cols = src_array.shape
+    with open_geotiff(
+            target_path, creation_options, height=n_rows, width=n_cols,
+            count=n_bands, dtype=dtype, nodata=nodata, crs=crs,
+            transform=transform) as target_dataset:
+        if chunk_mb is None:
+            src_values = numpy.asarray(src_array)
+            if nodata is not None:
+                src_values = numpy.where(
+                    numpy.isnan(src_values), nodata, src_values)
+            if x_roll:
+                src_values = numpy.roll(src_values, -x_roll, axis=2)
+            target_dataset.write(src_values)
+        else:
+            write_in_chunks(
+                target_dataset, src_array, nodata, chunk_mb, x_roll=x_roll)
+        if band_descriptions is not None:
+            for band_index, description in enumerate(band_descriptions):
+                target_dataset.set_band_description(
+                    band_index+1, description)
+    return target_path
+
+
+def convert_dataset_variables(
+        dataset, target_path_fn, convention='span', **write_kwargs):
+    """Write every variable in `dataset` to its own GeoTIFF.
+
+    Args:
+        dataset (xarray.Dataset): dataset whose data variables are all on
+            the same lat/lng grid.
+        target_path_fn (callable): called with a variable id, returns the
+            target path for that variable.
+        convention (str): coordinate convention, see ``grid_transform``.
+        write_kwargs: passed to ``write_geotiff``.
+
+    Returns:
+        list of (target_path, variable_id) tuples created.
+    """
+    transform = grid_transform(
+        *detect_coordinates(dataset), convention=convention)
+    target_path_variable_id_list = []
+    for variable_id, data_array in dataset.items():
+        target_path = write_geotiff(
+            target_path_fn(variable_id), data_array, transform,
+            **write_kwargs)
+        target_path_variable_id_list.append((target_path, variable_id))
+    return target_path_variable_id_list
+
+
+def writer_pool(writer_backend, n_workers):
+    """Make an executor for ``write_geotiff`` calls.
+
+    Args:
+        writer_backend (str): "thread" for a thread pool that shares arrays
+            with the caller, GDAL releases the GIL while compressing.
+            "pickle" or "shared_memory" for a process pool, see
+            ``publish_shared_block`` for the latter.
+        n_workers (int): number of writers.
+
+    Returns:
+        concurrent.futures.Executor
+    """
+    if writer_backend == 'thread':
+        return ThreadPoolExecutor(n_workers)
+    if writer_backend in ('pickle', 'shared_memory'):
+        return ProcessPoolExecutor(n_workers)
+    raise ValueError(f'unknown writer backend {writer_backend}')
+
+
+def publish_shared_block(src_array):
+    """Copy an array into a new shared memory block.
+
+    The caller must ``close`` and ``unlink`` the returned block once every
+    ``write_geotiff_from_shared_block`` call that uses it is done.
+
+    Returns:
+        multiprocessing.shared_memory.SharedMemory
+    """
+    shared_block = shared_memory.SharedMemory(
+        create=True, size=src_array.nbytes)
+    numpy.ndarray(
+        src_array.shape, dtype=src_array.dtype,
+        buffer=shared_block.buf)[:] = src_array
+    return shared_block
+
+
+def write_geotiff_from_shared_block(
+        shared_block_name, block_shape, block_dtype, block_slice,
+        target_path, transform, **write_kwargs):
+    """Write ``block[block_slice]`` of a published shared memory block.
+
+    Args:
+        shared_block_name (str): name of a ``publish_shared_block`` block.
+        block_shape (tuple): shape of the published array.
+        block_dtype (numpy.dtype): dtype of the published array.
+        block_slice (slice): slice of the first axis to write as bands.
+        target_path (str): path to the GeoTIFF to create.
+        transform (rasterio.transform.Affine): transform of the grid.
+        write_kwargs: passed to ``write_geotiff``.
+
+    Returns:
+        `target_path`
+    """
+    shared_block = shared_memory.SharedMemory(name=shared_block_name)
+    try:
+        src_array = numpy.ndarray(
+            block_shape, dtype=block_dtype, buffer=shared_block.buf)
+        return write_geotiff(
+            target_path, src_array[block_slice], transform, **write_kwargs)
+    finally:
+        src_array = None
+        shared_block.close()
@@ -1,8 +1,12 @@
 """See `python scriptname.py --help"""
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+import collections
 import glob
 import os
 import tempfile
 import shutil
+import time
 import uuid
 
 from ecoshard import geoprocessing
@@ -12,10 +16,10 @@ from pathvalidate import sanitize_filename
 from rasterio.transform import Affine
 import argparse
 import itertools
-import numpy
-import rasterio
 import xarray
 
+import netcdf_conversion
+
 
 def main():
     """Entrypoint."""
@@ -32,109 +36,212 @@ def main():
     parser.add_argument(
         '--target_nodata', type=float,
         help='Set this as target nodata value if desired')
+    parser.add_argument(
+        '--chunk_mb', type=float,
+        help=(
+            'if defined, stream the netcdf lazily and write it window by '
+            'window so no more than about this many MB are held in memory'))
+    parser.add_argument(
+        '--workers', type=int,
+        help=(
+            'if defined, plan every file/variable/coordinate output up '
+            'front and convert them on this many processes, skipping '
+            'outputs that already exist'))
+    parser.add_argument(
+        '--grid_convention', default='offset',
+        choices=netcdf_conversion.GRID_CONVENTIONS, help=(
+            'how the x/y coordinates place the pixels, "center" treats them '
+            'as pixel centers, "offset" (the default) keeps the half pixel '
+            'shift of earlier outputs, see netcdf_conversion.grid_transform'))
+    netcdf_conversion.add_creation_arguments(parser)
     parser.add_argument('out_dir', help='path to output directory')
     args = parser.parse_args()
     _ = parser.parse_args()
+    creation_options = netcdf_conversion.resolve_creation_options(
+        args.creation_profile, args.creation_options)
     os.makedirs(args.out_dir, exist_ok=True)
     path_list = list(glob.glob(args.netcdf_path))
     if len(path_list) == 0:
         raise ValueError(f'no files matched the path {args.netcdf_path}')
+
+    if args.workers is None:
+        for nc_path in path_list:
+            print(f'processing {nc_path}')
+            for job in plan_conversions(
+                    nc_path, args.x_y_fields, args.band_field,
+                    args.target_nodata, args.chunk_mb, args.out_dir,
+                    creation_options, args.grid_convention):
+                convert_job(job)
+        return
+
+    job_list = []
+    skipped_count = 0
     for nc_path in path_list:
-        print(f'processing {nc_path}')
-        decode_times = True
-        while True:
-            try:
-                dataset = xarray.open_dataset(
-                    nc_path, decode_times=decode_times)
-                break
-            except ValueError:
-                if decode_times is False:
-                    raise
-                decode_times = False
-        res_list = []
-        coord_list = []
-        for coord_id, field_id in zip(['x', 'y'], args.x_y_fields):
-            if field_id not in dataset.coords:
-                raise ValueError(
-                    f'Expected {field_id} in coordinates but only found '
-                    f'{list(dataset.coords.keys())}')
-            coord_array = dataset.coords[field_id]
-            res_list.append(float(
-                numpy.median(numpy.diff(coord_array))))
-            coord_list.append(coord_array)
-
-        n_bands = 1
-        if args.band_field is not None:
-            n_bands = len(dataset.coords[args.band_field])
-
-        remaining_coords = (
-            set(dataset.coords) - set(args.x_y_fields+[args.band_field]))
-
-        # Reduce the dimensionality of the dataset using the coordinates
-        coord_values = {
-            coord_name: dataset[coord_name].values
-            for coord_name in remaining_coords
-        }
-
-        # get all combinations
-        combinations = list(itertools.product(*coord_values.values()))
-        if not combinations:
-            combinations = [None]
-
-        transform = Affine.translation(
-            coord_list[0][0] + res_list[0]/2,
-            coord_list[1][0] + res_list[1]/2) * Affine.scale(*res_list)
-
-        basename = os.path.basename(os.path.splitext(nc_path)[0])
-
-        # iterate through all the variables in the dataset
-        for variable_name in dataset.keys():
-            combination_suffix = ''
-            local_dataset = dataset
-
-            for combination in combinations:
-                local_selector = {
-                    key: value
-                    for key, value in zip(coord_values.keys(), combination)}
-                local_dataset = dataset.sel(**local_selector)
-                combination_suffix = '_'+'_'.join([
-                    f'{key}{value}' for key, value in local_selector.items()])
-                if combination_suffix == '_':
-                    combination_suffix = ''
-                target_dir = os.path.join(args.out_dir, variable_name)
-                os.makedirs(target_dir, exist_ok=True)
-                filename = (
-                    f"{basename}_{variable_name}{combination_suffix}.tif")
-                target_path = os.path.join(target_dir, sanitize_filename(
-                    filename, replacement_text="_"))
-                # assume latlng
-                crs_string = "+proj=latlong +datum=WGS84"
-                src_array = local_dataset[variable_name]
-                if len(src_array.dims) == 2:
-                    src_array = src_array.expand_dims('band')
-
-                if args.target_nodata is not None:
-                    src_array = src_array.fillna(args.target_nodata)
-
-                with rasterio.open(
-                    target_path,
-                    mode="w",
-                    driver="GTiff",
-                    height=len(coord_list[1]),
-                    width=len(coord_list[0]),
-                    count=n_bands,
-                    dtype=numpy.float32,
-                    nodata=args.target_nodata,
-                    crs=crs_string,
-                    transform=transform,
-                    **{
-                        'tiled': 'YES',
-                        'COMPRESS': 'LZW',
-                        'PREDICTOR': 2}) as new_dataset:
-                    print(f'writing {target_path}')
-                    new_dataset.write(src_array)
-
-                warp_to_180(target_path)
+        for job in plan_conversions(
+                nc_path, args.x_y_fields, args.band_field,
+                args.target_nodata, args.chunk_mb, args.out_dir,
+                creation_options, args.grid_convention):
+            if os.path.exists(job['target_path']):
+                skipped_count += 1
+                continue
+            job_list.append(job)
+    print(
+        f'planned {len(job_list)} outputs from {len(path_list)} files, '
+        f'{skipped_count} already exist and are skipped')
+
+    stats_by_file = collections.defaultdict(lambda: {
+        'n_outputs': 0, 'n_bytes': 0, 'start': None, 'end': None})
+    with ProcessPoolExecutor(args.workers) as executor:
+        future_list = [
+            executor.submit(convert_job, job) for job in job_list]
+        for future in as_completed(future_list):
+            nc_path, target_path, start_time, end_time = future.result()
+            file_stats = stats_by_file[nc_path]
+            file_stats['n_outputs'] += 1
+            file_stats['n_bytes'] += os.path.getsize(target_path)
+            if file_stats['start'] is None or (
+                    start_time < file_stats['start']):
+                file_stats['start'] = start_time
+            if file_stats['end'] is None or end_time > file_stats['end']:
+                file_stats['end'] = end_time
+
+    for nc_path, file_stats in sorted(stats_by_file.items()):
+        elapsed = max(file_stats['end'] - file_stats['start'], 1e-9)
+        written_mb = file_stats['n_bytes'] / 2**20
+        print(
+            f'{nc_path}: {file_stats["n_outputs"]} outputs, '
+            f'{written_mb:.1f}MB written in {elapsed:.2f}s '
+            f'({written_mb/elapsed:.2f}MB/s)')
+
+
+def _open_dataset(nc_path, cache=True):
+    """Open `nc_path`, falling back to undecoded times if they don't parse."""
+    decode_times = True
+    while True:
+        try:
+            return xarray.open_dataset(
+                nc_path, decode_times=decode_times, cache=cache)
+        except ValueError:
+            if decode_times is False:
+                raise
+            decode_times = False
+
+
+def plan_conversions(
+        nc_path, x_y_fields, band_field, target_nodata, chunk_mb, out_dir,
+        creation_options=None, grid_convention='offset'):
+    """List every GeoTIFF that converting `nc_path` will produce.
+
+    Only the coordinates are read here, the variable data are left for
+    ``convert_job`` so planning hundreds of files stays cheap.
+
+    Args:
+        nc_path (str): path to netcdf file.
+        x_y_fields (list): names of the x and y coordinates.
+        band_field (str): if not None, coordinate to use as the band axis.
+        target_nodata (float): nodata value to fill NaNs with, or None.
+        chunk_mb (float): if not None, write in windows of about this size.
+        out_dir (str): output directory, one subdirectory per variable.
+        creation_options (dict): GDAL creation options, defaults to
+            ``netcdf_conversion.DEFAULT_CREATION_OPTIONS``.
+        grid_convention (str): see ``netcdf_conversion.grid_transform``,
+            "offset" reproduces earlier outputs.
+
+    Returns:
+        list of job dicts that can be passed to ``convert_job``.
+    """
+    dataset = _open_dataset(nc_path, cache=False)
+    coord_list = netcdf_conversion.detect_coordinates(
+        dataset, [x_y_fields[0]], [x_y_fields[1]])
+
+    remaining_coords = (
+        set(dataset.coords) - set(list(x_y_fields)+[band_field]))
+
+    # Reduce the dimensionality of the dataset using the coordinates
+    coord_values = {
+        coord_name: dataset[coord_name].values
+        for coord_name in remaining_coords
+    }
+
+    # get all combinations
+    combinations = list(itertools.product(*coord_values.values()))
+    if not combinations:
+        combinations = [None]
+
+    transform = netcdf_conversion.grid_transform(
+        *coord_list, convention=grid_convention)
+    x_roll, x_origin = netcdf_conversion.longitude_roll(
+        transform.c, transform.a, len(coord_list[0]))
+    transform = Affine(
+        transform.a, transform.b, x_origin,
+        transform.d, transform.e, transform.f)
+
+    basename = os.path.basename(os.path.splitext(nc_path)[0])
+
+    job_list = []
+    # iterate through all the variables in the dataset
+    for variable_name in dataset.keys():
+        for combination in combinations:
+            local_selector = {
+                key: value
+                for key, value in zip(coord_values.keys(), combination)}
+            combination_suffix = '_'+'_'.join([
+                f'{key}{value}' for key, value in local_selector.items()])
+            if combination_suffix == '_':
+                combination_suffix = ''
+            target_dir = os.path.join(out_dir, variable_name)
+            filename = (
+                f"{basename}_{variable_name}{combination_suffix}.tif")
+            target_path = os.path.join(target_dir, sanitize_filename(
+                filename, replacement_text="_"))
+            job_list.append({
+                'nc_path': nc_path,
+                'variable_name': variable_name,
+                'selector': local_selector,
+                'target_path': target_path,
+                'transform': transform,
+                'x_roll': x_roll,
+                'target_nodata': target_nodata,
+                'chunk_mb': chunk_mb,
+                'creation_options': creation_options,
+            })
+    dataset.close()
+    return job_list
+
+
+def convert_job(job):
+    """Write the single GeoTIFF described by a ``plan_conversions`` job.
+
+    Args:
+        job (dict): a job produced by ``plan_conversions``.
+
+    Returns:
+        (nc_path, target_path, start_time, end_time) tuple.
+    """
+    start_time = time.time()
+    chunk_mb = job['chunk_mb']
+    target_nodata = job['target_nodata']
+    # in chunked mode don't let xarray cache whole variables
+    dataset = _open_dataset(job['nc_path'], cache=chunk_mb is None)
+    local_dataset = dataset.sel(**job['selector'])
+    target_path = job['target_path']
+    print(f'writing {target_path}')
+    # written under a temporary name and renamed when complete, so a killed
+    # job doesn't leave an output that --workers runs skip as done
+    write_path = f'{target_path}.{uuid.uuid4().hex}.tmp.tif'
+    # assume latlng
+    netcdf_conversion.write_geotiff(
+        write_path, local_dataset[job['variable_name']], job['transform'],
+        nodata=target_nodata, crs='+proj=latlong +datum=WGS84',
+        creation_options=job['creation_options'], chunk_mb=chunk_mb,
+        x_roll=job['x_roll'])
+    dataset.close()
+
+    if not job['x_roll']:
+        # grids that aren't a full 0-360 band can't be rolled
+        warp_to_180(write_path)
+    os.replace(write_path, target_path)
+    return job['nc_path'], target_path, start_time, time.time()
 
 
 def warp_to_180(local_raster_path):
@@ -0,0 +1,169 @@
+"""See `python scriptname.py --help"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import contextlib
+import os
+
+import numexpr
+import numpy
+import rasterio
+
+import netcdf_conversion
+
+DEFAULT_NODATA = -9999
+# output tiles are 256x256 by default, windows stay on their boundaries
+DEFAULT_BLOCK_SHAPE = (256, 256)
+
+
+def compile_expression(expression, name_list):
+    """Compile `expression` once for float64 operands named `name_list`.
+
+    Args:
+        expression (str): numexpr expression such as ``(A - B) / C``.
+        name_list (list): names of the rasters that can appear in it.
+
+    Returns:
+        (numexpr.NumExpr, list of the names `expression` uses, in the
+        order the compiled expression expects them)
+    """
+    used_name_list = numexpr.NumExpr(expression).input_names
+    unknown_names = set(used_name_list) - set(name_list)
+    if unknown_names:
+        raise ValueError(
+            f'{expression} uses {sorted(unknown_names)} but only '
+            f'{sorted(name_list)} were given')
+    compiled_expression = numexpr.NumExpr(
+        expression,
+        signature=[(name, numpy.float64) for name in used_name_list])
+    return compiled_expression, used_name_list
+
+
+def evaluate_expression(
+        expression, raster_path_by_name, target_path, target_nodata=None,
+        n_threads=None, chunk_mb=64, creation_options=None):
+    """Evaluate `expression` over aligned rasters into `target_path`.
+
+    The expression is compiled once and evaluated window by window on
+    numexpr's thread pool while the next window is read on a background
+    thread. A target pixel is nodata if any raster the expression uses is
+    nodata or non-finite there, or if the expression itself isn't finite
+    (e.g. a division by 0).
+
+    Args:
+        expression (str): numexpr expression of the names in
+            `raster_path_by_name`, e.g. ``(A - B) / C * 86400``.
+        raster_path_by_name (dict): maps expression names to single band
+            rasters, all of the same size and georeferencing.
+        target_path (str): path to the float32 raster to create.
+        target_nodata (float): target nodata, defaults to the nodata of the
+            first raster the expression uses, or ``DEFAULT_NODATA``.
+        n_threads (int): numexpr threads, defaults to numexpr's default.
+        chunk_mb (float): approximate memory budget per window.
+        creation_options (dict): GDAL creation options, see
+            ``netcdf_conversion.open_geotiff``.
+
+    Returns:
+        None
+    """
+    compiled_expression, name_list = compile_expression(
+        expression, list(raster_path_by_name))
+    if n_threads is not None:
+        numexpr.set_num_threads(n_threads)
+
+    with contextlib.ExitStack() as stack:
+        raster_list = [
+            stack.enter_context(rasterio.open(raster_path_by_name[name]))
+            for name in name_list]
+        if not raster_list:
+            raise ValueError(f'{expression} uses no rasters')
+        base_raster = raster_list[0]
+        for name, raster in zip(name_list, raster_list):
+            if raster.shape != base_raster.shape:
+                raise ValueError(
+                    f'raster {name} is {raster.shape} but {name_list[0]} is '
+                    f'{base_raster.shape}, align them first')
+        if target_nodata is None:
+            target_nodata = base_raster.nodata
+        if target_nodata is None:
+            target_nodata = DEFAULT_NODATA
+
+        target_dir = os.path.dirname(target_path)
+        if target_dir:
+            os.makedirs(target_dir, exist_ok=True)
+        target_raster = stack.enter_context(netcdf_conversion.open_geotiff(
+            target_path, creation_options,
+            height=base_raster.height, width=base_raster.width, count=1,
+            dtype=numpy.float32, nodata=target_nodata, crs=base_raster.crs,
+            transform=base_raster.transform))
+
+        def _read_window(window):
+            array_list = []
+            valid_mask = numpy.ones(
+                (window.height, window.width), dtype=bool)
+            for raster in raster_list:
+                array = raster.read(1, window=window).astype(
+                    numpy.float64, copy=False)
+                valid_mask &= numpy.isfinite(array)
+                if raster.nodata is not None:
+                    valid_mask &= array != raster.nodata
+                array_list.append(array)
+            return array_list, valid_mask
+
+        window_list = [
+            window for _, window in netcdf_conversion.iter_chunk_windows(
+                1, base_raster.height, base_raster.width,
+                DEFAULT_BLOCK_SHAPE, chunk_mb / (len(raster_list) + 2))]
+        # one reader thread, GDAL handles aren't safe to share
+        with ThreadPoolExecutor(1) as reader:
+            next_read = reader.submit(_read_window, window_list[0])
+            for window_index, window in enumerate(window_list):
+                array_list, valid_mask = next_read.result()
+                if window_index + 1 < len(window_list):
+                    next_read = reader.submit(
+                        _read_window, window_list[window_index+1])
+                result = compiled_expression(*array_list)
+                valid_mask &= numpy.isfinite(result)
+                target_raster.write(
+                    numpy.where(valid_mask, result, target_nodata).astype(
+                        numpy.float32), 1, window=window)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Evaluate a numexpr expression over aligned rasters, e.g. '
+        '"(A - B) / C * 86400" with --raster A=a.tif --raster B=b.tif '
+        '--raster C=c.tif. A pixel is nodata if any raster used is nodata '
+        'there or the result is not finite.'))
+    parser.add_argument('expression', help='expression to evaluate')
+    parser.add_argument(
+        '--raster', action='append', required=True, metavar='NAME=PATH',
+        help='a raster and the name it has in the expression, repeatable')
+    parser.add_argument(
+        '--target_path', required=True, help='Path to target raster.')
+    parser.add_argument(
+        '--target_nodata', type=float, help=(
+            'target nodata, defaults to the nodata of the first raster'))
+    parser.add_argument(
+        '--n_threads', type=int, help='number of threads to evaluate on')
+    parser.add_argument(
+        '--chunk_mb', type=float, default=64,
+        help='approximate memory budget per window')
+    netcdf_conversion.add_creation_arguments(parser)
+    args = parser.parse_args()
+
+    raster_path_by_name = {}
+    for raster_arg in args.raster:
+        if '=' not in raster_arg:
+            raise ValueError(f'expected NAME=PATH but got {raster_arg}')
+        name, path = raster_arg.split('=', 1)
+        raster_path_by_name[name] = path
+    evaluate_expression(
+        args.expression, raster_path_by_name, args.target_path,
+        target_nodata=args.target_nodata, n_threads=args.n_threads,
+        chunk_mb=args.chunk_mb,
+        creation_options=netcdf_conversion.resolve_creation_options(
+            args.creation_profile, args.creation_options))
+
+
+if __name__ == '__main__':
+    main()
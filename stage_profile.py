@@ -0,0 +1,510 @@
+"""Wall time, CPU time, I/O and queue wait of the stages of a pipeline.
+
+Not a command line script. When a run of the ERA5 scripts is slow, taskgraph
+doesn't say whether the time went to existence checks, downloads, clipping,
+reductions or table writes. ``StageProfile.wrap`` returns a stand-in for a
+task graph whose ``add_task`` wraps each task function. The wrapper records
+the task's wall time, CPU time, bytes read and written and when it started,
+and the profile knows when the task was scheduled and what it depends on.
+The stage of a task is the name of its function. Work a script does in its
+own thread is recorded with ``StageProfile.stage``, and a task function can
+record parts of itself as stages of their own with ``task_stage``.
+
+Records are appended as JSON lines to one file per process in the records
+directory of the profile, so tasks that run in taskgraph's worker processes
+are recorded too. ``StageProfile.write_report`` reads them back and writes
+the percentiles of every stage and the critical path of the run as JSON and
+CSV.
+
+CPU time and bytes are those of the thread that runs the task, from
+``time.thread_time`` and the "rchar" and "wchar" counters of Linux's
+``/proc/thread-self/io``, which count every read and write, downloads
+included. Bytes are left empty where that file doesn't exist, and work a
+task hands to other threads, e.g. GDAL's, isn't counted.
+"""
+import collections
+import contextlib
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+PERCENTILE_LIST = [50, 90, 99]
+STAGE_FIELD_LIST = [
+    'stage', 'kind', 'scheduled', 'runs', 'failed', 'wall_total_s',
+    *[f'wall_p{percentile}_s' for percentile in PERCENTILE_LIST],
+    'wall_max_s', 'cpu_total_s', 'cpu_fraction', 'queue_wait_p50_s',
+    'queue_wait_p90_s', 'queue_wait_max_s', 'read_mb', 'written_mb',
+    'read_mb_per_s', 'critical_path_s']
+_IO_COUNTERS_PATH = '/proc/thread-self/io'
+# threads of a process append to the same record file
+_RECORD_LOCK = threading.Lock()
+# record directory and id of the task a worker thread is running
+_ACTIVE_TASK = threading.local()
+
+
+def add_profile_arguments(parser):
+    """Add ``--profile_dir`` and ``--profile_interval`` to `parser`.
+
+    Use ``profile_from_args(args)`` on the parsed arguments.
+    """
+    parser.add_argument(
+        '--profile_dir', help=(
+            'if set, the wall time, CPU time, bytes read and written and '
+            'queue wait of every task and stage are recorded, and a JSON and '
+            'CSV profile of the run with per-stage percentiles and the '
+            'critical path is written to this directory'))
+    parser.add_argument(
+        '--profile_interval', type=float, default=0, help=(
+            'if > 0, a summary line of the --profile_dir profile is logged '
+            'every this many seconds'))
+
+
+def profile_from_args(args):
+    """``StageProfile`` from ``add_profile_arguments``."""
+    if args.profile_interval > 0 and not args.profile_dir:
+        raise ValueError('--profile_interval needs --profile_dir')
+    return StageProfile(
+        args.profile_dir, summary_interval=args.profile_interval)
+
+
+def _io_counters():
+    """Bytes read and written by this thread, (None, None) if unknown."""
+    try:
+        with open(_IO_COUNTERS_PATH) as io_file:
+            counter_by_name = dict(line.split(':') for line in io_file)
+    except OSError:
+        return None, None
+    return int(counter_by_name['rchar']), int(counter_by_name['wchar'])
+
+
+@contextlib.contextmanager
+def _measure(record_dir, stage, task_id=None, parent_task_id=None):
+    """Record the body of the ``with`` as a run of `stage` in `record_dir`.
+
+    Args:
+        record_dir (str): directory of the record files.
+        stage (str): name of the stage.
+        task_id (int): id of the task the body runs, None for work that
+            isn't a task.
+        parent_task_id (int): id of the task the body is part of, if any.
+
+    Returns:
+        context manager
+    """
+    start_time = time.time()
+    start_cpu = time.thread_time()
+    start_read, start_written = _io_counters()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        end_time = time.time()
+        end_read, end_written = _io_counters()
+        record = {
+            'stage': stage,
+            'task_id': task_id,
+            'parent_task_id': parent_task_id,
+            'start': start_time,
+            'end': end_time,
+            'cpu_s': time.thread_time() - start_cpu,
+            'read_bytes': (
+                None if start_read is None else end_read - start_read),
+            'written_bytes': (
+                None if start_written is None
+                else end_written - start_written),
+            'failed': failed,
+        }
+        with _RECORD_LOCK:
+            with open(os.path.join(
+                    record_dir, f'records_{os.getpid()}.jsonl'),
+                    'a') as record_file:
+                record_file.write(json.dumps(record) + '\n')
+
+
+def task_stage(stage):
+    """Record part of the running task as a run of `stage`.
+
+    For use in task functions, e.g. to tell a download from the work on
+    what it downloaded. It records nothing outside of a profiled task.
+
+    Args:
+        stage (str): name of the stage.
+
+    Returns:
+        context manager
+    """
+    record_dir = getattr(_ACTIVE_TASK, 'record_dir', None)
+    if record_dir is None:
+        return contextlib.nullcontext()
+    return _measure(record_dir, stage, parent_task_id=_ACTIVE_TASK.task_id)
+
+
+class _ProfiledFunc:
+    """Task function that records its call, it pickles to worker processes.
+
+    taskgraph identifies a task by the name and source of its function,
+    which are those of the wrapped function, so tasks completed without a
+    profile aren't redone with one.
+    """
+
+    def __init__(self, func, stage, task_id, record_dir):
+        self.func = func
+        self.stage = stage
+        self.task_id = task_id
+        self.record_dir = record_dir
+        self.__name__ = func.__name__
+        self.__wrapped__ = func
+
+    def __call__(self, *args, **kwargs):
+        _ACTIVE_TASK.record_dir = self.record_dir
+        _ACTIVE_TASK.task_id = self.task_id
+        try:
+            with _measure(self.record_dir, self.stage, task_id=self.task_id):
+                return self.func(*args, **kwargs)
+        finally:
+            _ACTIVE_TASK.record_dir = None
+
+
+class _ProfiledTaskGraph:
+    """A task graph whose tasks are recorded by a ``StageProfile``."""
+
+    def __init__(self, task_graph, profile):
+        self.task_graph = task_graph
+        self.profile = profile
+
+    def add_task(
+            self, func=None, dependent_task_list=None, task_name=None,
+            **kwargs):
+        """``taskgraph.TaskGraph.add_task`` of a recorded `func`."""
+        return self.profile._add_task(
+            self.task_graph, func, dependent_task_list or [], task_name,
+            kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.task_graph, name)
+
+
+class StageProfile:
+    """Records of the tasks and stages of a run and their report."""
+
+    def __init__(self, profile_dir=None, summary_interval=0):
+        """Set up the profile of a run starting now.
+
+        Args:
+            profile_dir (str): directory to write the records and report
+                to, if None the profile is off: ``wrap`` returns the task
+                graph it is given and nothing is recorded.
+            summary_interval (float): if > 0, ``start_summary`` logs a
+                summary line every this many seconds.
+        """
+        self.profile_dir = profile_dir
+        self.summary_interval = summary_interval
+        self.start_time = time.time()
+        self.run_id = f'{time.strftime("%Y%m%d_%H%M%S")}_{os.getpid()}'
+        self.record_dir = None
+        if profile_dir is not None:
+            self.record_dir = os.path.join(
+                profile_dir, f'stage_profile_{self.run_id}_records')
+            os.makedirs(self.record_dir, exist_ok=True)
+        # scheduled tasks, a task's id is its index
+        self._task_list = []
+        # id() of a taskgraph.Task to (the task, its id)
+        self._task_id_by_object_id = {}
+        self._lock = threading.Lock()
+        self._stop_summary = threading.Event()
+
+    def wrap(self, task_graph):
+        """Return a stand-in for `task_graph` whose tasks are recorded."""
+        if self.record_dir is None or isinstance(
+                task_graph, _ProfiledTaskGraph):
+            return task_graph
+        return _ProfiledTaskGraph(task_graph, self)
+
+    def stage(self, stage):
+        """Record the body of a ``with`` in this thread as a run of `stage`.
+
+        Args:
+            stage (str): name of the stage, e.g. "write_tables".
+
+        Returns:
+            context manager
+        """
+        if self.record_dir is None:
+            return contextlib.nullcontext()
+        return _measure(self.record_dir, stage)
+
+    def _add_task(
+            self, task_graph, func, dependent_task_list, task_name, kwargs):
+        with self._lock:
+            task_id = len(self._task_list)
+            stage = func.__name__.lstrip('_')
+            scheduled_time = time.time()
+            task = task_graph.add_task(
+                func=_ProfiledFunc(func, stage, task_id, self.record_dir),
+                dependent_task_list=dependent_task_list,
+                task_name=task_name, **kwargs)
+            if id(task) in self._task_id_by_object_id:
+                # taskgraph returns the first of duplicate tasks
+                return task
+            self._task_id_by_object_id[id(task)] = (task, task_id)
+            self._task_list.append({
+                'task_id': task_id,
+                'stage': stage,
+                'task_name': task_name,
+                'scheduled': scheduled_time,
+                'dependency_id_list': [
+                    self._task_id_by_object_id[id(dependent_task)][1]
+                    for dependent_task in dependent_task_list
+                    if id(dependent_task) in self._task_id_by_object_id],
+            })
+        return task
+
+    def _read_records(self):
+        record_list = []
+        for record_path in glob.glob(
+                os.path.join(self.record_dir, '*.jsonl')):
+            with open(record_path) as record_file:
+                for line in record_file:
+                    try:
+                        record_list.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # a line another process is writing
+                        pass
+        return record_list
+
+    def start_summary(self):
+        """Log ``summary_line`` every ``summary_interval`` seconds.
+
+        The summary stops when ``write_report`` is called, it isn't started
+        if the profile is off or the interval isn't > 0.
+        """
+        if self.record_dir is None or self.summary_interval <= 0:
+            return
+
+        def _log_summaries():
+            while not self._stop_summary.wait(self.summary_interval):
+                LOGGER.info(self.summary_line())
+
+        threading.Thread(target=_log_summaries, daemon=True).start()
+
+    def summary_line(self):
+        """One line of the tasks done so far and the slowest stages."""
+        record_list = self._read_records()
+        with self._lock:
+            n_scheduled = len(self._task_list)
+        wall_list_by_stage = collections.defaultdict(list)
+        for record in record_list:
+            wall_list_by_stage[record['stage']].append(
+                record['end'] - record['start'])
+        stage_text = ', '.join(
+            f'{stage} {len(wall_list)} done p50 '
+            f'{numpy.percentile(wall_list, 50):.2f}s'
+            for stage, wall_list in sorted(
+                wall_list_by_stage.items(),
+                key=lambda item: -sum(item[1]))[:3])
+        n_done = sum(
+            1 for record in record_list if record['task_id'] is not None)
+        read_mb = sum(
+            record['read_bytes'] or 0 for record in record_list
+            if record['parent_task_id'] is None) / 2**20
+        return (
+            f'{time.time()-self.start_time:.0f}s: {n_done}/{n_scheduled} '
+            f'tasks done, {read_mb:.1f} MB read, slowest stages: '
+            f'{stage_text or "none yet"}')
+
+    def write_report(self):
+        """Stop the summary line and write the profile of the run so far.
+
+        Writes ``stage_profile_{run_id}.json``, with the stages, the
+        critical path and every task, and ``stage_profile_{run_id}.csv``,
+        a row of ``STAGE_FIELD_LIST`` per stage. A task's queue wait is the
+        time from when it was scheduled, or its last dependency finished if
+        that was later, to when it started. The critical path ends at the
+        task that finished last and goes back through the dependency that
+        finished last of each task. The script wait of a step is the time
+        from when that dependency finished, or the run started, to when the
+        script scheduled the step, e.g. while it was writing tables.
+
+        Returns:
+            (json path, csv path), None if the profile is off.
+        """
+        self._stop_summary.set()
+        if self.record_dir is None:
+            return None
+        record_list = self._read_records()
+        with self._lock:
+            task_by_id = {task['task_id']: task for task in self._task_list}
+        run_by_task_id = {
+            record['task_id']: record for record in record_list
+            if record['task_id'] is not None}
+
+        queue_wait_by_task_id = {}
+        for task_id, run in run_by_task_id.items():
+            task = task_by_id[task_id]
+            ready_time = max([task['scheduled']] + [
+                run_by_task_id[dependency_id]['end']
+                for dependency_id in task['dependency_id_list']
+                if dependency_id in run_by_task_id])
+            queue_wait_by_task_id[task_id] = max(
+                0.0, run['start'] - ready_time)
+
+        critical_path = []
+        run = max(
+            run_by_task_id.values(), key=lambda run: run['end'],
+            default=None)
+        while run is not None:
+            task = task_by_id[run['task_id']]
+            last_dependency_run = max([
+                run_by_task_id[dependency_id]
+                for dependency_id in task['dependency_id_list']
+                if dependency_id in run_by_task_id],
+                key=lambda dependency_run: dependency_run['end'],
+                default=None)
+            released_time = self.start_time
+            if last_dependency_run is not None:
+                released_time = last_dependency_run['end']
+            critical_path.append({
+                'task_name': task['task_name'],
+                'stage': task['stage'],
+                'scheduled_s': task['scheduled'] - self.start_time,
+                'start_s': run['start'] - self.start_time,
+                'end_s': run['end'] - self.start_time,
+                'wall_s': run['end'] - run['start'],
+                'script_wait_s': max(0.0, task['scheduled'] - released_time),
+                'queue_wait_s': queue_wait_by_task_id[run['task_id']],
+            })
+            run = last_dependency_run
+        critical_path.reverse()
+        critical_s_by_stage = collections.defaultdict(float)
+        for step in critical_path:
+            critical_s_by_stage[step['stage']] += step['wall_s']
+
+        n_scheduled_by_stage = collections.Counter(
+            task['stage'] for task in task_by_id.values())
+        record_list_by_stage = collections.defaultdict(list)
+        for record in record_list:
+            record_list_by_stage[record['stage']].append(record)
+        stage_list = [
+            _stage_stats(
+                stage, record_list_by_stage[stage],
+                n_scheduled_by_stage.get(stage), [
+                    queue_wait_by_task_id[record['task_id']]
+                    for record in record_list_by_stage[stage]
+                    if record['task_id'] is not None],
+                critical_s_by_stage.get(stage, 0.0))
+            for stage in set(record_list_by_stage) | set(
+                n_scheduled_by_stage)]
+        stage_list.sort(key=lambda stats: -(stats['wall_total_s'] or 0))
+
+        report_base = os.path.join(
+            self.profile_dir, f'stage_profile_{self.run_id}')
+        with open(f'{report_base}.json', 'w') as json_file:
+            json.dump({
+                'run_id': self.run_id,
+                'wall_s': time.time() - self.start_time,
+                'tasks_scheduled': len(task_by_id),
+                'tasks_run': len(run_by_task_id),
+                'stage_list': stage_list,
+                # the critical path spans the run up to its last task
+                'critical_path_s': (
+                    critical_path[-1]['end_s'] if critical_path else 0.0),
+                'critical_path_script_wait_s': sum(
+                    step['script_wait_s'] for step in critical_path),
+                'critical_path_queue_wait_s': sum(
+                    step['queue_wait_s'] for step in critical_path),
+                'critical_path': critical_path,
+                'task_list': [{
+                    **task, **run_by_task_id.get(task_id, {}),
+                    'queue_wait_s': queue_wait_by_task_id.get(task_id)}
+                    for task_id, task in sorted(task_by_id.items())],
+            }, json_file, indent=1)
+        with open(f'{report_base}.csv', 'w') as csv_file:
+            csv_file.write(','.join(STAGE_FIELD_LIST) + '\n')
+            for stats in stage_list:
+                csv_file.write(','.join(
+                    '' if stats[field] is None else str(stats[field])
+                    for field in STAGE_FIELD_LIST) + '\n')
+        LOGGER.info(
+            f'stage profile in {report_base}.json and .csv, slowest stages: '
+            + ', '.join(
+                f'{stats["stage"]} {stats["wall_total_s"]}s'
+                for stats in stage_list[:3]))
+        return f'{report_base}.json', f'{report_base}.csv'
+
+
+def _stage_stats(
+        stage, record_list, n_scheduled, queue_wait_list, critical_s):
+    """Row of ``STAGE_FIELD_LIST`` of a stage.
+
+    Args:
+        stage (str): name of the stage.
+        record_list (list): records of the runs of the stage.
+        n_scheduled (int): tasks of the stage scheduled, None if the stage
+            isn't a task; tasks taskgraph found complete aren't run.
+        queue_wait_list (list): queue waits of the stage's task runs.
+        critical_s (float): wall time of the stage on the critical path.
+
+    Returns:
+        dict of ``STAGE_FIELD_LIST``, values are rounded and None where
+        there is nothing to measure.
+    """
+    def _round(value, digits=3):
+        return None if value is None else round(float(value), digits)
+
+    kind = 'task'
+    if n_scheduled is None:
+        kind = 'part' if any(
+            record['parent_task_id'] is not None
+            for record in record_list) else 'inline'
+    wall_array = numpy.array(
+        [record['end'] - record['start'] for record in record_list])
+    wall_total = float(numpy.sum(wall_array))
+    cpu_total = sum(record['cpu_s'] for record in record_list)
+    read_bytes_list = [
+        record['read_bytes'] for record in record_list
+        if record['read_bytes'] is not None]
+    written_bytes_list = [
+        record['written_bytes'] for record in record_list
+        if record['written_bytes'] is not None]
+    read_mb = sum(read_bytes_list) / 2**20 if read_bytes_list else None
+    stats = {
+        'stage': stage,
+        'kind': kind,
+        'scheduled': n_scheduled,
+        'runs': len(record_list),
+        'failed': sum(1 for record in record_list if record['failed']),
+        'wall_total_s': _round(wall_total) if record_list else None,
+        'wall_max_s': _round(
+            numpy.max(wall_array) if record_list else None),
+        'cpu_total_s': _round(cpu_total) if record_list else None,
+        'cpu_fraction': _round(
+            cpu_total / wall_total if wall_total > 0 else None),
+        'queue_wait_p50_s': _round(
+            numpy.percentile(queue_wait_list, 50)
+            if queue_wait_list else None),
+        'queue_wait_p90_s': _round(
+            numpy.percentile(queue_wait_list, 90)
+            if queue_wait_list else None),
+        'queue_wait_max_s': _round(
+            max(queue_wait_list) if queue_wait_list else None),
+        'read_mb': _round(read_mb),
+        'written_mb': _round(
+            sum(written_bytes_list) / 2**20 if written_bytes_list else None),
+        'read_mb_per_s': _round(
+            read_mb / wall_total
+            if read_mb is not None and wall_total > 0 else None),
+        'critical_path_s': _round(critical_s) if kind == 'task' else None,
+    }
+    for percentile in PERCENTILE_LIST:
+        stats[f'wall_p{percentile}_s'] = _round(
+            numpy.percentile(wall_array, percentile)
+            if record_list else None)
+    return stats
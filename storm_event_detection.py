@@ -1,4 +1,5 @@
 """See `python scriptname.py --help"""
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import argparse
 import calendar
@@ -6,21 +7,21 @@ import datetime
 import logging
 import multiprocessing
 import os
-import shutil
 import sys
 import time
 
 from osgeo import gdal
-from osgeo import osr
 from ecoshard import geoprocessing
 from ecoshard import taskgraph
 import numpy
 import requests
 
-try:
-    from ecoshard import fetch_data
-except RuntimeError as e:
-    print(f'Error when loading fetch_data: {e}')
+from clip_cache import ClipCache
+import daily_cube
+import key_manifest
+import stage_profile
+import streaming_reducer
+import window_read
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -32,8 +33,6 @@ LOGGER = logging.getLogger(os.path.splitext(os.path.basename(__file__))[0])
 LOGGER.setLevel(logging.DEBUG)
 logging.getLogger('ecoshard.fetch_data').setLevel(logging.INFO)
 
-ERA5_RESOLUTION_M = 27830
-ERA5_RESOLUTION_DEG = 0.25
 ERA5_TOTAL_PRECIP_BAND_NAME = 'total_precipitation'
 MASK_NODATA = -9999
 
@@ -73,11 +72,8 @@ def build_monthly_ranges(start_date, end_date):
 
 
 def daterange(start_date, end_date):
-    """Generator produces all ``datetimes`` between start and end."""
-    if start_date == end_date:
-        yield start_date
-        return
-    for n in range(int((end_date - start_date).days)):
+    """Generator produces all ``datetimes`` from start to end inclusive."""
+    for n in range(int((end_date - start_date).days) + 1):
         yield start_date + datetime.timedelta(n)
 
 
@@ -88,24 +84,91 @@ def _download_url(url, target_path):
     return target_path
 
 
+def count_storm_events(
+        precip_array_list, nodata, rain_event_threshold, window_days):
+    """Count the rolling `window_days` windows with a storm's average precip.
+
+    Days are copied into a float32 ring of the last `window_days` days with
+    nodata and +inf days set to NaN, so a window that includes a nodata or
+    non-finite day sums to NaN (or -inf) and is not an event. Each window is
+    summed from its own days rather than as a difference of running sums,
+    so a 2 day window is the same float32 ``a + b`` the pairwise average
+    was.
+
+    Args:
+        precip_array_list (list): same shaped daily precip arrays in date
+            order.
+        nodata (float): nodata value of the precip arrays and the result.
+        rain_event_threshold (float): a window is an event if its average
+            daily precip is at least this.
+        window_days (int): number of consecutive days in a window, if there
+            are fewer arrays than this the whole list is one window.
+
+    Returns:
+        int32 array of the number of events per pixel, `nodata` where there
+        were none.
+    """
+    window_days = min(window_days, len(precip_array_list))
+    block_shape = precip_array_list[0].shape
+    day_ring = numpy.empty((window_days,) + block_shape, dtype=numpy.float32)
+    invalid_mask = numpy.empty(block_shape, dtype=bool)
+    nodata_mask = numpy.empty(block_shape, dtype=bool)
+    window_sum = numpy.empty(block_shape, dtype=numpy.float32)
+    event_mask = numpy.empty(block_shape, dtype=bool)
+    # a uint8 tally of the bool events is much cheaper than an int32 one
+    count_dtype = numpy.uint8 if len(precip_array_list) < 256 else (
+        numpy.int32)
+    event_count = numpy.zeros(block_shape, dtype=count_dtype)
+    window_threshold = numpy.float32(rain_event_threshold * window_days)
+    for day_index, precip_array in enumerate(precip_array_list):
+        day_array = day_ring[day_index % window_days]
+        numpy.copyto(day_array, precip_array)
+        numpy.equal(precip_array, numpy.inf, out=invalid_mask)
+        if nodata is not None:
+            numpy.equal(precip_array, nodata, out=nodata_mask)
+            numpy.logical_or(invalid_mask, nodata_mask, out=invalid_mask)
+        numpy.copyto(day_array, numpy.nan, where=invalid_mask)
+        if day_index < window_days-1:
+            continue
+        if window_days == 1:
+            window_sum = day_ring[0]
+        else:
+            numpy.add(day_ring[0], day_ring[1], out=window_sum)
+            for window_day_array in day_ring[2:]:
+                numpy.add(window_sum, window_day_array, out=window_sum)
+        numpy.greater_equal(window_sum, window_threshold, out=event_mask)
+        numpy.add(event_count, event_mask.view(numpy.uint8), out=event_count)
+    result = event_count.astype(numpy.int32)
+    result[result == 0] = nodata
+    return result
+
+
 def _process_month(
-        clip_path_band_list, nodata, rain_event_threshold,
+        clip_path_band_list, nodata, rain_event_threshold, window_days,
         target_monthly_precip_path):
+    """Count the storm events of the windows ending in a month.
+
+    Args:
+        clip_path_band_list (list): (path, band) daily precip rasters of the
+            month in date order, preceded by up to ``window_days-1`` days of
+            the previous month so windows crossing into the month count.
+        nodata (float): nodata of the precip rasters and the target.
+        rain_event_threshold (float): see ``count_storm_events``.
+        window_days (int): see ``count_storm_events``.
+        target_monthly_precip_path (str): path to the int32 event count
+            raster to create.
+
+    Returns:
+        number of storm events in the month summed over every pixel, it is
+        tallied as the blocks are written so the raster isn't read back.
+    """
+    event_sum = 0
+
     def _process_month_op(*precip_array):
-        result = numpy.zeros(precip_array[0].shape, dtype=int)
-        valid_mask = numpy.zeros(result.shape, dtype=bool)
-        if len(precip_array) >= 2:
-            for precip_a, precip_b in zip(
-                    precip_array[:-1], precip_array[1:]):
-                # convert to mm and average by /2 for 48 hr period
-                local_mask = (precip_a+precip_b)/2 >= rain_event_threshold
-                result += local_mask
-                valid_mask |= local_mask
-        else:
-            local_mask = precip_array[0] >= rain_event_threshold
-            result += local_mask
-            valid_mask |= local_mask
-        result[~valid_mask] = nodata
+        nonlocal event_sum
+        result = count_storm_events(
+            precip_array, nodata, rain_event_threshold, window_days)
+        event_sum += int(numpy.sum(result[result != nodata]))
         return result
 
     LOGGER.info(f'about to process {target_monthly_precip_path}')
@@ -113,13 +176,40 @@ def _process_month(
         clip_path_band_list,
         _process_month_op,
         target_monthly_precip_path, gdal.GDT_Int32, nodata)
+    return event_sum
+
+
+def _process_month_from_cube(
+        cube_dir, date_list, rain_event_threshold, window_days,
+        target_monthly_precip_path):
+    """``_process_month`` over days of a ``daily_cube.DailyCube``.
+
+    Args:
+        cube_dir (str): directory of the precip cube.
+        date_list (list): days of the month in the form YYYY-MM-DD,
+            preceded by up to ``window_days-1`` days of the previous month.
+        rain_event_threshold (float): see ``count_storm_events``.
+        window_days (int): see ``count_storm_events``.
+        target_monthly_precip_path (str): path to the int32 event count
+            raster to create.
+
+    Returns:
+        number of storm events in the month summed over every pixel.
+    """
+    cube = daily_cube.DailyCube(cube_dir)
+    result = count_storm_events(
+        cube.read(date_list), cube.nodata, rain_event_threshold, window_days)
+    cube.write_raster(result, target_monthly_precip_path)
+    return int(numpy.sum(result[result != cube.nodata]))
 
 
 def main():
     start_time = time.time()
     parser = argparse.ArgumentParser(description=(
-        'Detect storm events in a 48 hour window using a threshold for '
-        'precip. Result is located in a directory called '
+        'Detect storm events in a rolling window of days (48 hours by '
+        'default) using a threshold for average daily precip. Windows '
+        'that cross a month boundary count toward the month they end in. '
+        'Result is located in a directory called '
         '`workspace_{vector name}` and contains rasters for each month over '
         'the time period showing nubmer of precip events per pixel, a raster '
         'prefixed with "overall_" showing the overall storm event per pixel, '
@@ -134,14 +224,59 @@ def main():
     parser.add_argument(
         '--rain_event_threshold', default=0.1, type=float,
         help='amount of rain (mm) in a day to count as a rain event')
+    parser.add_argument(
+        '--window_days', default=2, type=int,
+        help='number of consecutive days to average precip over')
+    parser.add_argument(
+        '--cube_cache_dir', help=(
+            'if set, clipped days are kept in memory-mapped per-AOI cubes in '
+            'this directory and reused across runs and date ranges'))
+    key_manifest.add_manifest_arguments(parser)
+    parser.add_argument(
+        '--window_read_root', help=(
+            'local directory, s3://bucket/prefix or http(s):// URL of tiled '
+            'copies of the dataset keys, if set only the AOI window of each '
+            'day is read from it with range requests instead of '
+            'downloading the whole day'))
+    parser.add_argument(
+        '--clip_cache_dir', default='era5_clip_cache', help=(
+            'directory the clipped days are kept in by AOI, variable and '
+            'date, every date range of this and later runs shares them'))
+    stage_profile.add_profile_arguments(parser)
     args = parser.parse_args()
-
-    result_workspace_path_list = []
-    for start_date, end_date in args.date_range:
-        result_workspace_path = process_date_range(
-            args.path_to_watersheds, start_date, end_date,
-            args.rain_event_threshold)
-        result_workspace_path_list.append(result_workspace_path)
+    if args.window_days < 1:
+        raise ValueError(
+            f'--window_days must be at least 1, got {args.window_days}')
+    profile = stage_profile.profile_from_args(args)
+
+    manifest = key_manifest.manifest_from_args(DATASET_ID, args)
+    clip_cache = ClipCache(
+        args.clip_cache_dir, args.path_to_watersheds, DATASET_ID,
+        MASK_NODATA, window_read_root=args.window_read_root)
+    task_graph = taskgraph.TaskGraph(
+        args.clip_cache_dir, multiprocessing.cpu_count(), 15.0)
+    profile.start_summary()
+    try:
+        # date ranges are scheduled side by side on one graph, days they
+        # share are clipped once and their months are processed together
+        with ThreadPoolExecutor(
+                max_workers=len(args.date_range)) as executor:
+            result_workspace_path_list = list(executor.map(
+                lambda date_range: str(process_date_range(
+                    args.path_to_watersheds, *date_range,
+                    args.rain_event_threshold, args.window_days,
+                    cube_cache_dir=args.cube_cache_dir, manifest=manifest,
+                    clip_cache=clip_cache, task_graph=task_graph,
+                    profile=profile)),
+                args.date_range))
+        if clip_cache.window_read_task_list:
+            LOGGER.info(window_read.transfer_summary([
+                clip_task.get()
+                for clip_task in clip_cache.window_read_task_list]))
+    finally:
+        task_graph.join()
+        task_graph.close()
+        profile.write_report()
 
     LOGGER.info(
         f'******** ALL DONE ({time.time()-start_time:.2f}s), results '
@@ -150,8 +285,35 @@ def main():
 
 def process_date_range(
         path_to_watersheds, start_date, end_date,
-        rain_event_threshold):
-    """Process a given date range for storm event detection."""
+        rain_event_threshold, window_days=2, cube_cache_dir=None,
+        manifest=None, clip_cache=None, task_graph=None, profile=None):
+    """Process a given date range for storm event detection.
+
+    Args:
+        path_to_watersheds (str): path to the AOI vector.
+        start_date (str): first day in the form YYYY-MM-DD.
+        end_date (str): last day in the form YYYY-MM-DD.
+        rain_event_threshold (float): see ``count_storm_events``.
+        window_days (int): see ``count_storm_events``.
+        cube_cache_dir (str): if not None, clipped days are appended to a
+            ``daily_cube`` cube in this directory and events are counted
+            from the cube, days already in it aren't fetched.
+        manifest (key_manifest.KeyManifest): answers whether the days
+            exist, if None every day is probed with
+            ``fetch_data.file_exists``.
+        clip_cache (clip_cache.ClipCache): cache the days are clipped into,
+            shared by the date ranges of a run, if None they are clipped
+            into the workspace.
+        task_graph (taskgraph.TaskGraph): graph the date range is scheduled
+            on, shared by the date ranges of a run. If None the date range
+            gets its own that is closed before returning, otherwise the
+            caller closes it.
+        profile (stage_profile.StageProfile): if not None, the tasks and
+            stages of the date range are recorded to it.
+
+    Returns:
+        path to the workspace of the results.
+    """
     vector_basename = os.path.basename(
         os.path.splitext(path_to_watersheds)[0])
     project_basename = (
@@ -159,141 +321,158 @@ def process_date_range(
     workspace_dir = Path(f'workspace_{project_basename}')
     workspace_dir.mkdir(parents=True, exist_ok=True)
 
-    task_graph = taskgraph.TaskGraph(
-        workspace_dir, multiprocessing.cpu_count(), 15.0)
+    owns_task_graph = task_graph is None
+    if owns_task_graph:
+        task_graph = taskgraph.TaskGraph(
+            workspace_dir, multiprocessing.cpu_count(), 15.0)
+    if profile is None:
+        profile = stage_profile.StageProfile()
+    task_graph = profile.wrap(task_graph)
 
     monthly_date_range_list = build_monthly_ranges(
         start_date, end_date)
     LOGGER.debug(monthly_date_range_list)
 
-    clip_dir = os.path.join(workspace_dir, 'clip')
-    os.makedirs(clip_dir, exist_ok=True)
-
-    monthly_precip_path_list = []
+    if clip_cache is None:
+        clip_cache = ClipCache(
+            os.path.join(workspace_dir, 'clip'), path_to_watersheds,
+            DATASET_ID, MASK_NODATA)
+    if manifest is None:
+        manifest = key_manifest.KeyManifest(DATASET_ID)
+
+    cube = None
+    if cube_cache_dir is not None:
+        cube = daily_cube.open_cube(daily_cube.aoi_cube_dir(
+            cube_cache_dir, path_to_watersheds, DATASET_ID, VARIABLE_ID))
+
+    # every month's clips are scheduled before any is processed so they all
+    # download in parallel
+    month_plan_list = []
     for start_date, end_date in monthly_date_range_list:
         month_start_day = datetime.datetime.strptime(start_date, '%Y-%m-%d')
         month_end_day = datetime.datetime.strptime(end_date, '%Y-%m-%d')
 
         existance_set = {}
-        for date in daterange(month_start_day, month_end_day):
-            date_str = date.strftime('%Y-%m-%d')
-            clip_path = os.path.join(
-                clip_dir, f'clip_{DATASET_ID}_{VARIABLE_ID}_{date_str}')
-
-            vector_info = geoprocessing.get_vector_info(path_to_watersheds)
-            vector_projection = osr.SpatialReference()
-            vector_projection.ImportFromWkt(vector_info['projection_wkt'])
-            if vector_projection.IsProjected():
-                clip_cell_size = (ERA5_RESOLUTION_M, -ERA5_RESOLUTION_M)
-            else:
-                clip_cell_size = (ERA5_RESOLUTION_DEG, -ERA5_RESOLUTION_DEG)
-
+        date_str_list = [
+            date.strftime('%Y-%m-%d')
+            for date in daterange(month_start_day, month_end_day)]
+        for date_str in date_str_list:
+            if cube is not None and date_str in cube:
+                continue
             dataset_args = {
                 'date': date_str,
                 'variable': VARIABLE_ID
             }
-
-            fetch_and_clip_args = (
-                DATASET_ID, dataset_args,
-                clip_cell_size,
-                path_to_watersheds, clip_path)
-
-            exists_task = task_graph.add_task(
-                func=fetch_data.file_exists,
-                args=(DATASET_ID, dataset_args),
-                store_result=True,
-                transient_run=True,
-                task_name=(
-                    f'test if {DATASET_ID}/{VARIABLE_ID}/{date_str} '
-                    'exists'))
             existance_set[f'{DATASET_ID}/{VARIABLE_ID}/{date_str}'] = (
-                exists_task, VARIABLE_ID, (fetch_and_clip_args, clip_path))
+                VARIABLE_ID, dataset_args)
 
+        with profile.stage('check_exists'):
+            missing_args_list = manifest.missing([
+                dataset_args for _, dataset_args in existance_set.values()])
         missing_file_list = [
-            variable_str
-            for variable_str, (_, exist_task, _) in existance_set.items()
-            if not exists_task.get()]
+            f'{DATASET_ID}/{dataset_args["variable"]}/{dataset_args["date"]}'
+            for dataset_args in missing_args_list]
         if missing_file_list:
-            task_graph.join()
-            task_graph.close()
+            if owns_task_graph:
+                task_graph.join()
+                task_graph.close()
             raise RuntimeError(
                 'The following data cannot be found in the cloud: ' +
                 ', '.join(missing_file_list))
 
+        clip_date_list = []
         clip_path_band_list = []
         clip_task_list = []
-        for _, variable_id, (fetch_args, clip_path) in existance_set.values():
-            LOGGER.info(f'clip path: {clip_path}')
-            clip_task = task_graph.add_task(
-                func=fetch_data.fetch_and_clip,
-                args=fetch_args,
-                kwargs={
-                    'all_touched': True,
-                    'target_mask_value': MASK_NODATA},
-                target_path_list=[clip_path],
-                task_name=f'fetch and clip {clip_path}')
-            clip_path_band_list.append((clip_path, 1))
-            clip_task_list.append(clip_task)
-
+        with profile.stage('schedule_clips'):
+            for variable_id, dataset_args in existance_set.values():
+                clip_path, clip_task = clip_cache.schedule(
+                    task_graph, dataset_args)
+                LOGGER.info(f'clip path: {clip_path}')
+                clip_date_list.append(dataset_args['date'])
+                clip_path_band_list.append((clip_path, 1))
+                clip_task_list.append(clip_task)
+        month_plan_list.append((
+            start_date, end_date, date_str_list, clip_date_list,
+            clip_path_band_list, clip_task_list))
+
+    window_label = f'{24*window_days}hr'
+    n_halo_days = window_days - 1
+    monthly_precip_path_list = []
+    # trailing days of the previous month that windows can start in
+    halo_date_list = []
+    halo_path_band_list = []
+    halo_task_list = []
+    for (start_date, end_date, date_str_list, clip_date_list,
+            clip_path_band_list, clip_task_list) in month_plan_list:
         monthly_precip_path = os.path.join(
-            workspace_dir, f'''{vector_basename}_48hr_avg_precip_events_{
-            start_date}_{end_date}.tif''')
-        monthly_precip_task = task_graph.add_task(
-            func=_process_month,
-            args=(
-                clip_path_band_list, MASK_NODATA, rain_event_threshold,
-                monthly_precip_path),
-            target_path_list=[monthly_precip_path],
-            dependent_task_list=clip_task_list,
-            task_name=f'process month {monthly_precip_path}')
+            workspace_dir, f'''{vector_basename}_{
+            window_label}_avg_precip_events_{start_date}_{end_date}.tif''')
+        if cube is None:
+            monthly_precip_task = task_graph.add_task(
+                func=_process_month,
+                args=(
+                    halo_path_band_list + clip_path_band_list, MASK_NODATA,
+                    rain_event_threshold, window_days, monthly_precip_path),
+                target_path_list=[monthly_precip_path],
+                dependent_task_list=halo_task_list + clip_task_list,
+                store_result=True,
+                task_name=f'process month {monthly_precip_path}')
+        else:
+            # appended here, in one process, so the cube has a single writer
+            for date_str, (clip_path, _), clip_task in zip(
+                    clip_date_list, clip_path_band_list, clip_task_list):
+                clip_task.join()
+                with profile.stage('append_cube'):
+                    cube.append(date_str, clip_path)
+            monthly_precip_task = task_graph.add_task(
+                func=_process_month_from_cube,
+                args=(
+                    cube.cube_dir, halo_date_list + date_str_list,
+                    rain_event_threshold, window_days, monthly_precip_path),
+                target_path_list=[monthly_precip_path],
+                store_result=True,
+                task_name=f'process month {monthly_precip_path}')
+        if n_halo_days > 0:
+            halo_date_list = (halo_date_list + date_str_list)[-n_halo_days:]
+            halo_path_band_list = (
+                halo_path_band_list + clip_path_band_list)[-n_halo_days:]
+            halo_task_list = (halo_task_list + clip_task_list)[-n_halo_days:]
         monthly_precip_path_list.append(
-            (monthly_precip_task, start_date[:7], Path(monthly_precip_path)))
+            (monthly_precip_task, start_date[:7], monthly_precip_path))
 
     precip_over_all_time_path = Path(os.path.join(
-        workspace_dir, f'''overall_{project_basename}_48hr_avg_precip_events_{
-        start_date}_{end_date}.tif'''))
+        workspace_dir, f'''overall_{project_basename}_{
+        window_label}_avg_precip_events_{start_date}_{end_date}.tif'''))
 
     table_path = r'\\?\{}'.format(
         Path(f'{os.path.splitext(precip_over_all_time_path)[0]}.csv').
         resolve())
 
-    with open(table_path, 'w') as csv_table:
+    # overall events per pixel, streamed a strip at a time over the months
+    task_graph.add_task(
+        func=streaming_reducer.reduce_rasters,
+        args=(
+            [raster_path for _, _, raster_path in monthly_precip_path_list],
+            {'sum': str(precip_over_all_time_path)}),
+        kwargs={'target_nodata': MASK_NODATA, 'target_dtype': 'int32'},
+        target_path_list=[str(precip_over_all_time_path)],
+        dependent_task_list=[
+            monthly_precip_task
+            for monthly_precip_task, _, _ in monthly_precip_path_list],
+        task_name=f'overall storm events {precip_over_all_time_path}')
+
+    # the months are waited for first so the write is timed on its own
+    month_event_list = [
+        (month_date, monthly_precip_task.get())
+        for monthly_precip_task, month_date, _ in monthly_precip_path_list]
+    with profile.stage('write_tables'), open(table_path, 'w') as csv_table:
         csv_table.write('year-month,number of storm events in region\n')
-        running_sum = None
-        for monthly_precip_task, month_date, raster_path in \
-                monthly_precip_path_list:
-            monthly_precip_task.join()
-            absolute_raster_path = r'\\?\{}'.format(raster_path.resolve())
-            r = gdal.OpenEx(str(absolute_raster_path))
-            b = r.GetRasterBand(1)
-            array = b.ReadAsArray()
-            nodata = b.GetNoDataValue()
-            b = None
-            r = None
-            csv_table.write(
-                f'{month_date},{numpy.sum(array[array != nodata])}\n')
-            if running_sum is None:
-                running_sum = array
-                valid_mask = array != nodata
-            else:
-                local_valid_mask = array != nodata
-                running_sum[local_valid_mask] += array[local_valid_mask]
-                valid_mask |= local_valid_mask
-            array = None
-
-    # write the final overall raster
-    shutil.copyfile(raster_path, precip_over_all_time_path)
-    r = gdal.OpenEx(
-        r'\\?\{}'.format(precip_over_all_time_path.resolve()),
-        gdal.OF_RASTER | gdal.GA_Update)
-    b = r.GetRasterBand(1)
-    running_sum[~valid_mask] = MASK_NODATA
-    b.WriteArray(running_sum)
-    b = None
-    r = None
-
-    task_graph.join()
-    task_graph.close()
+        for month_date, event_count in month_event_list:
+            csv_table.write(f'{month_date},{event_count}\n')
+
+    if owns_task_graph:
+        task_graph.join()
+        task_graph.close()
     return workspace_dir
 
 
@@ -0,0 +1,252 @@
+"""Streaming per-pixel reductions over large stacks of rasters.
+
+Not a command line script, see ``average_rasters.py``. Inputs are read one
+window at a time and folded into running per-pixel accumulators, so memory
+depends on the window size and not on how many rasters are reduced.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import contextlib
+
+from rasterio.windows import Window
+import numpy
+import rasterio
+
+import netcdf_conversion
+
+STAT_LIST = ['mean', 'sum', 'std', 'min', 'max', 'count']
+DEFAULT_NODATA = -9999
+
+
+class BlockAccumulator:
+    """Running per-pixel statistics of a stream of same shaped arrays.
+
+    Only the accumulators the requested stats need are allocated. Mean and
+    standard deviation use Welford's update so they stay accurate over
+    thousands of inputs.
+    """
+
+    def __init__(self, shape, stat_list):
+        """Allocate accumulators.
+
+        Args:
+            shape (tuple): shape of every array that will be added.
+            stat_list (list): stats from ``STAT_LIST`` that will be asked of
+                ``result``.
+        """
+        unknown_stats = set(stat_list) - set(STAT_LIST)
+        if unknown_stats:
+            raise ValueError(
+                f'unknown stats {unknown_stats}, expected {STAT_LIST}')
+        self.count = numpy.zeros(shape, dtype=numpy.int64)
+        self.sum = None
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        if 'sum' in stat_list:
+            self.sum = numpy.zeros(shape, dtype=numpy.float64)
+        if 'mean' in stat_list or 'std' in stat_list:
+            self.mean = numpy.zeros(shape, dtype=numpy.float64)
+        if 'std' in stat_list:
+            self.m2 = numpy.zeros(shape, dtype=numpy.float64)
+        if 'min' in stat_list:
+            self.min = numpy.full(shape, numpy.inf)
+        if 'max' in stat_list:
+            self.max = numpy.full(shape, -numpy.inf)
+
+    def load_moments(self, count, mean, m2):
+        """Resume from the count, mean and squared deviation sum of a stream.
+
+        Only the "mean" and "std" statistics resume, e.g. from moments
+        ``climatology`` persisted.
+        """
+        if self.mean is None:
+            raise ValueError('only accumulators of "mean" or "std" can resume')
+        self.count[:] = count
+        self.mean[:] = mean
+        if self.m2 is not None:
+            self.m2[:] = m2
+
+    def add(self, array, valid_mask):
+        """Fold the `valid_mask` pixels of `array` into the statistics."""
+        array = array.astype(numpy.float64, copy=False)
+        self.count += valid_mask
+        if self.sum is not None:
+            self.sum += numpy.where(valid_mask, array, 0)
+        if self.mean is not None:
+            delta = numpy.where(valid_mask, array - self.mean, 0)
+            self.mean += delta / numpy.maximum(self.count, 1)
+            if self.m2 is not None:
+                self.m2 += delta * numpy.where(
+                    valid_mask, array - self.mean, 0)
+        if self.min is not None:
+            numpy.fmin(
+                self.min, numpy.where(valid_mask, array, numpy.inf),
+                out=self.min)
+        if self.max is not None:
+            numpy.fmax(
+                self.max, numpy.where(valid_mask, array, -numpy.inf),
+                out=self.max)
+
+    def result(self, stat, nodata):
+        """Return `stat` per pixel, `nodata` where no input was valid.
+
+        "std" is the population standard deviation and "count" is the number
+        of valid inputs, it is 0 rather than `nodata` where none were.
+        """
+        if stat == 'count':
+            return self.count
+        if stat == 'sum':
+            result = self.sum
+        elif stat == 'mean':
+            result = self.mean
+        elif stat == 'std':
+            result = numpy.sqrt(self.m2 / numpy.maximum(self.count, 1))
+        elif stat == 'min':
+            result = self.min
+        elif stat == 'max':
+            result = self.max
+        else:
+            raise ValueError(f'unknown stat {stat}, expected {STAT_LIST}')
+        return numpy.where(self.count > 0, result, nodata)
+
+
+def _check_shape(raster, raster_path, raster_shape):
+    if raster.shape != raster_shape:
+        raise ValueError(
+            f'expected {raster_path} to be {raster_shape} like the '
+            f'first raster but it is {raster.shape}')
+
+
+def read_windows(
+        raster_path_list, window, max_open, raster_shape,
+        open_raster_by_path=None):
+    """Read `window` of band 1 of each raster, at most `max_open` at once.
+
+    Args:
+        open_raster_by_path (dict): rasters already open for reading, by
+            path, each is read on one thread at a time. Other paths are
+            opened and closed around their read.
+
+    Yields:
+        (array, nodata) tuples in the order of `raster_path_list`.
+    """
+    if open_raster_by_path is None:
+        open_raster_by_path = {}
+
+    def _read(raster_path):
+        if raster_path in open_raster_by_path:
+            raster = open_raster_by_path[raster_path]
+            return raster.read(1, window=window), raster.nodata
+        with rasterio.open(raster_path) as raster:
+            _check_shape(raster, raster_path, raster_shape)
+            return raster.read(1, window=window), raster.nodata
+
+    with ThreadPoolExecutor(max_open) as executor:
+        future_queue = collections.deque()
+        for raster_path in raster_path_list:
+            # bound the lookahead so unconsumed windows don't pile up
+            if len(future_queue) >= 2*max_open:
+                yield future_queue.popleft().result()
+            future_queue.append(executor.submit(_read, raster_path))
+        while future_queue:
+            yield future_queue.popleft().result()
+
+
+def valid_pixel_mask(array, nodata):
+    """Return the pixels of `array` that are finite and not `nodata`."""
+    valid_mask = numpy.isfinite(array)
+    if nodata is not None:
+        valid_mask &= array != nodata
+    return valid_mask
+
+
+def reduce_rasters(
+        raster_path_list, target_path_by_stat, target_nodata=None,
+        max_open=4, chunk_mb=256, creation_options=None,
+        target_dtype='float32'):
+    """Reduce a stack of same-grid rasters to per-pixel statistics.
+
+    The target grid is cut into row strips that fit in `chunk_mb`. Each
+    input is read one strip at a time and added to the strip's
+    ``BlockAccumulator``, so memory is independent of the number of inputs.
+    If there are no more than `max_open` inputs they stay open across
+    strips, otherwise each is opened once per strip, keeping the least
+    recently used handles wouldn't help as every strip reads the inputs in
+    the same order. Each input's own nodata value is honored per pixel.
+
+    Args:
+        raster_path_list (list): paths to single band rasters, all of the
+            same size and georeferencing as the first one.
+        target_path_by_stat (dict): maps stats in ``STAT_LIST`` to the path
+            of the raster to write that stat to.
+        target_nodata (float): nodata of the targets, defaults to the
+            nodata of the first raster, or ``DEFAULT_NODATA`` if it has
+            none. "count" targets have no nodata.
+        max_open (int): maximum number of inputs open at the same time.
+        chunk_mb (float): approximate memory budget for the accumulators
+            of one strip.
+        creation_options (dict): GDAL creation options of the targets,
+            see ``netcdf_conversion.open_geotiff``.
+        target_dtype (str): data type of the targets other than "count",
+            e.g. "int32" to sum integer counts.
+
+    Returns:
+        None
+    """
+    if not raster_path_list:
+        raise ValueError('no rasters to reduce')
+    with rasterio.open(raster_path_list[0]) as base_raster:
+        n_rows, n_cols = base_raster.height, base_raster.width
+        base_profile = {
+            'height': n_rows,
+            'width': n_cols,
+            'count': 1,
+            'crs': base_raster.crs,
+            'transform': base_raster.transform,
+        }
+        if target_nodata is None:
+            target_nodata = base_raster.nodata
+    if target_nodata is None:
+        target_nodata = DEFAULT_NODATA
+
+    stat_list = list(target_path_by_stat)
+    # count, plus up to 3 float64 accumulators and a couple of temporaries
+    bytes_per_pixel = 8 * (len(stat_list) + 4)
+    rows_per_strip = max(
+        1, int(chunk_mb * 2**20 // (bytes_per_pixel * n_cols)))
+
+    target_raster_by_stat = {}
+    with contextlib.ExitStack() as stack:
+        for stat, target_path in target_path_by_stat.items():
+            if stat == 'count':
+                profile = {**base_profile, 'dtype': 'int32', 'nodata': None}
+            else:
+                profile = {
+                    **base_profile, 'dtype': target_dtype,
+                    'nodata': target_nodata}
+            target_raster_by_stat[stat] = stack.enter_context(
+                netcdf_conversion.open_geotiff(
+                    target_path, creation_options, **profile))
+        open_raster_by_path = {}
+        # a path listed twice would be read from two threads at once
+        if len(set(raster_path_list)) == len(raster_path_list) <= max_open:
+            for raster_path in raster_path_list:
+                raster = stack.enter_context(rasterio.open(raster_path))
+                _check_shape(raster, raster_path, (n_rows, n_cols))
+                open_raster_by_path[raster_path] = raster
+
+        for row_off in range(0, n_rows, rows_per_strip):
+            window = Window(
+                0, row_off, n_cols, min(rows_per_strip, n_rows-row_off))
+            accumulator = BlockAccumulator(
+                (window.height, window.width), stat_list)
+            for array, nodata in read_windows(
+                    raster_path_list, window, max_open, (n_rows, n_cols),
+                    open_raster_by_path):
+                accumulator.add(array, valid_pixel_mask(array, nodata))
+            for stat, target_raster in target_raster_by_stat.items():
+                target_raster.write(
+                    accumulator.result(stat, target_nodata).astype(
+                        target_raster.dtypes[0]), 1, window=window)
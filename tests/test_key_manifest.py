@@ -0,0 +1,162 @@
+"""Tests of key_manifest over a local directory and a moto S3 bucket."""
+import json
+import os
+import threading
+
+import pytest
+
+pytest.importorskip('ecoshard.fetch_data')
+import key_manifest
+
+FILE_FORMAT = 'era5/{variable}/era5_{variable}_{date}.tif'
+DATE_LIST = [f'2020-01-{day:02d}' for day in range(1, 11)]
+PRESENT_DATE_LIST = DATE_LIST[::2]
+
+
+class _ProbeRecorder:
+    """Stands in for ``fetch_data.file_exists``, records the probed args."""
+
+    def __init__(self, existing_key_set=()):
+        self.existing_key_set = set(existing_key_set)
+        self.probed_args_list = []
+        self._lock = threading.Lock()
+
+    def __call__(self, dataset_id, dataset_args):
+        with self._lock:
+            self.probed_args_list.append(dataset_args)
+        return FILE_FORMAT.format(**dataset_args) in self.existing_key_set
+
+
+def _args_list(variable='t2m'):
+    return [{'variable': variable, 'date': date} for date in DATE_LIST]
+
+
+def _absent_args_list(variable='t2m'):
+    return [
+        dataset_args for dataset_args in _args_list(variable)
+        if dataset_args['date'] not in PRESENT_DATE_LIST]
+
+
+@pytest.fixture
+def probe(monkeypatch):
+    probe = _ProbeRecorder()
+    monkeypatch.setattr(key_manifest.fetch_data, 'file_exists', probe)
+    return probe
+
+
+@pytest.fixture
+def local_root(tmp_path):
+    root = tmp_path / 'mirror'
+    for variable in ['t2m', 'tp']:
+        for date in PRESENT_DATE_LIST:
+            key_path = root / FILE_FORMAT.format(variable=variable, date=date)
+            key_path.parent.mkdir(parents=True, exist_ok=True)
+            key_path.write_bytes(b'')
+    # shares the literal prefix of a t2m key but isn't one
+    (root / 'era5' / 't2m' / 'era5_t2m_2020-01-02.tif.tmp').write_bytes(b'')
+    return str(root)
+
+
+def test_list_keys_walks_only_the_prefix(local_root):
+    key_list = key_manifest.list_keys(local_root, 'era5/t2m/era5_t2m_')
+    assert sorted(key_list) == sorted(
+        [FILE_FORMAT.format(variable='t2m', date=date)
+         for date in PRESENT_DATE_LIST] +
+        ['era5/t2m/era5_t2m_2020-01-02.tif.tmp'])
+
+
+def test_missing_is_exactly_the_absent_keys(local_root, probe):
+    manifest = key_manifest.KeyManifest(
+        'era5_daily', root=local_root, file_format=FILE_FORMAT)
+    assert manifest.missing(_args_list()) == _absent_args_list()
+    assert manifest.missing(_args_list('tp')) == _absent_args_list('tp')
+    # only keys the listing doesn't have are probed
+    assert sorted(
+        (args['variable'], args['date'])
+        for args in probe.probed_args_list) == sorted(
+        (args['variable'], args['date'])
+        for args in _absent_args_list() + _absent_args_list('tp'))
+    assert manifest.exists({'variable': 't2m', 'date': DATE_LIST[0]})
+    assert not manifest.exists({'variable': 't2m', 'date': DATE_LIST[1]})
+
+
+def test_probe_fallback_finds_keys_published_after_the_listing(
+        local_root, probe):
+    manifest = key_manifest.KeyManifest(
+        'era5_daily', root=local_root, file_format=FILE_FORMAT)
+    late_args = {'variable': 't2m', 'date': DATE_LIST[1]}
+    probe.existing_key_set.add(FILE_FORMAT.format(**late_args))
+    assert late_args not in manifest.missing(_args_list())
+    assert manifest.missing(_args_list()) == [
+        dataset_args for dataset_args in _absent_args_list()
+        if dataset_args != late_args]
+    # remembered for the rest of the run rather than probed again
+    assert probe.probed_args_list.count(late_args) == 1
+
+
+def test_no_root_probes_every_key(probe):
+    probe.existing_key_set.update(
+        FILE_FORMAT.format(variable='t2m', date=date)
+        for date in PRESENT_DATE_LIST)
+    manifest = key_manifest.KeyManifest(
+        'era5_daily', file_format=FILE_FORMAT)
+    assert manifest.missing(_args_list()) == _absent_args_list()
+    assert len(probe.probed_args_list) == len(DATE_LIST)
+
+
+def test_listing_is_cached_for_its_ttl(local_root, tmp_path, probe):
+    cache_dir = str(tmp_path / 'cache')
+    manifest = key_manifest.KeyManifest(
+        'era5_daily', root=local_root, file_format=FILE_FORMAT,
+        cache_dir=cache_dir)
+    assert manifest.missing(_args_list()) == _absent_args_list()
+    (cache_path,) = [
+        os.path.join(cache_dir, filename)
+        for filename in os.listdir(cache_dir)]
+
+    # a new key on disk isn't seen while the cached listing is fresh
+    new_key = FILE_FORMAT.format(variable='t2m', date=DATE_LIST[1])
+    new_key_path = os.path.join(local_root, new_key)
+    with open(new_key_path, 'wb'):
+        pass
+    cached_manifest = key_manifest.KeyManifest(
+        'era5_daily', root=local_root, file_format=FILE_FORMAT,
+        cache_dir=cache_dir)
+    assert cached_manifest.missing(_args_list()) == _absent_args_list()
+    with open(cache_path) as cache_file:
+        assert new_key not in json.load(cache_file)['key_list']
+
+    # an expired listing is listed again
+    expired_manifest = key_manifest.KeyManifest(
+        'era5_daily', root=local_root, file_format=FILE_FORMAT,
+        cache_dir=cache_dir, ttl_hours=0)
+    assert expired_manifest.missing(_args_list()) == [
+        dataset_args for dataset_args in _absent_args_list()
+        if dataset_args['date'] != DATE_LIST[1]]
+    with open(cache_path) as cache_file:
+        assert new_key in json.load(cache_file)['key_list']
+
+
+def test_missing_over_a_moto_bucket(monkeypatch, probe):
+    boto3 = pytest.importorskip('boto3')
+    moto = pytest.importorskip('moto')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='mirror')
+        for date in PRESENT_DATE_LIST:
+            client.put_object(
+                Bucket='mirror',
+                Key='data/' + FILE_FORMAT.format(variable='t2m', date=date),
+                Body=b'')
+        # outside the root prefix, must not be listed
+        client.put_object(
+            Bucket='mirror',
+            Key=FILE_FORMAT.format(variable='t2m', date=DATE_LIST[1]),
+            Body=b'')
+        manifest = key_manifest.KeyManifest(
+            'era5_daily', root='s3://mirror/data', file_format=FILE_FORMAT)
+        assert manifest.missing(_args_list()) == _absent_args_list()
+    assert len(probe.probed_args_list) == len(_absent_args_list())
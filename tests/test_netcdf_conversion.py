@@ -0,0 +1,322 @@
+"""Regression tests of the converters that go through netcdf_conversion.
+
+Each converter's output is compared with the output of the writer it had
+before ``netcdf_conversion`` existed, reproduced here, on synthetic NetCDF
+files.
+"""
+import os
+
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+import numpy
+import pandas
+import pytest
+import rasterio
+import rasterio.warp
+import rasterio.windows
+import xarray
+
+import netcdf_conversion
+
+LEGACY_CREATION_OPTIONS = {'tiled': 'YES', 'COMPRESS': 'LZW', 'PREDICTOR': 2}
+
+
+def _legacy_span_convert(dataset, target_path_fn):
+    """Writer of update_era5, fetch_aer_anomalies and the AER GDM script."""
+    res_list = []
+    coord_list = []
+    for field_id in ['longitude', 'latitude']:
+        coord_array = dataset.coords[field_id]
+        res_list.append(float(
+            (coord_array[-1] - coord_array[0]) / len(coord_array)))
+        coord_list.append(coord_array)
+    transform = Affine.translation(
+        *[a[0] for a in coord_list]) * Affine.scale(*res_list)
+    target_path_variable_id_list = []
+    for variable_id, data_array in dataset.items():
+        target_path = target_path_fn(variable_id)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        with rasterio.open(
+                target_path, mode='w', driver='GTiff',
+                height=len(coord_list[1]), width=len(coord_list[0]),
+                count=1, dtype=numpy.float32, nodata=None,
+                crs='+proj=latlong', transform=transform,
+                **LEGACY_CREATION_OPTIONS) as new_dataset:
+            new_dataset.write(data_array)
+        target_path_variable_id_list.append((target_path, variable_id))
+    return target_path_variable_id_list
+
+
+def _legacy_netcdf_to_geotiff(
+        nc_path, x_y_fields, selector, variable_name, target_nodata,
+        target_path):
+    """Whole array writer of netcdf_to_geotiff, then its ``warp_to_180``."""
+    dataset = xarray.open_dataset(nc_path)
+    res_list = []
+    coord_list = []
+    for field_id in x_y_fields:
+        coord_array = dataset.coords[field_id]
+        res_list.append(float(numpy.median(numpy.diff(coord_array))))
+        coord_list.append(coord_array)
+    transform = Affine.translation(
+        coord_list[0][0] + res_list[0]/2,
+        coord_list[1][0] + res_list[1]/2) * Affine.scale(*res_list)
+    src_array = dataset.sel(**selector)[variable_name]
+    if len(src_array.dims) == 2:
+        src_array = src_array.expand_dims('band')
+    if target_nodata is not None:
+        src_array = src_array.fillna(target_nodata)
+    with rasterio.open(
+            target_path, mode='w', driver='GTiff',
+            height=len(coord_list[1]), width=len(coord_list[0]),
+            count=src_array.shape[0], dtype=numpy.float32,
+            nodata=target_nodata, crs='+proj=latlong +datum=WGS84',
+            transform=transform,
+            **LEGACY_CREATION_OPTIONS) as new_dataset:
+        new_dataset.write(src_array)
+    dataset.close()
+    _legacy_warp_to_180(target_path)
+
+
+def _legacy_warp_to_180(local_raster_path):
+    """``warp_to_180`` of netcdf_to_geotiff on rasterio's GDAL warper.
+
+    The raster is read through a window one pixel bigger on every side,
+    like the buffered VRT was, and warped from ``+lon_wrap=180`` with
+    nearest neighbour onto the same bounds moved 180 degrees west, like
+    ``geoprocessing.warp_raster`` was.
+    """
+    with rasterio.open(local_raster_path) as local_raster:
+        x_size = abs(local_raster.transform.a)
+        y_size = abs(local_raster.transform.e)
+        left, bottom, right, top = local_raster.bounds
+        if right <= 180:
+            return
+        buffered_bounds = [
+            min(left, right) - x_size, max(bottom, top) + y_size,
+            max(left, right) + x_size, min(bottom, top) - y_size]
+        buffered_bounds[1] = min(buffered_bounds[1], 90)
+        buffered_bounds[3] = max(buffered_bounds[3], -90)
+        window = rasterio.windows.from_bounds(
+            buffered_bounds[0], buffered_bounds[3], buffered_bounds[2],
+            buffered_bounds[1], local_raster.transform)
+        nodata = local_raster.nodata
+        buffered_array = local_raster.read(
+            window=window, boundless=True,
+            fill_value=0 if nodata is None else nodata)
+        buffered_transform = local_raster.window_transform(window)
+        profile = local_raster.profile
+    target_bb = list(buffered_bounds)
+    if target_bb[2] > 180:
+        target_bb[2] -= 180
+        target_bb[0] -= 180
+    target_transform = Affine.translation(
+        target_bb[0], target_bb[1]) * Affine.scale(x_size, -y_size)
+    target_array = numpy.empty(
+        (buffered_array.shape[0],
+         int(round((target_bb[1] - target_bb[3]) / y_size)),
+         int(round((target_bb[2] - target_bb[0]) / x_size))),
+        dtype=buffered_array.dtype)
+    rasterio.warp.reproject(
+        buffered_array, target_array, src_transform=buffered_transform,
+        src_crs=CRS.from_string('+proj=longlat +datum=WGS84 +lon_wrap=180'),
+        src_nodata=nodata, dst_transform=target_transform,
+        dst_crs=CRS.from_string('+datum=WGS84 +proj=longlat'),
+        dst_nodata=nodata, resampling=rasterio.warp.Resampling.nearest)
+    profile.update(
+        height=target_array.shape[1], width=target_array.shape[2],
+        transform=target_transform)
+    with rasterio.open(local_raster_path, 'w', **profile) as target_raster:
+        target_raster.write(target_array)
+
+
+def _assert_same_geotiff(expected_path, actual_path):
+    with rasterio.open(expected_path) as expected, \
+            rasterio.open(actual_path) as actual:
+        assert actual.shape == expected.shape
+        assert actual.count == expected.count
+        assert actual.dtypes == expected.dtypes
+        assert actual.transform.almost_equals(expected.transform)
+        assert actual.crs == expected.crs
+        assert actual.nodata == expected.nodata or (
+            numpy.isnan(actual.nodata) and numpy.isnan(expected.nodata))
+        assert actual.descriptions == expected.descriptions
+        numpy.testing.assert_array_equal(actual.read(), expected.read())
+
+
+def _write_lat_lng_netcdf(nc_path, longitude, n_time=0):
+    """Write a float32 NetCDF with two variables and some NaNs."""
+    latitude = numpy.arange(59.875, 40, -0.25)
+    random_state = numpy.random.RandomState(7)
+    dims = ('latitude', 'longitude')
+    coords = {'latitude': latitude, 'longitude': longitude}
+    shape = (len(latitude), len(longitude))
+    if n_time:
+        dims = ('time',) + dims
+        coords['time'] = pandas.date_range('2000-01-01', periods=n_time)
+        shape = (n_time,) + shape
+    variable_by_id = {}
+    for variable_id in ['tp', 't2m']:
+        values = random_state.gamma(1, 2, shape).astype(numpy.float32)
+        values[..., 3, 5] = numpy.nan
+        variable_by_id[variable_id] = (dims, values)
+    xarray.Dataset(variable_by_id, coords=coords).to_netcdf(nc_path)
+
+
+@pytest.fixture
+def span_netcdf_path(tmp_path):
+    nc_path = str(tmp_path / 'span.nc')
+    # daily ERA5 and AER files carry a single time step
+    _write_lat_lng_netcdf(nc_path, numpy.arange(10.125, 30, 0.25), n_time=1)
+    return nc_path
+
+
+@pytest.mark.parametrize('module_name, function_name', [
+    ('update_era5', 'process_era5_netcdf_to_geotiff'),
+    ('fetch_aer_anomalies', 'process_era5_anomaly_to_geotiff'),
+    ('extract_drought_thresholds_from_aer_gdm', 'process_netcat_to_geotiff'),
+])
+def test_span_converters_match_legacy(
+        tmp_path, span_netcdf_path, module_name, function_name):
+    module = pytest.importorskip(module_name)
+    date_field = 'year_month' if module_name == 'fetch_aer_anomalies' else (
+        'date')
+    target_path_pattern = str(
+        tmp_path / 'new' / f'{{variable}}_{{{date_field}}}.tif')
+    new_list = getattr(module, function_name)(
+        span_netcdf_path, '2000-01', target_path_pattern)
+    legacy_list = _legacy_span_convert(
+        xarray.open_dataset(span_netcdf_path),
+        lambda variable_id: str(
+            tmp_path / 'legacy' / f'{variable_id}_2000-01.tif'))
+    assert [variable_id for _, variable_id in new_list] == [
+        variable_id for _, variable_id in legacy_list]
+    for (new_path, _), (legacy_path, _) in zip(new_list, legacy_list):
+        _assert_same_geotiff(legacy_path, new_path)
+
+
+def test_cmip6_writers_match_legacy(tmp_path, span_netcdf_path):
+    cmip6_download = pytest.importorskip('cmip6_download')
+    dataset = xarray.open_dataset(span_netcdf_path)
+    res_list = [
+        float((coords[-1] - coords[0]) / len(coords)) for coords in [
+            dataset['longitude'].values, dataset['latitude'].values]]
+    legacy_transform = Affine.translation(
+        float(dataset['longitude'][0]), float(dataset['latitude'][0])) * (
+        Affine.scale(*res_list))
+    geometry = cmip6_download.grid_geometry(dataset, 'tp', span_netcdf_path)
+    assert geometry['transform'].almost_equals(legacy_transform)
+
+    data_values = dataset['tp'].values
+    new_path = str(tmp_path / 'new' / 'day.tif')
+    cmip6_download._write_raster(data_values, geometry['transform'], new_path)
+    legacy_path = str(tmp_path / 'legacy_day.tif')
+    with rasterio.open(
+            legacy_path, mode='w', driver='GTiff',
+            height=data_values.shape[1], width=data_values.shape[2],
+            count=1, dtype=numpy.float32, nodata=None, crs='+proj=latlong',
+            transform=legacy_transform,
+            **LEGACY_CREATION_OPTIONS) as new_dataset:
+        new_dataset.write(data_values)
+    _assert_same_geotiff(legacy_path, new_path)
+
+    cube_values = numpy.concatenate(
+        [dataset['tp'].values, dataset['t2m'].values])
+    date_list = ['2000-01-01', '2000-01-02']
+    new_cube_path = str(tmp_path / 'new' / 'cube.tif')
+    cmip6_download._write_year_cube(
+        cube_values, date_list, geometry['transform'],
+        str(tmp_path / 'local' / 'cube.tif'), new_cube_path)
+    legacy_cube_path = str(tmp_path / 'legacy_cube.tif')
+    with rasterio.open(
+            legacy_cube_path, mode='w', driver='GTiff',
+            height=cube_values.shape[1], width=cube_values.shape[2],
+            count=len(date_list), dtype=numpy.float32, nodata=None,
+            crs='+proj=latlong', transform=legacy_transform,
+            tiled='YES', BLOCKXSIZE=64, BLOCKYSIZE=64, INTERLEAVE='PIXEL',
+            BIGTIFF='IF_SAFER', COMPRESS='LZW',
+            PREDICTOR=2) as new_dataset:
+        new_dataset.write(cube_values)
+        for band_index, date_str in enumerate(date_list):
+            new_dataset.set_band_description(band_index+1, date_str)
+    _assert_same_geotiff(legacy_cube_path, new_cube_path)
+
+
+@pytest.mark.parametrize('chunk_mb', [None, 0.01])
+def test_netcdf_to_geotiff_matches_legacy(tmp_path, chunk_mb):
+    netcdf_to_geotiff = pytest.importorskip('netcdf_to_geotiff')
+    nc_path = str(tmp_path / 'global.nc')
+    # a 0-360 grid, rolled to -180-180 now and warped there before
+    _write_lat_lng_netcdf(nc_path, numpy.arange(0.125, 360, 0.25), n_time=2)
+    job_list = netcdf_to_geotiff.plan_conversions(
+        nc_path, ['longitude', 'latitude'], None, -9999, chunk_mb,
+        str(tmp_path / 'new'))
+    assert len(job_list) == 4
+    dataset = xarray.open_dataset(nc_path)
+    for job in job_list:
+        assert job['x_roll']
+        netcdf_to_geotiff.convert_job(job)
+        legacy_path = str(tmp_path / os.path.basename(job['target_path']))
+        _legacy_netcdf_to_geotiff(
+            nc_path, ['longitude', 'latitude'], job['selector'],
+            job['variable_name'], -9999, legacy_path)
+        with rasterio.open(legacy_path) as legacy, \
+                rasterio.open(job['target_path']) as actual:
+            # the warp kept the buffered VRT's extra pixel on every side
+            window = rasterio.windows.from_bounds(
+                *actual.bounds, transform=legacy.transform).round_offsets(
+                ).round_lengths()
+            assert (window.height, window.width) == actual.shape
+            assert actual.transform.almost_equals(
+                legacy.window_transform(window))
+            assert actual.crs == legacy.crs
+            assert actual.nodata == legacy.nodata
+            assert actual.dtypes == legacy.dtypes
+            legacy_array = legacy.read(window=window)
+            actual_array = actual.read()
+            seam_col = int(round(-actual.transform.c / actual.transform.a))
+        # the warp wrapped longitudes into 0-360, so it looked for the
+        # column at longitude 0 west of where the offset grid starts and
+        # left it nodata, the roll carries the grid's last column there
+        differ_cols = numpy.nonzero(legacy_array != actual_array)[2]
+        assert set(differ_cols) == {seam_col}
+        assert (legacy_array[..., seam_col] == -9999).all()
+        last_col = dataset.sel(**job['selector'])[job['variable_name']]
+        numpy.testing.assert_array_equal(
+            actual_array[0, :, seam_col],
+            last_col.fillna(-9999).values[:, -1])
+    dataset.close()
+
+
+def test_center_convention_is_half_a_pixel_before_the_first_center():
+    x_coords = numpy.arange(0.125, 2, 0.25)
+    y_coords = numpy.arange(59.875, 58, -0.25)
+    transform = netcdf_conversion.grid_transform(
+        x_coords, y_coords, convention='center')
+    assert transform.almost_equals(
+        Affine.translation(0, 60) * Affine.scale(0.25, -0.25))
+    # pixel centers land on the coordinates
+    assert numpy.allclose(transform * (0.5, 0.5), (0.125, 59.875))
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'int32'])
+def test_open_geotiff_writes_every_profile(tmp_path, dtype):
+    array = numpy.arange(64*80, dtype=dtype).reshape(64, 80)
+    for profile_id in netcdf_conversion.CREATION_PROFILES:
+        target_path = str(tmp_path / f'{profile_id}.tif')
+        with netcdf_conversion.open_geotiff(
+                target_path,
+                netcdf_conversion.resolve_creation_options(profile_id, None),
+                height=64, width=80, count=1, dtype=dtype,
+                crs=netcdf_conversion.LATLNG_CRS,
+                transform=Affine.translation(0, 1) * Affine.scale(
+                    0.25, -0.25)) as target_raster:
+            target_raster.write(array, 1)
+        with rasterio.open(target_path) as target_raster:
+            numpy.testing.assert_array_equal(target_raster.read(1), array)
+            if profile_id == 'cog':
+                assert target_raster.tags(
+                    ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        f'{profile_id}.tif'
+        for profile_id in netcdf_conversion.CREATION_PROFILES)
@@ -0,0 +1,86 @@
+"""Window reads of tiled GeoTIFFs served by a local HTTP range server."""
+import functools
+import http.server
+import os
+import threading
+
+from rasterio.transform import Affine
+import geopandas
+import numpy
+import pytest
+import rasterio
+import shapely
+
+window_read = pytest.importorskip('window_read')
+import aoi_context
+import benchmark_window_reads
+import netcdf_conversion
+
+MASK_NODATA = -9999
+
+
+@pytest.fixture
+def range_server(tmp_path):
+    """Serve `tmp_path`/served, yields (server, root url, served dir)."""
+    serve_dir = str(tmp_path / 'served')
+    os.makedirs(serve_dir)
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(
+            benchmark_window_reads._RangeRequestHandler,
+            directory=serve_dir))
+    server.bytes_sent = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield server, f'http://127.0.0.1:{server.server_port}', serve_dir
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize('creation_profile', ['legacy', 'cog'])
+def test_clip_window_matches_full_clip(
+        tmp_path, range_server, creation_profile):
+    server, root_url, serve_dir = range_server
+    key = f'precip_{creation_profile}.tif'
+    source_path = os.path.join(serve_dir, key)
+    array = numpy.random.RandomState(1).gamma(0.3, 2, (361, 720)).astype(
+        numpy.float32)
+    array[180:183, 433:436] = MASK_NODATA
+    netcdf_conversion.write_geotiff(
+        source_path, array,
+        Affine.translation(-180.25, 90.25) * Affine.scale(0.5, -0.5),
+        nodata=MASK_NODATA,
+        creation_options=netcdf_conversion.resolve_creation_options(
+            creation_profile))
+
+    aoi_path = str(tmp_path / 'aoi.gpkg')
+    geopandas.GeoDataFrame(
+        geometry=[shapely.box(35.9, -2.1, 38.1, 0.6)],
+        crs='EPSG:4326').to_file(aoi_path)
+    context_path = aoi_context.build_cached(
+        aoi_path, source_path, str(tmp_path / 'aoi_context'))
+
+    full_clip_path = str(tmp_path / 'full_clip.tif')
+    aoi_context.AoiContext.load(context_path).clip(
+        source_path, full_clip_path, MASK_NODATA)
+    window_clip_path = str(tmp_path / 'window_clip.tif')
+    transfer = window_read.clip_window(
+        context_path, window_read.gdal_path(root_url, key),
+        window_clip_path, MASK_NODATA)
+
+    with rasterio.open(full_clip_path) as full_clip, \
+            rasterio.open(window_clip_path) as window_clip:
+        assert window_clip.shape == full_clip.shape
+        assert window_clip.transform.almost_equals(full_clip.transform)
+        assert window_clip.nodata == full_clip.nodata
+        full_array = full_clip.read()
+        numpy.testing.assert_array_equal(window_clip.read(), full_array)
+    # the AOI covers valid and masked pixels
+    assert (full_array == MASK_NODATA).any()
+    assert (full_array != MASK_NODATA).any()
+
+    file_bytes = os.path.getsize(source_path)
+    assert transfer['file_bytes'] == file_bytes
+    assert 0 < transfer['downloaded_bytes'] < file_bytes
+    assert server.bytes_sent < file_bytes
@@ -7,11 +7,10 @@ import logging
 import os
 import sys
 
-from rasterio.transform import Affine
-import numpy
-import rasterio
 import xarray
 
+import netcdf_conversion
+
 try:
     from ecoshard import fetch_data
 except RuntimeError as e:
@@ -28,7 +27,8 @@ LOGGER.setLevel(logging.DEBUG)
 logging.getLogger('fetch_data').setLevel(logging.INFO)
 
 
-def process_era5_netcdf_to_geotiff(netcdf_path, date_str, target_path_pattern):
+def process_era5_netcdf_to_geotiff(
+        netcdf_path, date_str, target_path_pattern, creation_options=None):
     """Convert era5 netcdf files to geotiff
 
     Args:
@@ -38,59 +38,32 @@ def process_era5_netcdf_to_geotiff(netcdf_path, date_str, target_path_pattern):
         target_path_pattern (str): pattern that will allow the replacement
             of `variable` and `date` strings with the appropriate variable
             date strings in the netcdf variables.
+        creation_options (dict): GDAL creation options, defaults to
+            ``netcdf_conversion.DEFAULT_CREATION_OPTIONS``.
 
     Returns:
         list of (file, variable_id) tuples created by this process
     """
     LOGGER.info(f'processing {netcdf_path}')
     dataset = xarray.open_dataset(netcdf_path)
-
-    res_list = []
-    coord_list = []
-    for coord_id, field_id in zip(['x', 'y'], ['longitude', 'latitude']):
-        coord_array = dataset.coords[field_id]
-        res_list.append(float(
-            (coord_array[-1] - coord_array[0]) / len(coord_array)))
-        coord_list.append(coord_array)
-
-    transform = Affine.translation(
-        *[a[0] for a in coord_list]) * Affine.scale(*res_list)
-
-    target_path_variable_id_list = []
-    for variable_id, data_array in dataset.items():
-        target_path = target_path_pattern.format(**{
+    # legacy "span" georeferencing keeps outputs identical to earlier runs
+    return netcdf_conversion.convert_dataset_variables(
+        dataset,
+        lambda variable_id: target_path_pattern.format(**{
             'date': date_str,
             'variable': variable_id
-            })
-        os.makedirs(os.path.dirname(target_path), exist_ok=True)
-        with rasterio.open(
-            target_path,
-            mode="w",
-            driver="GTiff",
-            height=len(coord_list[1]),
-            width=len(coord_list[0]),
-            count=1,
-            dtype=numpy.float32,
-            nodata=None,
-            crs="+proj=latlong",
-            transform=transform,
-            **{
-                'tiled': 'YES',
-                'COMPRESS': 'LZW',
-                'PREDICTOR': 2}) as new_dataset:
-            new_dataset.write(data_array)
-        target_path_variable_id_list.append((target_path, variable_id))
-    return target_path_variable_id_list
-
-
-def download_and_repack(date_str, target_path_pattern):
+            }),
+        convention='span', creation_options=creation_options)
+
+
+def download_and_repack(date_str, target_path_pattern, creation_options=None):
     try:
         LOGGER.info(f'fetching {date_str}')
         netcdf_path = fetch_data.fetch_file(
             'aer_era5_netcdf_daily', {'date': date_str})
         LOGGER.info(f'downloaded to {netcdf_path}')
         geotiff_path_variable_id_list = process_era5_netcdf_to_geotiff(
-            netcdf_path, date_str, target_path_pattern)
+            netcdf_path, date_str, target_path_pattern, creation_options)
         for geotiff_path, variable_id in geotiff_path_variable_id_list:
             remote_path = fetch_data.put_file(geotiff_path, 'era5_daily', {
                 'date': date_str,
@@ -110,7 +83,10 @@ def main():
     parser.add_argument(
         '--local_workspace', type=str, default='era5_process_workspace',
         help='Directory to downloand and work in.')
+    netcdf_conversion.add_creation_arguments(parser)
     args = parser.parse_args()
+    creation_options = netcdf_conversion.resolve_creation_options(
+        args.creation_profile, args.creation_options)
 
     start_day = datetime.datetime.strptime(args.start_date, '%Y-%m-%d')
     end_day = datetime.datetime.strptime(args.end_date, '%Y-%m-%d')
@@ -128,8 +104,8 @@ def main():
 
     with ThreadPoolExecutor(max_workers=50) as executor:
         _ = list(executor.map(partial(
-            download_and_repack, target_path_pattern=target_path_pattern),
-            date_list))
+            download_and_repack, target_path_pattern=target_path_pattern,
+            creation_options=creation_options), date_list))
 
 
 if __name__ == '__main__':
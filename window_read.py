@@ -0,0 +1,116 @@
+"""Clip days by reading only the AOI window of a remote raster.
+
+Not a command line script. ``fetch_data.fetch_file`` downloads a whole
+global day, 1440x721 pixels per variable, to keep the few pixels of a
+watershed. Tiled and cloud optimized sources can be read a tile at a time
+with HTTP range requests through GDAL's ``/vsicurl/`` and ``/vsis3/``, so
+``clip_window`` transfers only the tiles of the AOI window and the header.
+Downloaded ranges stay in GDAL's LRU chunk cache and connections are kept
+open by the worker process, which the neighbouring days it clips reuse.
+
+S3 compatible stores other than AWS, e.g. a minio server, are selected
+with GDAL's ``AWS_S3_ENDPOINT``, ``AWS_HTTPS`` and ``AWS_VIRTUAL_HOSTING``
+environment variables.
+"""
+import json
+import os
+
+from osgeo import gdal
+from rasterio.transform import Affine
+
+import aoi_context
+
+# megabytes of GDAL's LRU cache of downloaded ranges, shared by every file
+# a process reads
+CURL_CACHE_MB = 64
+GDAL_CONFIG = {
+    # opening a file doesn't list its directory
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_CACHE_SIZE': str(CURL_CACHE_MB * 2**20),
+    # the tiles of a window are fetched over one HTTP/2 connection when the
+    # server has TLS, and adjacent ones in one request
+    'GDAL_HTTP_VERSION': '2TLS',
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'CPL_VSIL_NETWORK_STATS_ENABLED': 'YES',
+}
+
+
+def gdal_path(root, key):
+    """GDAL path of `key` under a local, ``s3://`` or ``http(s)://`` root."""
+    if root.startswith('s3://'):
+        return f'/vsis3/{root[len("s3://"):].rstrip("/")}/{key}'
+    if root.startswith(('http://', 'https://')):
+        return f'/vsicurl/{root.rstrip("/")}/{key}'
+    return os.path.join(root, key)
+
+
+def configure_gdal():
+    """Set ``GDAL_CONFIG`` in this process, it is cheap to repeat."""
+    for key, value in GDAL_CONFIG.items():
+        gdal.SetConfigOption(key, value)
+
+
+def downloaded_bytes():
+    """Bytes GDAL's network file systems have downloaded in this process."""
+    stats = json.loads(gdal.NetworkStatsGetAsSerializedJSON() or '{}')
+    return sum(
+        method_stats.get('downloaded_bytes', 0)
+        for method_stats in stats.get('methods', {}).values())
+
+
+def clip_window(context_path, source_path, target_path, target_mask_value):
+    """Clip a raster on the AOI's grid reading only the AOI window.
+
+    Args:
+        context_path (str): path to a saved ``aoi_context.AoiContext`` of
+            the source's grid.
+        source_path (str): GDAL path of the source, see ``gdal_path``.
+        target_path (str): path to the clipped GeoTIFF to create.
+        target_mask_value (float): see ``aoi_context.AoiContext.clip``.
+
+    Returns:
+        dict with the "downloaded_bytes" of the read, 0 for a local source,
+        and the "file_bytes" of the whole source.
+    """
+    configure_gdal()
+    context = aoi_context.AoiContext.load(context_path)
+    start_bytes = downloaded_bytes()
+    raster = gdal.OpenEx(source_path, gdal.OF_RASTER)
+    if raster is None:
+        raise FileNotFoundError(f'could not open {source_path}')
+    context.check_grid(
+        source_path, (raster.RasterYSize, raster.RasterXSize),
+        Affine.from_gdal(*raster.GetGeoTransform()))
+    band = raster.GetRasterBand(1)
+    window = context.window
+    array = band.ReadAsArray(
+        int(window.col_off), int(window.row_off), int(window.width),
+        int(window.height))
+    nodata = band.GetNoDataValue()
+    band = None
+    raster = None
+    context.write_clip(array, nodata, target_path, target_mask_value)
+    return {
+        'downloaded_bytes': downloaded_bytes() - start_bytes,
+        'file_bytes': gdal.VSIStatL(source_path).size,
+    }
+
+
+def transfer_summary(transfer_list):
+    """One line comparing window reads with downloading the files whole.
+
+    Args:
+        transfer_list (list): results of ``clip_window``.
+
+    Returns:
+        str
+    """
+    read_bytes = sum(
+        transfer['downloaded_bytes'] for transfer in transfer_list)
+    file_bytes = sum(transfer['file_bytes'] for transfer in transfer_list)
+    return (
+        f'window reads of {len(transfer_list)} rasters downloaded '
+        f'{read_bytes/2**20:.2f} MB, downloading them whole is '
+        f'{file_bytes/2**20:.2f} MB '
+        f'({100*read_bytes/max(file_bytes, 1):.2f}%)')
@@ -0,0 +1,262 @@
+"""Zonal statistics from a zone index that is rasterized once per grid.
+
+Not a command line script. ``ZoneIndex.build`` rasterizes the zones of a
+vector onto a raster grid once, after that the stats of any raster on that
+grid are a couple of ``numpy.bincount`` calls and one sort. Indexes are
+cached as ``.npz`` files keyed by the vector and the grid.
+"""
+import hashlib
+import logging
+import os
+
+from rasterio.transform import Affine
+import geopandas
+import numpy
+import rasterio
+import rasterio.features
+
+LOGGER = logging.getLogger(__name__)
+
+# zones are rasterized on a grid this many times finer to weight the
+# pixels they partly cover
+DEFAULT_SUPERSAMPLE = 4
+# upper bound of supersampled pixels rasterized at once
+MAX_STRIP_PIXELS = 2**24
+
+
+class ZoneIndex:
+    """Pixels of a raster grid covered by each zone of a vector.
+
+    Attributes:
+        zone_id_list (list): id of each zone, a zone number indexes it.
+        pixel_index (numpy.ndarray): flat index into the grid of each
+            covered (pixel, zone) pair.
+        zone (numpy.ndarray): zone number of each pair.
+        weight (numpy.ndarray): fraction of the pixel the zone covers, in
+            (0, 1]. A pixel a zone only touches has a small weight rather
+            than none.
+        shape (tuple): rows and columns of the grid.
+        transform (affine.Affine): geotransform of the grid.
+    """
+
+    def __init__(
+            self, zone_id_list, pixel_index, zone, weight, shape,
+            transform):
+        """See the class attributes."""
+        self.zone_id_list = list(zone_id_list)
+        self.pixel_index = pixel_index
+        self.zone = zone
+        self.weight = weight
+        self.shape = tuple(shape)
+        self.transform = Affine(*transform[:6])
+
+    @classmethod
+    def build(
+            cls, vector_path, grid_raster_path, zone_field=None,
+            supersample=DEFAULT_SUPERSAMPLE):
+        """Rasterize the zones of `vector_path` onto a raster's grid.
+
+        Zones are rasterized all-touched on a grid `supersample` times
+        finer than the raster's, a pixel's weight for a zone is the
+        fraction of its sub-pixels that zone touches.
+
+        Args:
+            vector_path (str): path to a polygon vector.
+            grid_raster_path (str): path to a raster on the target grid.
+            zone_field (str): features with the same value of this field are
+                one zone, if None each feature is a zone identified by its
+                position in the vector.
+            supersample (int): sub-pixels per pixel along each axis.
+
+        Returns:
+            ZoneIndex
+        """
+        with rasterio.open(grid_raster_path) as raster:
+            shape = raster.shape
+            transform = raster.transform
+            crs = raster.crs
+        vector = geopandas.read_file(vector_path)
+        if crs is not None and vector.crs is not None:
+            vector = vector.to_crs(crs)
+        if zone_field is None:
+            feature_zone_id_list = list(range(len(vector)))
+        else:
+            feature_zone_id_list = list(vector[zone_field])
+        zone_id_list = list(dict.fromkeys(feature_zone_id_list))
+        zone_number_by_id = {
+            zone_id: zone_number
+            for zone_number, zone_id in enumerate(zone_id_list)}
+        # rasterized value is the zone number + 1 so 0 is no zone
+        shape_list = [
+            (geometry, zone_number_by_id[zone_id] + 1)
+            for geometry, zone_id in zip(
+                vector.geometry, feature_zone_id_list)
+            if geometry is not None and not geometry.is_empty]
+
+        n_rows, n_cols = shape
+        rows_per_strip = max(
+            1, MAX_STRIP_PIXELS // (n_cols * supersample**2))
+        pixel_index_list = []
+        zone_list = []
+        count_list = []
+        for row_off in range(0, n_rows, rows_per_strip):
+            strip_rows = min(rows_per_strip, n_rows-row_off)
+            fine_zone = rasterio.features.rasterize(
+                shape_list,
+                out_shape=(strip_rows*supersample, n_cols*supersample),
+                transform=(
+                    transform * Affine.translation(0, row_off) *
+                    Affine.scale(1/supersample)),
+                fill=0, all_touched=True, dtype=numpy.int32)
+            fine_row, fine_col = numpy.nonzero(fine_zone)
+            if not len(fine_row):
+                continue
+            pixel_index = (
+                (fine_row // supersample + row_off) * n_cols +
+                fine_col // supersample)
+            n_zones_plus_1 = len(zone_id_list) + 1
+            pair_code, sub_pixel_count = numpy.unique(
+                pixel_index * n_zones_plus_1 +
+                fine_zone[fine_row, fine_col],
+                return_counts=True)
+            pixel_index_list.append(pair_code // n_zones_plus_1)
+            zone_list.append((pair_code % n_zones_plus_1 - 1).astype(
+                numpy.int32))
+            count_list.append(sub_pixel_count)
+
+        if pixel_index_list:
+            pixel_index = numpy.concatenate(pixel_index_list)
+            zone = numpy.concatenate(zone_list)
+            weight = numpy.concatenate(count_list) / supersample**2
+        else:
+            pixel_index = numpy.empty(0, dtype=numpy.int64)
+            zone = numpy.empty(0, dtype=numpy.int32)
+            weight = numpy.empty(0)
+        LOGGER.info(
+            f'indexed {len(zone_id_list)} zones of {vector_path} over '
+            f'{len(pixel_index)} pixel/zone pairs of a {shape} grid')
+        return cls(zone_id_list, pixel_index, zone, weight, shape, transform)
+
+    @classmethod
+    def load_or_build(
+            cls, vector_path, grid_raster_path, cache_dir, zone_field=None,
+            supersample=DEFAULT_SUPERSAMPLE):
+        """``build`` unless an index of the same vector and grid is cached.
+
+        The cache key covers the vector's path, size and modification time,
+        the zone field, the supersampling and the grid's shape, transform
+        and projection.
+
+        Args:
+            vector_path (str): see ``build``.
+            grid_raster_path (str): see ``build``.
+            cache_dir (str): directory of the cached indexes.
+            zone_field (str): see ``build``.
+            supersample (int): see ``build``.
+
+        Returns:
+            ZoneIndex
+        """
+        with rasterio.open(grid_raster_path) as raster:
+            grid_key = (
+                raster.shape, tuple(raster.transform)[:6],
+                raster.crs.to_string() if raster.crs else None)
+        vector_stat = os.stat(vector_path)
+        cache_key = hashlib.sha1(repr((
+            os.path.abspath(vector_path), vector_stat.st_size,
+            vector_stat.st_mtime, zone_field, supersample,
+            grid_key)).encode('utf-8')).hexdigest()
+        cache_path = os.path.join(cache_dir, f'zone_index_{cache_key}.npz')
+        if os.path.exists(cache_path):
+            with numpy.load(cache_path, allow_pickle=True) as cached:
+                return cls(
+                    cached['zone_id_list'], cached['pixel_index'],
+                    cached['zone'], cached['weight'], cached['shape'],
+                    cached['transform'])
+        zone_index = cls.build(
+            vector_path, grid_raster_path, zone_field=zone_field,
+            supersample=supersample)
+        os.makedirs(cache_dir, exist_ok=True)
+        # write then rename so a concurrent reader never sees a partial file
+        temp_path = f'{cache_path}.{os.getpid()}.npz'
+        numpy.savez(
+            temp_path,
+            zone_id_list=numpy.array(zone_index.zone_id_list, dtype=object),
+            pixel_index=zone_index.pixel_index, zone=zone_index.zone,
+            weight=zone_index.weight, shape=numpy.array(zone_index.shape),
+            transform=numpy.array(tuple(zone_index.transform)[:6]))
+        os.replace(temp_path, cache_path)
+        return zone_index
+
+    def on_grid_of(self, raster):
+        """True if the open rasterio `raster` is on this index's grid."""
+        return (
+            raster.shape == self.shape and
+            raster.transform.almost_equals(self.transform))
+
+    def zonal_statistics(self, raster_path, percentile_list=(), band=1):
+        """Statistics of each zone for a raster on this index's grid.
+
+        Nodata and non-finite pixels are skipped. The mean is weighted by
+        coverage, min, max and percentiles are of every pixel a zone
+        touches.
+
+        Args:
+            raster_path (str): path to a raster on the indexed grid.
+            percentile_list (list): percentiles in [0, 100] to compute,
+                reported as "p<percentile>", e.g. "p50".
+            band (int): band of `raster_path` to read.
+
+        Returns:
+            dict mapping the zone ids of zones with valid pixels to dicts
+            with "mean", "min", "max", "count" (valid pixels touched),
+            "weight" (valid pixel area in pixels) and the percentiles.
+        """
+        with rasterio.open(raster_path) as raster:
+            if not self.on_grid_of(raster):
+                raise ValueError(
+                    f'{raster_path} is on a {raster.shape} grid at '
+                    f'{raster.transform} but the zone index is on a '
+                    f'{self.shape} grid at {self.transform}')
+            nodata = raster.nodata
+            values = raster.read(band).ravel()[self.pixel_index].astype(
+                numpy.float64)
+
+        valid_mask = numpy.isfinite(values)
+        if nodata is not None:
+            valid_mask &= values != nodata
+        values = values[valid_mask]
+        zone = self.zone[valid_mask]
+        weight = self.weight[valid_mask]
+
+        n_zones = len(self.zone_id_list)
+        count = numpy.bincount(zone, minlength=n_zones)
+        weight_sum = numpy.bincount(zone, weights=weight, minlength=n_zones)
+        weighted_sum = numpy.bincount(
+            zone, weights=weight*values, minlength=n_zones)
+
+        # each zone's values in ascending order, zone after zone
+        sorted_values = values[numpy.lexsort((values, zone))]
+        zone_start = numpy.cumsum(count) - count
+        zone_last = zone_start + count - 1
+        stat_map = {}
+        for zone_number in numpy.nonzero(count)[0]:
+            start = zone_start[zone_number]
+            zone_stats = {
+                'mean': weighted_sum[zone_number] / weight_sum[zone_number],
+                'min': sorted_values[start],
+                'max': sorted_values[zone_last[zone_number]],
+                'count': int(count[zone_number]),
+                'weight': weight_sum[zone_number],
+            }
+            for percentile in percentile_list:
+                # linear interpolation, like numpy.percentile's default
+                position = start + percentile / 100 * (count[zone_number]-1)
+                lower = int(numpy.floor(position))
+                upper = min(lower+1, zone_last[zone_number])
+                fraction = position - lower
+                zone_stats[f'p{percentile:g}'] = (
+                    sorted_values[lower] * (1-fraction) +
+                    sorted_values[upper] * fraction)
+            stat_map[self.zone_id_list[zone_number]] = zone_stats
+        return stat_map